@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: ai
+@author: Memory&Xinxin
+@date: 2019/12/24
+@document: 本地模式的电脑对手：在单独的进程里用确定化的蒙特卡洛树搜索选一步棋
+'''
+
+import sys
+import json
+import math
+import time
+import random
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from .rules import Board, COLORS, RED, BLUE
+from .transposition import TranspositionTable
+
+'''
+没翻开的棋子双方都不知道是什么，只知道还剩哪些棋子没翻开，所以不能直接在真实的棋盘上搜索。
+每次模拟先用 Board.shuffled() 把没翻开的棋子随机重新摆一遍（确定化），再在这个棋盘上
+选择、扩展、模拟、回传。双方看到的东西一样，所以节点按双方都看得到的局面建立（Single-Observer ISMCTS），
+放在置换表里，键是 Board.public_hash()：不同的确定化、不同的走法顺序走到同一个局面，
+以及来回走重复出现的局面，都共用一个节点的统计。
+翻开同一个格子不管翻出什么，在父节点上都是同一条边，翻出来以后才按翻出的棋子分到不同的节点。
+一条边在这次确定化里不能走时不参与选择，UCB 里用它能走的次数代替父节点的访问次数。
+每次模拟最多随机走 ROLLOUT 步，没有结束时按双方剩下棋子的分值估计胜负。
+没有棋可走的一方只能等着超时，搜索里当作认输。
+
+搜索在进程池的一个进程里进行，游戏的画面每 30ms 检查一次结果，不会卡住。
+这个进程一直用同一个置换表，上一步搜过的局面这一步还能接着用。
+难度对应每一步最多想几秒、最多模拟几局，见 configs.AI_LEVELS。
+'''
+
+VALUE = (10, 8, 6, 4, 2, 5)     # 国王、将军、骑士、弓箭手、禁卫军、刺客的分值
+ROLLOUT = 40                    # 每次模拟最多随机走几步
+EXPLORE = 0.7                   # UCB 的探索系数
+TABLE_BITS = 16                 # 置换表有 2 ** TABLE_BITS 个槽
+
+_executor = None
+_table = None
+
+
+class Edge(object):
+    '''
+    节点上的一步棋。
+    '''
+    __slots__ = ('visits', 'wins', 'avail')
+
+    def __init__(self):
+        self.visits = 0             # 模拟经过这一步的次数
+        self.wins = 0.0             # 这些模拟里走这一步的一方的总得分
+        self.avail = 1              # 这一步能走的次数
+
+    def ucb(self):
+        return self.wins / self.visits + EXPLORE * math.sqrt(math.log(self.avail) / self.visits)
+
+
+class Node(object):
+    '''
+    搜索树的节点，对应双方都看得到的一个局面。
+    '''
+    __slots__ = ('edges', )
+
+    def __init__(self):
+        self.edges = {}             # 走法 -> Edge
+
+
+def evaluate(board):
+    '''
+    红方的得分：赢 1、和 0.5、输 0；没有结束时按双方剩下棋子的分值估计。
+    '''
+    if board.result is not None:
+        return 1.0 if board.result == RED else 0.0 if board.result == BLUE else 0.5
+    pieces = board.pieces
+    red = sum(bin(pieces[i]).count('1') * VALUE[i] for i in range(6))
+    blue = sum(bin(pieces[i + 6]).count('1') * VALUE[i] for i in range(6))
+    return 0.5 + 0.5 * (red - blue) / (red + blue)
+
+
+def search(board, seconds, iterations, seed=None, table=None):
+    '''
+    为轮到的一方选一步棋，最多想 seconds 秒、模拟 iterations 局。
+    board 里没翻开的棋子只用来知道还剩哪些棋子，每次模拟都会重新随机摆放。
+    table 是存节点的置换表，传入同一个表时可以接着用以前搜过的局面，默认每次用一个新的表。
+    @return: (走法, 模拟的局数)，走法同 Board.actions()
+    '''
+    rng = random.Random(seed)
+    acts = board.actions()
+    if len(acts) <= 1:
+        return (acts[0] if acts else None), 0
+    if table is None:
+        table = TranspositionTable(TABLE_BITS)
+    table.new_search()
+    root = lookup(table, board, 0)
+    deadline = time.time() + seconds
+    n = 0
+    while n < iterations and time.time() < deadline:
+        b = board.shuffled(rng)
+        node = root
+        path = []                   # 经过的边和走这一步的一方
+        # 选择：所有能走的都走过了，就按 UCB 往下走
+        while b.result is None:
+            acts = b.actions()
+            if not acts:
+                b.resign(b.turn)
+                break
+            if node is None:
+                node = lookup(table, b, len(path))
+            edges = node.edges
+            untried = [a for a in acts if a not in edges]
+            if untried:
+                # 扩展一个没走过的
+                a = rng.choice(untried)
+                edge = edges[a] = Edge()
+                path.append((edge, b.turn))
+                b.apply(a)
+                break
+            legal = [(a, edges[a]) for a in acts]
+            for a, edge in legal:
+                edge.avail += 1
+            a, edge = max(legal, key=lambda item: item[1].ucb())
+            path.append((edge, b.turn))
+            b.apply(a)
+            node = None
+        # 模拟
+        for i in range(ROLLOUT):
+            if b.result is not None:
+                break
+            acts = b.actions()
+            if not acts:
+                b.resign(b.turn)
+                break
+            b.apply(rng.choice(acts))
+        score = evaluate(b)
+        # 回传
+        for edge, color in path:
+            edge.visits += 1
+            edge.wins += score if color == RED else 1 - score
+        n += 1
+    best = max(root.edges, key=lambda a: root.edges[a].visits)
+    return best, n
+
+
+def lookup(table, board, depth):
+    '''
+    置换表里 board 这个局面的节点，没有就新建一个。离根越近的节点越不容易被替换掉。
+    '''
+    key = board.public_hash()
+    node = table.get(key)
+    if node is None:
+        node = Node()
+        table.put(key, node, -depth)
+    return node
+
+
+def shared_search(board, seconds, iterations):
+    '''
+    在进程池的进程里搜索，这个进程里的每次搜索共用一个置换表。
+    '''
+    global _table
+    if _table is None:
+        _table = TranspositionTable(TABLE_BITS)
+    return search(board, seconds, iterations, table=_table)
+
+
+def executor():
+    '''
+    所有的电脑对手共用一个只有一个进程的进程池，第一次用到时才启动。
+    '''
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=1)
+    return _executor
+
+
+class AIPlayer(object):
+    '''
+    电脑对手。think() 在进程池里开始想下一步，poll() 看想好了没有，都不会阻塞。
+    '''
+    def __init__(self, color, seconds, iterations):
+        self.color = color              # 电脑执哪一方，'red' 或 'blue'
+        self.seconds = seconds          # 每一步最多想几秒
+        self.iterations = iterations    # 每一步最多模拟几局
+        self.future = None
+
+    @property
+    def thinking(self):
+        return self.future is not None
+
+    def think(self, board):
+        self.future = executor().submit(shared_search, board, self.seconds, self.iterations)
+
+    def poll(self):
+        '''
+        想好了就返回这一步，否则返回 None。
+        '''
+        if self.future is None or not self.future.done():
+            return None
+        future, self.future = self.future, None
+        return future.result()[0]
+
+    def cancel(self):
+        '''
+        游戏结束了，不再需要正在想的这一步。
+        '''
+        if self.future is not None:
+            self.future.cancel()
+            self.future = None
+
+
+def play(chess, players, seed=None):
+    '''
+    players 是红方、蓝方的 (秒数, 模拟局数)，None 表示随机走。和 AIPlayer 一样，每一方一局里一直用自己的置换表。
+    @return: 结束时的棋盘
+    '''
+    rng = random.Random(seed)
+    board = Board.from_chess(chess)
+    tables = [TranspositionTable(TABLE_BITS) if player else None for player in players]
+    while board.result is None:
+        player = players[board.turn]
+        if not board.actions():
+            board.resign(board.turn)
+        elif player is None:
+            board.apply(rng.choice(board.actions()))
+        else:
+            board.apply(search(board, player[0], player[1], rng.random(), tables[board.turn])[0])
+    return board
+
+
+def main(argv=None):
+    from .utils import random_chess
+
+    parser = argparse.ArgumentParser(prog='python -m battlechess.ai', description='让电脑对手和随机走棋或者另一个电脑对手下几局')
+    parser.add_argument('-n', '--games', type=int, default=20, help='下几局，双方轮流执红')
+    parser.add_argument('-s', '--seconds', type=float, default=1, help='电脑每一步最多想几秒')
+    parser.add_argument('-i', '--iterations', type=int, default=3000, help='电脑每一步最多模拟几局')
+    parser.add_argument('--vs', type=int, default=0, help='对手每一步模拟几局，0 表示随机走')
+    parser.add_argument('--seed', type=int, default=None, help='随机数种子')
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    me = (args.seconds, args.iterations)
+    other = (args.seconds, args.vs) if args.vs else None
+    score = 0.0
+    start = time.time()
+    for i in range(args.games):
+        color = i % 2
+        players = (me, other) if color == RED else (other, me)
+        board = play(random_chess(), players, random.random())
+        score += 0.5 if board.winner is None else float(board.winner == COLORS[color])
+    sys.stdout.write(json.dumps({'games': args.games, 'score': score / args.games if args.games else 0,
+                                 'seconds': round(time.time() - start, 1)}) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: aioserver
+@author: Memory&Xinxin
+@date: 2019/12/18
+@document: 基于 asyncio streams 的服务端，python -m battlechess.runserver --backend asyncio
+'''
+
+import socket
+import asyncio
+from twisted.internet import reactor, defer
+from twisted.internet.address import IPv4Address
+from twisted.internet.error import ConnectionDone, ConnectionLost
+from twisted.python.failure import Failure
+
+'''
+登录、注册、匹配、转发这些逻辑都在 BCServerProtocol 里，它只用到 transport 的
+write、registerProducer、loseConnection、abortConnection 几个方法，和底层是什么无关。
+这里用 asyncio.start_server 接受连接，每个连接把 StreamWriter 包装成一个 transport，
+再用协程读 StreamReader，把数据交给 BCServerProtocol.dataReceived，
+所以两种后端用的是同一套处理逻辑。
+使用这个后端时，runserver 会先安装 Twisted 的 asyncio reactor，
+数据库线程池、定时器这些 Twisted 的部分也都跑在同一个 asyncio 事件循环上。
+'''
+
+READ_SIZE = 65536           # 每次最多读多少字节
+
+
+class StreamTransport(object):
+    '''
+    把 asyncio 的 StreamWriter 包装成 BCServerProtocol 需要的 transport。
+    写缓冲区超过上限时暂停生产者，等 drain() 返回后再恢复，和 Twisted 的 TCP transport 一样。
+    '''
+    __slots__ = ('writer', 'producer', 'disconnecting', 'draining')
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.producer = None
+        self.disconnecting = False
+        self.draining = False
+
+    def write(self, data):
+        if self.disconnecting:
+            return
+        self.writer.write(data)
+        self.check_buffer()
+
+    def writeSequence(self, seq):
+        if self.disconnecting:
+            return
+        self.writer.writelines(seq)
+        self.check_buffer()
+
+    def check_buffer(self):
+        transport = self.writer.transport
+        if self.producer is None or self.draining:
+            return
+        if transport.get_write_buffer_size() > transport.get_write_buffer_limits()[1]:
+            self.draining = True
+            self.producer.pauseProducing()
+            asyncio.ensure_future(self.drain())
+
+    async def drain(self):
+        try:
+            await self.writer.drain()
+        except (ConnectionError, OSError):
+            return
+        self.draining = False
+        if self.producer is not None and not self.disconnecting:
+            self.producer.resumeProducing()
+
+    def loseConnection(self):
+        if not self.disconnecting:
+            self.disconnecting = True
+            self.writer.close()
+
+    def abortConnection(self):
+        self.disconnecting = True
+        self.writer.transport.abort()
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def getPeer(self):
+        return self.address('peername')
+
+    def getHost(self):
+        return self.address('sockname')
+
+    def address(self, name):
+        addr = self.writer.get_extra_info(name)
+        if not addr:
+            return None
+        return IPv4Address('TCP', addr[0], addr[1])
+
+
+async def handle(factory, reader, writer):
+    '''
+    一个连接的整个生命周期：建立连接、不停地读数据、断开。
+    '''
+    transport = StreamTransport(writer)
+    proto = factory.buildProtocol(transport.getPeer())
+    proto.makeConnection(transport)
+    reason = ConnectionDone()
+    try:
+        while True:
+            data = await reader.read(READ_SIZE)
+            if not data:
+                break
+            proto.dataReceived(data)
+    except (ConnectionError, OSError) as e:
+        reason = ConnectionLost(str(e))
+    except asyncio.CancelledError:
+        reason = ConnectionLost('服务器关闭。')
+        raise
+    except Exception as e:
+        # 和 Twisted 一样，处理数据时出错就断开这个连接，不影响其他连接
+        factory.log.print('处理用户 %s 的数据时出错： %r' % (proto.user or proto.id, e))
+        reason = ConnectionLost(repr(e))
+    finally:
+        transport.producer = None
+        transport.disconnecting = True
+        writer.close()
+        proto.connectionLost(Failure(reason))
+
+
+def listen(factory, port=None, sock=None):
+    '''
+    在 port 上（或者用已经建好的 sock）接受连接，需要在 reactor 运行以后调用。
+    @return: Deferred，结果是 asyncio 的 Server
+    '''
+    def started(server):
+        factory.doStart()
+
+        def stop():
+            server.close()
+            factory.doStop()
+
+        reactor.addSystemEventTrigger('before', 'shutdown', stop)
+        factory.log.print('asyncio 后端开始接受连接。')
+        return server
+
+    def failed(failure):
+        factory.log.print('asyncio 后端无法监听端口： %s' % failure.getErrorMessage())
+        reactor.stop()
+
+    coro = asyncio.start_server(lambda r, w: handle(factory, r, w), port=port, sock=sock,
+                                backlog=socket.SOMAXCONN)
+    d = defer.Deferred.fromFuture(asyncio.ensure_future(coro))
+    d.addCallbacks(started, failed)
+    return d
+
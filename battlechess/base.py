@@ -9,7 +9,7 @@
 import pygame
 from pygame.locals import MOUSEBUTTONDOWN
 from twisted.internet import reactor
-from .utils import uninstall_game, get_surface, surface_clip, dict2bin
+from .utils import uninstall_game, get_surface, surface_clip
 from .configs import *
 
 
@@ -74,8 +74,7 @@ class BaseGame(object):
         '''
         if not self.factory or not self.factory.protocol:
             return
-        self.factory.protocol.transport.write(dict2bin(data))
-        # self.factory.protocol.transport.getHandle().sendall(json.dumps(data).encode('utf-8'))
+        self.factory.protocol.send(data)
 
     def get_datas(self, clean=True):
         '''
@@ -214,7 +213,7 @@ class WaitButton(Button):
 
 class Chess(object):
     '''
-    棋子类。
+    棋子类，只负责棋子的图像、位置和朝向，走棋的规则见 rules.py。
     '''
     def __init__(self, color, pos, level, img_chess, cb):
         self.color = color                  # 颜色，即阵营
@@ -257,32 +256,3 @@ class Chess(object):
         返回棋子的位置。
         '''
         return (self.x, self.y)
-
-    def eat(self, chess):
-        '''
-        自己这个棋子能否吃掉 chess
-        '''
-        if self.level == 0 and chess.level == 5:
-            return False
-        if self.level == 5 and chess.level == 0:
-            return True
-        if self.level <= chess.level:
-            return True
-
-    def next(self):
-        '''
-        看棋子下一步能走的格子有哪些。
-        '''
-        next_list = []
-        for d, v in DIRECTION.items():
-            nx = self.x + v[0]
-            ny = self.y + v[1]
-            if nx < 0 or nx >= ROW or ny < 0 or ny >= ROW:
-                continue
-            chess = self.cb[nx][ny]
-            if chess is None:
-                next_list.append((nx, ny))
-            elif chess.open and chess.color != self.color:
-                if self.eat(chess):
-                    next_list.append((nx, ny))
-        return next_list
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: batch
+@author: Memory&Xinxin
+@date: 2019/12/26
+@document: 用 NumPy 同时模拟成千上万局游戏：批量计算能走的步、走棋、判断结束，用于随机模拟和生成数据
+'''
+
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from .rules import Board, BIT, DIRECTION, DEAL_LEVELS, EAT, EMPTY, MAX_NOEAT, ROW, SIZE, RED, BLUE, DRAW
+
+'''
+N 局游戏的棋盘放在一个 N×36 的数组 cell 里，每个格子一个 16 位整数（见 encode()）：
+低 6 位是等级的独热编码，接着 6 位是这个等级能吃掉的等级，再往上是颜色、是否翻开、是否为空。
+颜色、等级、是否翻开三个 N×6×6 的平面可以用同名的属性取出来。
+另外每局轮到哪一方、双方剩下的棋子数、连续没有吃子的步数、一共走的步数、结果各是一个数组。
+规则和 rules.Board 一样（也就是客户端原来的 Chess.eat 和 Chess.next）。
+
+每局的所有走法编成 0 到 179 的整数：第 s 格翻棋是 s，第 s 格的棋子往第 d 个方向
+（同 rules.DIRECTION：上、左、右、下）走是 36 + d * 36 + s。
+legal() 把所有局的格子首尾相接看成一个一维数组，往第 d 个方向走一格就是往后挪 OFFSETS[d] 个，
+和挪过的数组比较后再去掉跨过棋盘边的格子。能不能吃用起点的“能吃的等级”和终点的等级按位与，
+都是连续内存上的按位运算，没有查表，也没有逐局、逐格的 Python 循环。
+apply() 用花式索引一次走完所有局的一步。
+random_rollout() 每局只取一个随机数，按能走的步数缩放后取第几个能走的步，不用给所有走法都取随机数。
+已经结束的局不再参与计算，rows 参数可以只算其中一部分局。
+没有棋可走的一方只能等着超时，random_rollout() 里直接算这一方输，和 ai.py、simulate.py 一样。
+numpy 不是必需的依赖，只有用到这个模块时才需要。
+'''
+
+ACTIONS = SIZE * 5          # 36 种翻棋加上 4 个方向的走棋
+ONGOING = -1                # result 里表示还没有结束
+EAT_TABLE = np.array(EAT, dtype=bool)
+DEAL_COLORS = np.arange(SIZE, dtype=np.int8) % 2
+DEAL_LEVELS_ARRAY = np.array(DEAL_LEVELS, dtype=np.int8)
+
+LEVEL_BITS = 0x3f           # 第 0~5 位：等级 l 是第 l 位
+EAT_SHIFT = 6               # 第 6~11 位：能吃掉的等级，同样每个等级一位
+COLOR_SHIFT = 12
+COLOR_BIT = 1 << 12         # 蓝方的棋子
+OPENED_BIT = 1 << 13        # 翻开了
+EMPTY_CELL = 1 << 14        # 没有棋子
+PIECE_CELLS = np.array([[(1 << a) | sum(1 << (EAT_SHIFT + b) for b in range(6) if EAT[a][b]) | c << COLOR_SHIFT
+                         for a in range(6)] for c in (RED, BLUE)], dtype=np.uint16)
+LEVEL_OF = np.zeros(LEVEL_BITS + 1, dtype=np.int8)
+LEVEL_OF[[1 << a for a in range(6)]] = np.arange(6)
+
+OFFSETS = np.array([dx * ROW + dy for dx, dy in DIRECTION])
+# 第 s 格往第 d 个方向走一格还在不在棋盘上
+INSIDE = np.array([[0 <= s // ROW + dx < ROW and 0 <= s % ROW + dy < ROW for s in range(SIZE)] for dx, dy in DIRECTION])
+
+
+def encode(color, level):
+    '''
+    由颜色和等级得到每个格子的编码，都是没翻开的，翻开的再加上 OPENED_BIT。
+    '''
+    color = np.asarray(color)
+    return np.where(color == EMPTY, EMPTY_CELL, PIECE_CELLS[np.maximum(color, 0), level]).astype(np.uint16)
+
+
+def decode(cell):
+    '''
+    由格子的编码得到颜色、等级、是否翻开，形状和 cell 相同。
+    '''
+    empty = (cell & EMPTY_CELL) != 0
+    color = np.where(empty, EMPTY, cell >> COLOR_SHIFT & 1).astype(np.int8)
+    level = LEVEL_OF[cell & LEVEL_BITS]
+    opened = (cell & OPENED_BIT) != 0
+    return color, level, opened
+
+
+class BoardBatch(object):
+    '''
+    N 局游戏的棋盘。
+    '''
+    def __init__(self, color, level, turn, max_noeat=MAX_NOEAT):
+        n = len(color)
+        self.cell = encode(color, level).reshape(n, SIZE)       # N×36，每个格子的编码
+        self.turn = np.asarray(turn, dtype=np.int8).copy()      # 轮到哪一方
+        piece = (self.cell & EMPTY_CELL) == 0
+        blue = (self.cell & COLOR_BIT) != 0
+        self.left = np.stack([(piece & ~blue).sum(1), (piece & blue).sum(1)], 1).astype(np.int16)
+        self.no_eat = np.zeros(n, dtype=np.int16)               # 连续多少步没有吃子或者翻开棋子
+        self.step = np.zeros(n, dtype=np.int32)                 # 一共走了多少步
+        self.result = np.full(n, ONGOING, dtype=np.int8)        # RED、BLUE、DRAW 或者 ONGOING
+        self.max_noeat = max_noeat
+
+    def __len__(self):
+        return len(self.cell)
+
+    @property
+    def color(self):
+        '''N×6×6，棋子的颜色，EMPTY 表示没有棋子。'''
+        return decode(self.cell)[0].reshape(len(self), ROW, ROW)
+
+    @property
+    def level(self):
+        '''N×6×6，棋子的等级，没有棋子的格子是 0。'''
+        return decode(self.cell)[1].reshape(len(self), ROW, ROW)
+
+    @property
+    def opened(self):
+        '''N×6×6，棋子是否翻开了。'''
+        return decode(self.cell)[2].reshape(len(self), ROW, ROW)
+
+    @classmethod
+    def deal(cls, n, rng=None, turn=RED, max_noeat=MAX_NOEAT):
+        '''
+        随机发 n 局牌，规则同 rules.deal()。turn 可以是每局各自的先手。
+        '''
+        rng = np.random.default_rng(rng)
+        order = np.argsort(rng.random((n, SIZE)), axis=1)      # 第 i 个发的棋子放在 order[:, i] 格
+        color = np.empty((n, SIZE), dtype=np.int8)
+        level = np.empty((n, SIZE), dtype=np.int8)
+        rows = np.arange(n)[:, None]
+        color[rows, order] = DEAL_COLORS
+        level[rows, order] = DEAL_LEVELS_ARRAY
+        return cls(color.reshape(n, ROW, ROW), level.reshape(n, ROW, ROW), np.broadcast_to(turn, n), max_noeat)
+
+    @classmethod
+    def from_boards(cls, boards):
+        '''
+        从一组 rules.Board 建立。
+        '''
+        n = len(boards)
+        at = np.array([b.at for b in boards], dtype=np.int16).reshape(n, SIZE)
+        color = np.where(at == EMPTY, EMPTY, at // 6).astype(np.int8)
+        level = np.where(at == EMPTY, 0, at % 6).astype(np.int8)
+        batch = cls(color, level, [b.turn for b in boards], boards[0].max_noeat if boards else MAX_NOEAT)
+        opened = np.array([[bool(b.opened & BIT[s]) for s in range(SIZE)] for b in boards], dtype=bool).reshape(n, SIZE)
+        batch.cell[opened] |= OPENED_BIT
+        batch.no_eat[:] = [b.no_eat for b in boards]
+        batch.step[:] = [b.step for b in boards]
+        batch.result[:] = [ONGOING if b.result is None else b.result for b in boards]
+        return batch
+
+    def board(self, i):
+        '''
+        第 i 局的 rules.Board。
+        '''
+        color, level, opened = decode(self.cell[i])
+        pieces = [0] * 12
+        mask = 0
+        for s in range(SIZE):
+            if color[s] != EMPTY:
+                pieces[color[s] * 6 + level[s]] |= BIT[s]
+                if opened[s]:
+                    mask |= BIT[s]
+        board = Board(pieces, int(self.turn[i]), self.max_noeat)
+        board.opened = mask
+        board.no_eat = int(self.no_eat[i])
+        board.step = int(self.step[i])
+        board.result = None if self.result[i] == ONGOING else int(self.result[i])
+        board.hash = board.zobrist()
+        return board
+
+    def ongoing(self):
+        '''
+        还没有结束的局的编号。
+        '''
+        return np.flatnonzero(self.result == ONGOING)
+
+    def legal(self, rows=None):
+        '''
+        rows 这些局（默认是所有的局）每种走法能不能走。
+        @return: len(rows)×180 的布尔数组，已经结束的局全是 False
+        '''
+        if rows is None:
+            rows = np.arange(len(self))
+        n = len(rows)
+        cell = self.cell[rows]
+        # 下面每个部分都会整块写一遍，不用先清零
+        out = np.empty((n, 5, SIZE), dtype=bool)
+        np.equal(cell & (OPENED_BIT | EMPTY_CELL), 0, out=out[:, 0])
+        turn = self.turn[rows].astype(np.uint16)[:, None] << COLOR_SHIFT
+        side = cell & (OPENED_BIT | COLOR_BIT)
+        mine = (side == (OPENED_BIT | turn)).ravel()                # 能走的棋子：轮到的一方翻开了的
+        prey = (side == (OPENED_BIT | COLOR_BIT ^ turn)).ravel()    # 能被吃的棋子：对方翻开了的
+        cell = cell.ravel()
+        empty = (cell & EMPTY_CELL) != 0
+        level = cell & LEVEL_BITS
+        eats = cell >> EAT_SHIFT
+        ok = np.zeros(n * SIZE, dtype=bool)
+        for d, o in enumerate(OFFSETS):
+            # 起点是 src 的格子，往这个方向走一格的终点是 dst 的格子；
+            # 跨过棋盘边（包括两头没有赋值的几个格子）的用 INSIDE 去掉
+            src, dst = (slice(0, -o), slice(o, None)) if o > 0 else (slice(-o, None), slice(0, o))
+            eat = (eats[src] & level[dst]) != 0
+            ok[src] = mine[src] & (empty[dst] | (prey[dst] & eat))
+            np.logical_and(ok.reshape(n, SIZE), INSIDE[d], out=out[:, d + 1])
+        done = self.result[rows] != ONGOING
+        if done.any():
+            out[done] = False
+        return out.reshape(n, ACTIONS)
+
+    def apply(self, actions, rows=None):
+        '''
+        rows 这些局（默认是所有的局）各走一步 actions，不检查是否合法，先用 legal() 检查。
+        '''
+        if rows is None:
+            rows = np.arange(len(self))
+        actions = np.asarray(actions)
+        kind, s = np.divmod(actions, SIZE)
+        # 翻棋
+        o = kind == 0
+        self.cell[rows[o], s[o]] |= OPENED_BIT
+        self.no_eat[rows[o]] = 0
+        # 走棋
+        m = ~o
+        r, s = rows[m], s[m]
+        t = s + OFFSETS[kind[m] - 1]
+        dead = self.cell[r, t]
+        eaten = (dead & EMPTY_CELL) == 0
+        self.left[r[eaten], dead[eaten] >> COLOR_SHIFT & 1] -= 1
+        self.no_eat[r] = np.where(eaten, 0, self.no_eat[r] + 1)
+        self.cell[r, t] = self.cell[r, s]
+        self.cell[r, s] = EMPTY_CELL
+        self.turn[rows] ^= 1
+        self.step[rows] += 1
+        self.check(rows)
+
+    def check(self, rows):
+        '''
+        判断 rows 这些局是否结束，顺序同 rules.Board.check()。
+        '''
+        red, blue = self.left[rows, 0], self.left[rows, 1]
+        result = np.full(len(rows), ONGOING, dtype=np.int8)
+        result[self.no_eat[rows] >= self.max_noeat] = DRAW
+        duel = (red == 1) & (blue == 1)
+        if duel.any():
+            color, level, _ = decode(self.cell[rows[duel]])
+            # 每局正好一个红方棋子、一个蓝方棋子，按行的顺序取出来
+            a, b = level[color == RED], level[color == BLUE]
+            result[duel] = np.where(EAT_TABLE[a, b], RED, BLUE)
+        result[blue == 0] = RED
+        result[red == 0] = BLUE
+        self.result[rows] = result
+
+    def resign(self, rows):
+        '''
+        rows 这些局轮到的一方认输。
+        '''
+        self.result[rows] = 1 - self.turn[rows]
+
+    def features(self, rows=None):
+        '''
+        从轮到的一方看到的局面，用来生成训练数据：
+        自己翻开了的 6 个等级、对方翻开了的 6 个等级、没翻开的、空格，一共 14 个 6×6 的平面。
+        @return: len(rows)×14×6×6 的 uint8 数组
+        '''
+        if rows is None:
+            rows = np.arange(len(self))
+        color, level, opened = decode(self.cell[rows].reshape(len(rows), ROW, ROW))
+        turn = self.turn[rows][:, None, None]
+        out = np.zeros((len(rows), 14, ROW, ROW), dtype=np.uint8)
+        levels = np.arange(6)[None, :, None, None]
+        out[:, 0:6] = ((color == turn) & opened)[:, None] & (level[:, None] == levels)
+        out[:, 6:12] = ((color == 1 - turn) & opened)[:, None] & (level[:, None] == levels)
+        out[:, 12] = (color != EMPTY) & ~opened
+        out[:, 13] = color == EMPTY
+        return out
+
+    def random_rollout(self, rng=None, max_plies=None):
+        '''
+        所有还没有结束的局都随机走到结束（或者再走 max_plies 步）。
+        @return: 一共走了多少步
+        '''
+        rng = np.random.default_rng(rng)
+        plies = 0
+        rows = self.ongoing()
+        k = 0
+        while len(rows) and (max_plies is None or k < max_plies):
+            # 所有局能走的步按局排好，每局能走的步数从里面数出来，不用再逐行统计
+            where = np.flatnonzero(self.legal(rows))
+            count = np.bincount(where // ACTIONS, minlength=len(rows))
+            stuck = count == 0
+            if stuck.any():
+                self.resign(rows[stuck])
+                rows, count = rows[~stuck], count[~stuck]
+            # 在能走的步里均匀地随机选一步：每局取一个随机数，乘以能走的步数得到选第几个，
+            # 加上前面几局一共能走的步数就是选中的步在 where 里的位置
+            pick = np.minimum((rng.random(len(rows)) * count).astype(np.int64), count - 1)
+            actions = where[np.cumsum(count) - count + pick] % ACTIONS
+            self.apply(actions, rows)
+            plies += len(rows)
+            rows = rows[self.result[rows] == ONGOING]
+            k += 1
+        return plies
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m battlechess.batch', description='用 NumPy 同时随机模拟很多局游戏')
+    parser.add_argument('-n', '--games', type=int, default=10000, help='同时模拟几局')
+    parser.add_argument('--plies', type=int, default=None, help='每局最多走几步，默认走到结束')
+    parser.add_argument('--seed', type=int, default=None, help='随机数种子')
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+    start = time.time()
+    batch = BoardBatch.deal(args.games, rng, rng.integers(0, 2, args.games))
+    plies = batch.random_rollout(rng, args.plies)
+    seconds = time.time() - start
+    counts = np.bincount(batch.result + 1, minlength=4)
+    sys.stdout.write(json.dumps({
+        'games': args.games, 'positions': int(plies), 'seconds': round(seconds, 3),
+        'positions_per_sec': round(plies / seconds), 'ongoing': int(counts[0]),
+        'red': int(counts[1]), 'blue': int(counts[2]), 'draw': int(counts[3]),
+        'mean_plies': round(float(batch.step.mean()), 1),
+    }, indent=2) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: bench
+@author: Memory&Xinxin
+@date: 2019/12/17
+@document: 服务端的性能测试：每个空闲连接的内存，以及两种网络后端的对比，python -m battlechess.bench -h 查看用法
+'''
+
+import gc
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+from .codec import dict2bin, hello
+from .configs import ROOT_PATH
+
+'''
+不开端口也不启动 reactor，直接创建 n 个 BCServerProtocol，
+接上一个什么都不做的 transport，完成握手（可选再登录），
+用 tracemalloc 统计这些连接一共多分配了多少内存，除以 n 就是每个空闲连接的开销。
+transport 在统计开始前就建好了，不算在里面。
+
+加上 --baseline 提交 时，用 git archive 取出那个提交的 battlechess，放进这个文件，
+在子进程里用同样的方法再统计一遍，输出改动前后每个连接的字节数。
+
+加上 --backends twisted,asyncio 时，依次用每种后端启动服务端，
+用同一个压力测试（loadtest）跑一遍，把吞吐量和延迟放在一起对比。
+没有被识别的参数都原样传给 loadtest。
+'''
+
+
+class IdleTransport(object):
+    '''
+    什么都不做的 transport，只实现服务端会调用到的方法。
+    '''
+    __slots__ = ('producer', 'disconnecting')
+
+    def __init__(self):
+        self.producer = None
+        self.disconnecting = False
+
+    def write(self, data):
+        pass
+
+    def writeSequence(self, data):
+        pass
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def loseConnection(self):
+        self.disconnecting = True
+
+    def abortConnection(self):
+        self.disconnecting = True
+
+    def getPeer(self):
+        return None
+
+    def getHost(self):
+        return None
+
+
+def idle_connections(n, login=False, top=0):
+    '''
+    创建 n 个空闲的连接，返回每个连接占用的字节数，以及分配最多的几行代码。
+    '''
+    from .server import BCServerFactory
+    from .utils import journal, ERROR
+
+    factory = BCServerFactory()
+    factory.log.level = ERROR
+    transports = [IdleTransport() for i in range(n)]
+    packet = dict2bin(hello())
+    names = ['idle%06d' % i for i in range(n)]
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    start = tracemalloc.get_traced_memory()[0]
+
+    conns = []
+    for i, t in enumerate(transports):
+        p = factory.buildProtocol(None)
+        p.makeConnection(t)
+        p.dataReceived(packet)
+        if login:
+            p.login(names[i], {'name': names[i], 'credit': 0, 'title': '平民'})
+        conns.append(p)
+    factory.flush()
+    # 日志和 nonebot 的消息只是暂时放在缓冲区里，不算连接的开销
+    factory.log.buffer.clear()
+    journal.events = []
+    gc.collect()
+
+    used = tracemalloc.get_traced_memory()[0] - start
+    stats = tracemalloc.take_snapshot().compare_to(before, 'lineno')[:top] if top else []
+    tracemalloc.stop()
+    return used / n, [(str(s.traceback), s.size_diff / n) for s in stats]
+
+
+def baseline_size(rev, n, login):
+    '''
+    提交 rev 的服务端每个连接占用的字节数。
+    '''
+    root = os.path.dirname(ROOT_PATH)
+    tmp = tempfile.mkdtemp(prefix='bench-')
+    try:
+        archive = subprocess.check_output(['git', 'archive', rev, 'battlechess'], cwd=root)
+        subprocess.run(['tar', '-x', '-C', tmp], input=archive, check=True)
+        shutil.copy(os.path.abspath(__file__), os.path.join(tmp, 'battlechess', 'bench.py'))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = tmp
+        cmd = [sys.executable, '-m', 'battlechess.bench', '-n', str(n), '--top', '0', '--json']
+        out = subprocess.check_output(cmd + (['--login'] if login else []), cwd=tmp, env=env)
+        return json.loads(out.decode('utf-8').strip().splitlines()[-1])['bytes']
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def wait_port(port, timeout=10):
+    '''
+    等服务端开始监听。
+    '''
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def compare_backends(backends, port, loadargs):
+    '''
+    每种后端各启动一次服务端，用同样的参数跑 loadtest。
+    @return: {后端: loadtest 的结果}
+    '''
+    env = dict(os.environ)
+    root = os.path.dirname(ROOT_PATH)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (root, env.get('PYTHONPATH')) if p)
+    results = {}
+    for backend in backends:
+        server = subprocess.Popen([sys.executable, '-m', 'battlechess.runserver', '-p', str(port), '-m', '0',
+                                   '-b', backend], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            if not wait_port(port):
+                results[backend] = {'errors': {'server_not_started': 1}}
+                continue
+            out = subprocess.check_output([sys.executable, '-m', 'battlechess.loadtest', '-p', str(port)] + loadargs,
+                                          env=env)
+            results[backend] = json.loads(out.decode('utf-8'))
+        finally:
+            server.terminate()
+            server.wait()
+    return results
+
+
+def format_compare(results):
+    '''
+    把几种后端的结果排成一张表。
+    '''
+    rows = [('连接/秒', lambda r: r['connections_per_sec']),
+            ('转发消息/秒', lambda r: r['messages_per_sec']),
+            ('转发延迟 p50 (ms)', lambda r: r['relay_latency_ms'].get('p50')),
+            ('转发延迟 p99 (ms)', lambda r: r['relay_latency_ms'].get('p99')),
+            ('转发延迟 max (ms)', lambda r: r['relay_latency_ms'].get('max')),
+            ('匹配延迟 p50 (ms)', lambda r: r['match_latency_ms'].get('p50')),
+            ('匹配延迟 p99 (ms)', lambda r: r['match_latency_ms'].get('p99')),
+            ('完成的游戏', lambda r: r['games']),
+            ('错误', lambda r: sum(r['errors'].values()))]
+    names = list(results)
+    lines = ['%-20s' % '' + ''.join('%14s' % n for n in names)]
+    for title, get in rows:
+        cells = []
+        for n in names:
+            try:
+                cells.append('%14s' % get(results[n]))
+            except (KeyError, TypeError):
+                cells.append('%14s' % '-')
+        lines.append('%-20s' % title + ''.join(cells))
+    return '\n'.join(lines) + '\n'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m battlechess.bench', description='统计服务端每个空闲连接的内存开销')
+    parser.add_argument('-n', '--connections', type=int, default=10000, help='创建多少个连接')
+    parser.add_argument('--login', action='store_true', help='连接以后再登录，统计在线用户的开销')
+    parser.add_argument('--top', type=int, default=8, help='列出分配内存最多的几行代码')
+    parser.add_argument('--baseline', default=None, help='和哪个 git 提交的服务端对比，例如 HEAD~3')
+    parser.add_argument('--json', action='store_true', help='只输出一行 json')
+    parser.add_argument('--backends', default=None,
+                        help='对比几种网络后端，例如 twisted,asyncio，此时 -n 是机器人的数量')
+    parser.add_argument('-p', '--port', type=int, default=23456, help='对比后端时服务端使用的端口')
+    args, extra = parser.parse_known_args(argv)
+
+    if args.backends:
+        results = compare_backends(args.backends.split(','), args.port, ['-n', str(args.connections)] + extra)
+        sys.stdout.write(format_compare(results))
+        return
+    if extra:
+        parser.error('无法识别的参数： %s' % ' '.join(extra))
+
+    size, stats = idle_connections(args.connections, args.login, args.top)
+    if args.json:
+        sys.stdout.write(json.dumps({'connections': args.connections, 'login': args.login, 'bytes': size}) + '\n')
+        return
+    kind = '已登录的' if args.login else '空闲'
+    if args.baseline:
+        before = baseline_size(args.baseline, args.connections, args.login)
+        sys.stdout.write('%d 个%s连接，每个连接 %s: %.0f 字节 -> 现在: %.0f 字节（%.1f 倍）\n'
+                         % (args.connections, kind, args.baseline, before, size, before / size))
+    else:
+        sys.stdout.write('%d 个%s连接，每个连接 %.0f 字节\n' % (args.connections, kind, size))
+    for where, each in stats:
+        sys.stdout.write('  %8.1f  %s\n' % (each, where))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: cache
+@author: Memory&Xinxin
+@date: 2019/12/06
+@document: 服务端的用户信息缓存
+'''
+
+from collections import OrderedDict
+from twisted.internet import defer, task
+from .database import get_user, update_users
+from .configs import USER_CACHE_SIZE, USER_FLUSH_INTERVAL
+
+
+class UserCache(object):
+    '''
+    用户信息（积分和称号）的 LRU 缓存。
+    在线的用户会被钉住，一直留在缓存里，所以匹配和登录时不用再查数据库；
+    不在线的用户按最近使用的顺序淘汰。
+    积分的修改只改缓存并记为脏数据，由定时器批量写回数据库，
+    同一个用户在两次写回之间改了多少次，都只会写一次。
+    用户下线时立即写回这个用户，多进程模式下等写完才通知主进程释放这个用户，
+    这样用户马上在其他进程登录时，从数据库读到的也是最新的积分。
+    '''
+    def __init__(self, dbworker, log, size=USER_CACHE_SIZE, interval=USER_FLUSH_INTERVAL):
+        self.dbworker = dbworker
+        self.log = log                  # 打印日志的函数
+        self.size = size                # 缓存的最大用户数，钉住的用户不算在限制里
+        self.interval = interval        # 写回数据库的间隔，单位是秒
+        self.users = OrderedDict()      # 用户名 -> 用户信息，越靠后越是最近使用的
+        self.pinned = set()             # 在线的用户
+        self.dirty = set()              # 修改了还没写回的用户
+        self.flushing = {}              # 正在写回的用户 -> 还没写完的次数
+        self.waiters = {}               # 用户名 -> 等这个用户写完的 Deferred 列表
+        self.loop = task.LoopingCall(self.flush)
+
+    def __contains__(self, name):
+        return name in self.users
+
+    def __len__(self):
+        return len(self.users)
+
+    def start(self, reactor):
+        '''
+        开始定时写回，reactor 关闭前再写回一次。
+        '''
+        self.loop.start(self.interval, now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+        return self.flush()
+
+    def get(self, name):
+        '''
+        返回缓存中的用户信息，不在缓存中时返回 None。
+        '''
+        user = self.users.get(name)
+        if user is not None:
+            self.users.move_to_end(name)
+        return user
+
+    def put(self, user):
+        '''
+        把从数据库查到的用户信息放进缓存。
+        如果缓存里的还没写回数据库，以缓存里的为准；否则以数据库的为准，
+        因为多进程模式下这个用户可能在其他进程里改过积分。
+        '''
+        name = user['name']
+        cached = self.users.get(name)
+        if cached is not None:
+            if name not in self.dirty and name not in self.flushing:
+                cached.update(user)
+            return self.get(name)
+        self.users[name] = user
+        self.evict()
+        return user
+
+    def load(self, name):
+        '''
+        返回一个 Deferred，结果是用户信息。缓存没有命中时才查询数据库。
+        '''
+        user = self.get(name)
+        if user is not None:
+            return defer.succeed(user)
+
+        def loaded(user):
+            if user is None:
+                return {'name': name, 'credit': 0, 'title': '平民'}
+            return self.put(user)
+
+        return self.dbworker.read(get_user, name).addCallback(loaded)
+
+    def pin(self, name):
+        '''
+        用户上线，钉在缓存里不被淘汰。
+        '''
+        self.pinned.add(name)
+
+    def unpin(self, name):
+        '''
+        用户下线，之后可以被淘汰。
+        @return: Deferred，这个用户的修改都写回数据库以后触发，写失败也会触发
+        '''
+        self.pinned.discard(name)
+        if name in self.dirty:
+            # 写线程按顺序执行，这一次一定在正在进行的批量写回之后完成
+            self.dirty.discard(name)
+            d = self.write([name])
+        elif name in self.flushing:
+            d = defer.Deferred()
+            self.waiters.setdefault(name, []).append(d)
+        else:
+            d = defer.succeed(None)
+        self.evict()
+        return d
+
+    def update(self, user):
+        '''
+        修改用户的积分和称号，只改缓存，稍后写回。
+        '''
+        name = user['name']
+        cached = self.users.get(name)
+        if cached is None:
+            cached = self.users[name] = {'name': name}
+        cached['credit'] = user['credit']
+        cached['title'] = user['title']
+        self.users.move_to_end(name)
+        self.dirty.add(name)
+
+    def evict(self):
+        '''
+        淘汰最久没用的用户，钉住的和还没写回的不淘汰。
+        '''
+        if len(self.users) <= self.size:
+            return
+        over = len(self.users) - self.size
+        victims = []
+        for name in self.users:
+            if len(victims) >= over:
+                break
+            if name in self.pinned or name in self.dirty:
+                continue
+            victims.append(name)
+        for name in victims:
+            del self.users[name]
+
+    def flush(self):
+        '''
+        把所有脏数据放在一个事务里写回数据库。
+        写失败时重新标记为脏，下次再写，所以这里不会把错误抛给定时器。
+        '''
+        if not self.dirty:
+            return defer.succeed(None)
+        names, self.dirty = self.dirty, set()
+        return self.write(names)
+
+    def write(self, names):
+        '''
+        把 names 这些用户写回数据库，返回的 Deferred 不会失败。
+        '''
+        flushing = self.flushing
+        for n in names:
+            flushing[n] = flushing.get(n, 0) + 1
+        rows = [dict(self.users[n]) for n in names if n in self.users]
+
+        def failed(failure):
+            self.log('写回用户数据失败： %s' % failure.getErrorMessage())
+            self.dirty.update(names)
+
+        def done(_):
+            for n in names:
+                flushing[n] -= 1
+                if not flushing[n]:
+                    del flushing[n]
+                    for d in self.waiters.pop(n, ()):
+                        d.callback(None)
+            self.evict()
+
+        d = self.dbworker.write(update_users, rows)
+        d.addErrback(failed)
+        d.addBoth(done)
+        return d
@@ -10,7 +10,8 @@
 import json
 from tkinter.messagebox import showinfo
 from twisted.internet.protocol import Protocol, ClientFactory
-from .utils import Logging, spilt_data
+from .utils import get_logger, PacketDecoder, FrameError
+from .codec import JSON, encode_packet, hello
 from .configs import CLIENT_LOG_PATH
 
 
@@ -18,14 +19,17 @@ class BCClientProtocol(Protocol):
     def __init__(self, factory, ui):
         self.factory = factory
         self.connected = False
-        self.log = Logging(CLIENT_LOG_PATH)
+        self.log = get_logger(CLIENT_LOG_PATH)
+        self.decoder = PacketDecoder(self.log.print)
+        self.codec = JSON       # 服务端回复握手以前都用json
         self.ui = ui
 
     def connectionMade(self):
         '''
-        建立连接。
+        建立连接，并和服务端协商数据的编码方式。
         '''
         self.connected = True
+        self.send(hello())
 
     def connectionLost(self, reason):
         '''
@@ -36,18 +40,35 @@ class BCClientProtocol(Protocol):
     def dataReceived(self, data):
         '''
         收到服务器的数据时采取的动作。
-        由于数据可能粘包，所以需要先进行分包，然后再逐个处理。
+        由于数据可能粘包或者被拆开，所以先放进解码器的缓冲区，
+        凑成完整的数据包以后再逐个处理。
         '''
-        jsons = spilt_data(data)
+        try:
+            jsons = self.decoder.feed(data)
+        except FrameError as e:
+            self.log.print('服务器发送了非法数据： %s' % e)
+            return
 
         for data in jsons:
-            if 'type' not in data:
-                continue
-            if data['type'] in ['signin', 'signup']:
+            if data['type'] == 'hello':
+                self.codec = data.get('codec', JSON)
+            elif data['type'] == 'ping':
+                self.send({'type': 'pong'})
+            elif data['type'] in ['signin', 'signup']:
                 self.user_login(data)
+            elif data['type'] == 'credit':
+                # 一局结束后服务端算好的积分，界面上的用户信息都是同一个字典
+                if self.ui.user:
+                    self.ui.user.update(data['user'])
             else:
                 self.factory.data.append(data)
 
+    def send(self, data):
+        '''
+        用协商好的编码方式给服务端发送一个数据包。
+        '''
+        self.transport.write(encode_packet(data, self.codec))
+
     def user_login(self, data):
         typ = data['type']
         result = data['result']
@@ -71,7 +92,7 @@ class BCClientFactory(ClientFactory):
         self.data = []
         self.failed = False
         self.lost = False
-        self.log = Logging(CLIENT_LOG_PATH)
+        self.log = get_logger(CLIENT_LOG_PATH)
         self.ui = ui
         self.ui.factory = self
 
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: cluster
+@author: Memory&Xinxin
+@date: 2019/12/10
+@document: 多进程模式的服务端，多个工作进程共用一个端口
+'''
+
+import os
+import sys
+import socket
+from twisted.internet import reactor, defer, task
+from twisted.internet.protocol import Protocol, Factory, ClientCreator, ProcessProtocol
+from .utils import get_logger, journal, qqmsg, write_online, random_chess
+from .codec import PacketDecoder, FrameError, dict2bin
+from .matchmaking import MatchQueue
+from . import metrics
+from .configs import ROOT_PATH, SERVER_LOG_PATH, MATCH_SWEEP
+
+'''
+一个主进程加 N 个工作进程。
+主进程创建监听的 socket，但是自己不接受连接，只把它交给工作进程，
+由操作系统把新连接分给各个工作进程。主进程里运行一个 Broker，
+所有工作进程都连到它上面，它负责：
+    1. 登记每个在线用户在哪个工作进程上，防止一个账号在两个进程上同时登录；
+    2. 所有进程共用一个匹配队列，所以不同进程上的用户也能匹配到一起；
+    3. 对手在其他进程上时，游戏数据包经过它转发。
+主进程和工作进程之间的数据包和客户端一样，是一行一个json。
+'''
+
+
+class BrokerProtocol(Protocol):
+    '''
+    主进程中和一个工作进程的连接。
+    '''
+    def __init__(self, broker):
+        self.broker = broker
+        self.decoder = PacketDecoder(broker.log.print)
+
+    def connectionMade(self):
+        self.broker.log.print('工作进程已连接。')
+
+    def connectionLost(self, reason):
+        self.broker.drop_worker(self)
+
+    def dataReceived(self, data):
+        try:
+            packets = self.decoder.feed(data)
+        except FrameError as e:
+            self.broker.log.print('工作进程发送了非法数据： %s' % e)
+            self.transport.loseConnection()
+            return
+        for packet in packets:
+            handler = self.broker.parse.get(packet['type'])
+            if handler:
+                handler(self, packet)
+
+    def send(self, data):
+        self.transport.write(dict2bin(data))
+
+
+class Broker(Factory):
+    '''
+    主进程中的会话登记和转发中心。
+    '''
+    def __init__(self):
+        self.log = get_logger(SERVER_LOG_PATH)
+        self.sessions = {}              # 用户名 -> 所在工作进程的连接
+        self.wait = MatchQueue()        # 所有进程共用的匹配队列
+        self.profiles = {}              # 等待匹配的用户的信息
+        self.sweeper = task.LoopingCall(self.sweep)
+        metrics.registry.gauge('bc_online_users', '所有工作进程上登录的用户数', lambda: len(self.sessions))
+        metrics.registry.gauge('bc_match_waiting', '正在等待匹配的用户数', lambda: len(self.wait))
+        self.parse = {'claim': self.claim,
+                      'release': self.release,
+                      'enqueue': self.enqueue,
+                      'cancel': self.cancel,
+                      'route': self.route}
+
+    def startFactory(self):
+        self.sweeper.start(MATCH_SWEEP, now=False)
+
+    def stopFactory(self):
+        if self.sweeper.running:
+            self.sweeper.stop()
+
+    def buildProtocol(self, addr):
+        return BrokerProtocol(self)
+
+    def claim(self, worker, data):
+        '''
+        工作进程上的用户登录，检查是否已经在其他进程上登录了。
+        '''
+        name = data['name']
+        owner = self.sessions.get(name)
+        ok = owner is None or owner is worker
+        if ok:
+            self.sessions[name] = worker
+            write_online(len(self.sessions))
+        worker.send({'type': 'claimed', 'id': data['id'], 'ok': ok})
+
+    def release(self, worker, data):
+        '''
+        工作进程上的用户下线。
+        '''
+        name = data['name']
+        if self.sessions.get(name) is worker:
+            self.sessions.pop(name)
+            self.wait.cancel(name)
+            self.profiles.pop(name, None)
+            write_online(len(self.sessions))
+
+    def enqueue(self, worker, data):
+        '''
+        用户请求匹配，能马上匹配到就开始游戏。
+        '''
+        user = data['user']
+        name = user['name']
+        if self.sessions.get(name) is not worker:
+            return
+        self.profiles[name] = user
+        self.wait.add(name, user['credit'])
+        you = self.wait.pair(name)
+        if you is not None:
+            self.start_game(name, you)
+
+    def cancel(self, worker, data):
+        self.wait.cancel(data['name'])
+        self.profiles.pop(data['name'], None)
+
+    def route(self, worker, data):
+        '''
+        把数据包转发给对手所在的工作进程。
+        '''
+        to = self.sessions.get(data['to'])
+        if to is not None:
+            to.send(data)
+
+    def sweep(self):
+        for me, you in self.wait.sweep():
+            self.start_game(me, you)
+
+    def start_game(self, me, you):
+        '''
+        两个用户匹配成功，发棋盘给他们各自所在的工作进程，me 执红先走。
+        '''
+        my_user = self.profiles.pop(me)
+        your_user = self.profiles.pop(you)
+        self.log.print('用户 %s 和 用户 %s 匹配成功。' % (me, you))
+        qqmsg('%s 和 %s' % (me, you), '匹配成功')
+        chess = random_chess()
+        data1 = {'type': 'init', 'chess': chess, 'turn': 'red', 'color': 'red', 'me': my_user, 'you': your_user}
+        data2 = {'type': 'init', 'chess': chess, 'turn': 'red', 'color': 'blue', 'me': your_user, 'you': my_user}
+        self.sessions[me].send({'type': 'start', 'name': me, 'you': you, 'init': data1})
+        self.sessions[you].send({'type': 'start', 'name': you, 'you': me, 'init': data2})
+
+    def drop_worker(self, worker):
+        '''
+        工作进程退出了，它上面的用户都算下线。
+        '''
+        self.log.print('工作进程断开了连接。')
+        for name in [n for n, w in self.sessions.items() if w is worker]:
+            self.release(worker, {'name': name})
+
+
+class ClusterClient(Protocol):
+    '''
+    工作进程和主进程的连接，BCServerFactory.cluster 就是它。
+    '''
+    def __init__(self, factory):
+        self.factory = factory
+        self.decoder = PacketDecoder(factory.log.print)
+        self.pending = {}           # 请求编号 -> 等待回复的 Deferred
+        self.next_id = 0
+
+    def connectionLost(self, reason):
+        # 主进程没了，工作进程也就没有意义了
+        self.factory.log.print('和主进程的连接断开，工作进程退出。')
+        for d in self.pending.values():
+            d.callback(False)
+        self.pending = {}
+        if reactor.running:
+            reactor.stop()
+
+    def dataReceived(self, data):
+        try:
+            packets = self.decoder.feed(data)
+        except FrameError as e:
+            self.factory.log.print('主进程发送了非法数据： %s' % e)
+            return
+        for packet in packets:
+            typ = packet['type']
+            if typ == 'claimed':
+                d = self.pending.pop(packet['id'], None)
+                if d is not None:
+                    d.callback(packet['ok'])
+            elif typ == 'route':
+                self.factory.deliver(packet['to'], packet['packet'])
+            elif typ == 'start':
+                self.factory.join_game(packet['name'], packet['you'], packet['init'])
+
+    def send(self, data):
+        self.transport.write(dict2bin(data))
+
+    def claim(self, name):
+        '''
+        登记用户 name 在本进程登录。
+        @return: Deferred，结果为 True 表示没有在其他进程登录
+        '''
+        self.next_id += 1
+        d = self.pending[self.next_id] = defer.Deferred()
+        self.send({'type': 'claim', 'name': name, 'id': self.next_id})
+        return d
+
+    def release(self, name):
+        self.send({'type': 'release', 'name': name})
+
+    def enqueue(self, user):
+        self.send({'type': 'enqueue', 'user': user})
+
+    def cancel(self, name):
+        self.send({'type': 'cancel', 'name': name})
+
+    def route(self, to, data):
+        self.send({'type': 'route', 'to': to, 'packet': data})
+
+
+class WorkerProcess(ProcessProtocol):
+    '''
+    主进程用来管理一个工作进程，工作进程意外退出时重新启动它。
+    '''
+    def __init__(self, supervisor, wid):
+        self.supervisor = supervisor
+        self.wid = wid
+
+    def processEnded(self, reason):
+        self.supervisor.ended(self, reason)
+
+
+class Supervisor(object):
+    '''
+    启动和重启工作进程。
+    '''
+    def __init__(self, fd, broker_port, workers, metrics_port=0, backend='twisted'):
+        self.fd = fd                        # 监听 socket 的文件描述符
+        self.broker_port = broker_port
+        self.workers = workers
+        self.metrics_port = metrics_port    # 主进程的指标端口，工作进程依次使用后面的端口
+        self.backend = backend              # 工作进程的网络层实现
+        self.processes = {}
+        self.stopping = False
+        self.log = get_logger(SERVER_LOG_PATH)
+
+    def start(self):
+        for wid in range(self.workers):
+            self.spawn(wid)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def spawn(self, wid):
+        env = dict(os.environ)
+        # 保证工作进程能导入 battlechess，不管是安装的还是源码
+        root = os.path.dirname(ROOT_PATH)
+        env['PYTHONPATH'] = os.pathsep.join(p for p in (root, env.get('PYTHONPATH')) if p)
+        args = [sys.executable, '-m', 'battlechess.runserver', '--worker', str(wid),
+                '--broker', str(self.broker_port), '--fd', '3',
+                '--metrics-port', str(self.metrics_port + 1 + wid if self.metrics_port else 0),
+                '--backend', self.backend]
+        proto = WorkerProcess(self, wid)
+        self.processes[wid] = reactor.spawnProcess(proto, sys.executable, args, env=env,
+                                                   childFDs={0: 0, 1: 1, 2: 2, 3: self.fd})
+        self.log.print('启动工作进程 %d。' % wid)
+
+    def ended(self, proto, reason):
+        self.processes.pop(proto.wid, None)
+        if self.stopping:
+            return
+        self.log.print('工作进程 %d 退出了： %s，重新启动。' % (proto.wid, reason.value))
+        reactor.callLater(1, self.spawn, proto.wid)
+
+    def stop(self):
+        self.stopping = True
+        for process in self.processes.values():
+            try:
+                process.signalProcess('TERM')
+            except Exception:
+                pass
+
+
+def runmaster(port, workers, metrics_port=0, backend='twisted'):
+    '''
+    启动主进程：创建监听的 socket，启动 Broker 和 workers 个工作进程。
+    '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', port))
+    sock.listen(socket.SOMAXCONN)
+    sock.setblocking(False)
+
+    broker = Broker()
+    broker_port = reactor.listenTCP(0, broker, interface='127.0.0.1').getHost().port
+    broker.log.print('启动服务器，共 %d 个工作进程。' % workers)
+    journal.start(reactor)
+    if metrics_port:
+        metrics.listen(reactor, metrics_port)
+    Supervisor(sock.fileno(), broker_port, workers, metrics_port, backend).start()
+    reactor.run()
+    sock.close()
+
+
+def runworker(fd, broker_port, wid, metrics_port=0, backend='twisted'):
+    '''
+    启动工作进程：先连接主进程，然后接管主进程传来的监听 socket。
+    '''
+    from .server import BCServerFactory
+    factory = BCServerFactory()
+    # 每个工作进程写自己的对局记录段文件
+    factory.records.prefix = 'w%d' % wid
+    # 在线人数由主进程统计
+    journal.online_path = None
+
+    def connected(link):
+        factory.cluster = link
+        if backend == 'asyncio':
+            from . import aioserver
+            aioserver.listen(factory, sock=socket.socket(socket.AF_INET, socket.SOCK_STREAM, fileno=fd))
+        else:
+            reactor.adoptStreamPort(fd, socket.AF_INET, factory)
+        if metrics_port:
+            metrics.listen(reactor, metrics_port)
+        factory.log.print('工作进程 %d 开始接受连接。' % wid)
+
+    def failed(failure):
+        factory.log.print('工作进程 %d 无法连接主进程： %s' % (wid, failure.getErrorMessage()))
+        reactor.stop()
+
+    d = ClientCreator(reactor, ClusterClient, factory).connectTCP('127.0.0.1', broker_port)
+    d.addCallbacks(connected, failed)
+    reactor.run()
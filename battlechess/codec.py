@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: codec
+@author: Memory&Xinxin
+@date: 2019/12/02
+@document: 网络数据包的编码和分帧
+'''
+
+import json
+import struct
+
+
+MAX_FRAME = 64 * 1024       # 单个数据包的最大长度，超过了就认为对方在乱发数据
+
+'''
+编码方式。json 是最早的格式：一个json字符串加一个换行符。
+bin1 是紧凑的二进制格式，只用在游戏中频繁发送的几种数据包上，格式为：
+    标记(1字节 0xBC) + 类型(1字节) + 长度(2字节) + 内容
+0xBC 不可能是一个 utf-8 字符的开头，所以两种格式可以混在同一个连接里。
+连接建立后客户端先发 hello 数据包告诉服务端自己支持哪些编码，
+服务端选一个回复，之后双方发送的数据就用这个编码。
+不发 hello 的旧客户端一直使用 json。
+'''
+PROTOCOL_VERSION = 2
+JSON = 'json'
+BINARY = 'bin1'
+CODECS = [BINARY, JSON]     # 按优先级排列
+
+BIN_MARK = 0xBC
+BIN_HEADER = struct.Struct('>BBH')
+COLORS = ['red', 'blue']
+
+
+class FrameError(Exception):
+    '''缓冲区里的数据一直凑不成一个完整的数据包，或者二进制帧的内容不合法时抛出。'''
+    pass
+
+
+def dict2bin(data):
+    '''
+    将字典数据转换成字符串，然后加上一个换行符，
+    再转换成二进制数据。
+    '''
+    strdata = json.dumps(data)
+    strdata = strdata + '\n'
+    return strdata.encode('utf-8')
+
+
+def pos2sq(pos):
+    '''
+    将棋盘位置 [x, y] 转换为 0~35 的格子编号。
+    '''
+    x, y = pos
+    if not (0 <= x < 6 and 0 <= y < 6):
+        raise ValueError('位置超出棋盘： %r' % (pos, ))
+    return x * 6 + y
+
+
+def sq2pos(sq):
+    '''
+    将 0~35 的格子编号转换为棋盘位置 [x, y]，编号超出棋盘说明对方在乱发数据。
+    '''
+    if not 0 <= sq < 36:
+        raise FrameError('格子编号超出棋盘： %d' % sq)
+    return [sq // 6, sq % 6]
+
+
+def pack_move(data):
+    return bytes((pos2sq(data['from']), pos2sq(data['to'])))
+
+
+def unpack_move(payload):
+    return {'type': 'move', 'from': sq2pos(payload[0]), 'to': sq2pos(payload[1])}
+
+
+def pack_open(data):
+    return bytes((pos2sq(data['from']), ))
+
+
+def unpack_open(payload):
+    return {'type': 'open', 'from': sq2pos(payload[0])}
+
+
+def pack_giveup(data):
+    return b''
+
+
+def unpack_giveup(payload):
+    return {'type': 'giveup'}
+
+
+def pack_init(data):
+    '''
+    棋盘的每个格子用一个字节表示：高位是颜色，低三位是等级，0xFF表示空。
+    双方的用户信息不定长，直接用json放在最后。
+    '''
+    board = bytearray()
+    for row in data['chess']:
+        for c in row:
+            board.append(COLORS.index(c[0]) << 3 | c[1] if c else 0xFF)
+    if len(board) != 36:
+        raise ValueError('棋盘大小不对')
+    board.append(COLORS.index(data['turn']))
+    board.append(COLORS.index(data['color']))
+    users = json.dumps([data['me'], data['you']]).encode('utf-8')
+    return bytes(board) + users
+
+
+def unpack_init(payload):
+    chess = [[None] * 6 for i in range(6)]
+    for sq in range(36):
+        b = payload[sq]
+        if b != 0xFF:
+            chess[sq // 6][sq % 6] = [COLORS[b >> 3], b & 7]
+    me, you = json.loads(payload[38:].tobytes().decode('utf-8'))
+    return {'type': 'init', 'chess': chess, 'turn': COLORS[payload[36]],
+            'color': COLORS[payload[37]], 'me': me, 'you': you}
+
+
+# 二进制编码的数据包：类型名 -> (类型编号, 打包函数, 解包函数)
+BIN_PACKETS = {'move': (1, pack_move, unpack_move),
+               'open': (2, pack_open, unpack_open),
+               'giveup': (3, pack_giveup, unpack_giveup),
+               'init': (4, pack_init, unpack_init)}
+BIN_UNPACK = {v[0]: v[2] for v in BIN_PACKETS.values()}
+
+
+def encode_packet(data, codec=JSON):
+    '''
+    按照协商好的编码方式编码一个数据包。
+    二进制格式不支持的数据包，或者内容不符合格式的，仍然用json发送。
+    '''
+    if codec == BINARY and data.get('type') in BIN_PACKETS:
+        typ, pack, _ = BIN_PACKETS[data['type']]
+        try:
+            payload = pack(data)
+        except (KeyError, IndexError, TypeError, ValueError):
+            return dict2bin(data)
+        return BIN_HEADER.pack(BIN_MARK, typ, len(payload)) + payload
+    return dict2bin(data)
+
+
+def hello():
+    '''
+    客户端连接后发送的握手数据包。
+    '''
+    return {'type': 'hello', 'version': PROTOCOL_VERSION, 'codecs': CODECS}
+
+
+def choose_codec(data):
+    '''
+    服务端根据客户端的 hello 数据包选择编码方式。
+    '''
+    offer = data.get('codecs') or []
+    for codec in CODECS:
+        if codec in offer:
+            return codec
+    return JSON
+
+
+class PacketDecoder(object):
+    '''
+    增量的数据包解码器，每个连接持有一个。
+    TCP 是流式的，一个数据包可能被拆成两次 dataReceived 收到，
+    也可能几个数据包一次收到，所以收到的数据先放进缓冲区，
+    切出完整的帧，每一帧只解析一次，剩下的半帧留到下次再拼。
+    json 帧以换行符结尾，二进制帧的长度写在帧头里，两种格式都能解析。
+    '''
+    __slots__ = ('buffer', 'max_frame', 'log')
+
+    def __init__(self, log=None, max_frame=MAX_FRAME):
+        self.buffer = bytearray()       # 接收缓冲区
+        self.max_frame = max_frame      # 单帧的最大长度
+        self.log = log                  # 打印日志的函数，解析失败时调用
+
+    def feed(self, data):
+        '''
+        放入新收到的数据，返回其中所有完整的数据包（字典）的列表。
+        '''
+        buf = self.buffer
+        buf += data
+        packets = []
+        start = 0
+        view = memoryview(buf)
+        size = len(buf)
+        try:
+            while start < size:
+                if buf[start] == BIN_MARK:
+                    if size - start < BIN_HEADER.size:
+                        break
+                    _, typ, length = BIN_HEADER.unpack_from(buf, start)
+                    end = start + BIN_HEADER.size + length
+                    if end > size:
+                        break
+                    self._unpack(typ, view[start+BIN_HEADER.size:end], packets)
+                    start = end
+                    continue
+                end = buf.find(b'\n', start)
+                if end < 0:
+                    break
+                if end > start:
+                    self._decode(view[start:end], packets)
+                start = end + 1
+        except FrameError:
+            # 帧内容不合法时，后面的数据也对不上了，整个缓冲区都不要了。
+            # 异常里还引用着帧的 memoryview，不能原地清空，换一个新的缓冲区
+            self.buffer = bytearray()
+            raise
+        finally:
+            # 释放 memoryview 以后才能改变 bytearray 的大小
+            view.release()
+        if start:
+            del buf[:start]
+        if len(buf) > self.max_frame:
+            size = len(buf)
+            del buf[:]
+            raise FrameError('数据包过长： %d 字节' % size)
+        return packets
+
+    def _decode(self, frame, packets):
+        '''
+        解析一帧数据，合法的数据包放进 packets 中。
+        '''
+        raw = frame.tobytes()
+        if not raw.strip():
+            return
+        try:
+            # 防止传来的不是json数据导致解析出错
+            data = json.loads(raw.decode('utf-8'))
+        except ValueError:
+            data = None
+        if isinstance(data, dict) and 'type' in data:
+            packets.append(data)
+        elif self.log:
+            self.log('json数据解析失败，内容为： %r' % raw)
+
+    def _unpack(self, typ, payload, packets):
+        '''
+        解析一个二进制帧，payload 是 memoryview，不会复制数据。
+        格子编号超出棋盘时的 FrameError 不在这里处理，交给调用者断开连接。
+        '''
+        try:
+            packets.append(BIN_UNPACK[typ](payload))
+        except (KeyError, IndexError, ValueError):
+            if self.log:
+                self.log('二进制数据解析失败，类型为： %d' % typ)
+
+    def pending(self):
+        '''
+        返回缓冲区中还没凑成完整数据包的字节数。
+        '''
+        return len(self.buffer)
@@ -16,6 +16,20 @@ MAX_TIMEOUT = 3             # 几次超时会被判输
 MAX_NOEAT = 30              # 几步不吃子或者翻棋会被判和棋
 MIN_GIVEUP = 20             # 几步以后才可以认输
 WIN_CREDIT = 20             # 赢了棋加的积分
+TIMEOUT_SLACK = 3           # 服务端判超时时多给的秒数，抵消网络延迟
+LOCAL_AI = 'normal'         # 本地模式电脑对手的难度，None 表示两个人在同一台电脑上对战
+AI_LEVELS = {               # 每个难度电脑每一步最多想几秒、最多模拟几局
+    'easy': (0.3, 300),
+    'normal': (1, 3000),
+    'hard': (3, 30000),
+}
+
+'''匹配设置'''
+MATCH_BUCKET = 100          # 匹配队列按积分分桶，每个桶的积分宽度
+MATCH_WINDOW = 100          # 刚开始匹配时能接受的积分差
+MATCH_WIDEN = 50            # 每多等一秒，能接受的积分差放宽多少
+MATCH_SWEEP = 1             # 每隔几秒给还在等待的用户重新匹配一次
+WATCH_LIST = 50             # 请求观战列表时最多返回几局游戏
 
 '''窗口设置'''
 WINDOW_TITILE = '皇家战棋 For Xinxin By Memory'  # 窗口标题
@@ -93,17 +107,37 @@ for img in imgs:
 SERVER_LOG_PATH = os.path.join(ROOT_PATH, 'log', 'server')     # 服务器的日志文件路径
 CLIENT_LOG_PATH = os.path.join(ROOT_PATH, 'log', 'client')     # 客户端的日志文件路径
 
+LOG_LEVEL = 20                      # 日志级别，10:DEBUG, 20:INFO, 30:WARNING, 40:ERROR
+LOG_FLUSH_INTERVAL = 1              # 日志写入文件的间隔（秒）
+LOG_BUFFER_SIZE = 100000            # 日志缓冲区最多存多少条
+
 LOGIN_LOG = os.path.join(SERVER_LOG_PATH, 'log_qq.txt')
 ONLINE_PATH = os.path.join(SERVER_LOG_PATH, 'online.txt')
+JOURNAL_INTERVAL = 2                # 给 nonebot 的消息和在线人数写入文件的间隔（秒）
 
 DATABASE_PATH = os.path.join(ROOT_PATH, 'database')
 USERDB = os.path.join(DATABASE_PATH, 'users.db')               # 数据库的路径
+DB_READERS = 4                                                  # 服务端读数据库的线程数
+USER_CACHE_SIZE = 10000                                         # 服务端缓存的离线用户数
+USER_FLUSH_INTERVAL = 5                                         # 用户积分写回数据库的间隔（秒）
+RECORD_PATH = os.path.join(DATABASE_PATH, 'records')            # 对局记录的目录
+RECORD_SEGMENT_SIZE = 64 * 1024 * 1024                          # 对局记录的一个段文件写到多大换下一个
+RECORD_FLUSH_INTERVAL = 2                                       # 对局记录写入磁盘的间隔（秒）
+RECORD_BATCH = 256                                              # 攒够这么多局就立即写入
+NAME_LIMIT = 64                                                 # 用户名 utf-8 编码后最多多少字节，对局记录里用一个字节存长度
+LEADERBOARD_TOP = 100                                           # 排行榜缓存前多少名
+LEADERBOARD_REFRESH = 60                                        # 多进程时每隔多少秒从数据库重新建立排行榜
 
 '''IP 设置，联网对战的服务器'''
 HOST = '39.106.67.160'              # 服务器地址
 PORT = 1122                         # 端口
 LOCAL_HOST = '127.0.0.1'            # 本地服务器地址
 LOCAL_PORT = 1122                   # 本地端口
+HEARTBEAT_INTERVAL = 15             # 服务端多少秒没收到客户端的数据就发送心跳
+HEARTBEAT_TIMEOUT = 45              # 服务端多少秒没收到客户端的数据就断开连接
+IDLE_TIMEOUT = 600                  # 不支持心跳的旧客户端多少秒没有数据就断开连接
+OUTBOX_LIMIT = 1024 * 1024          # 服务端给一个连接待发送的数据超过这么多字节就断开它
+METRICS_PORT = 1123                 # 服务端运行指标的 HTTP 端口，只监听本机，0 表示不开启
 
 
 '''随机用户设置'''
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: database
+@author: Memory&Xinxin
+@date: 2019/12/05
+@document: 服务端的数据库访问层
+'''
+
+import os
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from twisted.python.threadpool import ThreadPool
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.failure import Failure
+from .metrics import DB_LATENCY, DB_ERRORS
+from .configs import USERDB, DATABASE_PATH, DB_READERS
+
+
+class DatabaseError(Exception):
+    '''数据库操作失败时抛出，代替原来返回 None 的做法。'''
+    pass
+
+
+class LoginError(Exception):
+    '''用户名不存在或者密码错误时抛出，参数是给用户看的原因。'''
+    pass
+
+
+class Database(object):
+    '''
+    长期持有数据库连接的管理器。
+    sqlite 的连接不能在线程之间共享，所以每个线程第一次使用时建立一个连接，
+    之后一直复用。连接打开时设置 WAL 模式，读和写可以同时进行；
+    sqlite3 模块会按 SQL 文本缓存预编译好的语句，所以同一条 SQL 只编译一次。
+    连接工作在自动提交模式下，需要多条语句一起生效时使用 transaction()。
+    '''
+    def __init__(self, path=USERDB, cached_statements=64):
+        self.path = path
+        self.cached_statements = cached_statements
+        self.local = threading.local()
+        self.conns = []                 # 所有线程的连接，关闭时用
+        self.lock = threading.Lock()
+
+    def connection(self):
+        '''
+        返回当前线程的连接，没有就新建一个。
+        '''
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            return conn
+        try:
+            # 连接只在建立它的线程里使用，关闭时才可能在别的线程，所以不需要检查线程
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False,
+                                   cached_statements=self.cached_statements)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        except sqlite3.Error as e:
+            raise DatabaseError('无法打开数据库 %s： %s' % (self.path, e))
+        self.local.conn = conn
+        self.local.depth = 0
+        with self.lock:
+            self.conns.append(conn)
+        return conn
+
+    def execute(self, sql, value=()):
+        '''
+        执行一条语句，返回游标。
+        '''
+        try:
+            return self.connection().execute(sql, value)
+        except sqlite3.Error as e:
+            raise DatabaseError('数据库操作失败： %s (%s)' % (sql.strip(), e))
+
+    def query(self, sql, value=()):
+        '''
+        执行一条查询语句，返回所有结果。
+        '''
+        return self.execute(sql, value).fetchall()
+
+    def query_one(self, sql, value=()):
+        '''
+        执行一条查询语句，返回第一条结果，没有结果时返回 None。
+        '''
+        return self.execute(sql, value).fetchone()
+
+    @contextmanager
+    def transaction(self):
+        '''
+        显式的事务，with 块里的语句要么全部生效，要么全部回滚。
+        可以嵌套，只有最外层会真正提交。
+        '''
+        conn = self.connection()
+        local = self.local
+        if local.depth == 0:
+            self.execute('BEGIN IMMEDIATE')
+        local.depth += 1
+        try:
+            yield self
+        except BaseException:
+            local.depth -= 1
+            if local.depth == 0:
+                conn.rollback()
+            raise
+        local.depth -= 1
+        if local.depth == 0:
+            try:
+                conn.commit()
+            except sqlite3.Error as e:
+                conn.rollback()
+                raise DatabaseError('提交事务失败： %s' % e)
+
+    def close(self):
+        '''
+        关闭所有线程的连接。
+        '''
+        with self.lock:
+            conns, self.conns = self.conns, []
+        for conn in conns:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self.local = threading.local()
+
+
+class DBWorker(object):
+    '''
+    把数据库操作放到线程池里执行，返回 Deferred，reactor 线程不会被磁盘IO卡住。
+    读操作在一个有上限的线程池里并发执行；
+    写操作全部交给只有一个线程的写池，按提交的顺序串行执行，
+    这样 sqlite 不会出现多个写者互相等锁的情况。
+    '''
+    def __init__(self, db, reactor, readers=DB_READERS):
+        self.db = db
+        self.reactor = reactor
+        self.readers = ThreadPool(1, readers, 'db-reader')
+        self.writer = ThreadPool(1, 1, 'db-writer')
+        self.running = False
+
+    def start(self):
+        '''
+        启动线程池，并在 reactor 关闭时自动停止。
+        '''
+        if self.running:
+            return
+        self.running = True
+        self.readers.start()
+        self.writer.start()
+        self.reactor.addSystemEventTrigger('after', 'shutdown', self.stop)
+
+    def stop(self):
+        '''
+        等待已经提交的操作执行完，然后关闭线程池和数据库连接。
+        '''
+        if not self.running:
+            return
+        self.running = False
+        self.readers.stop()
+        self.writer.stop()
+        self.db.close()
+
+    def read(self, f, *args, **kwargs):
+        '''
+        在读线程池中执行 f(db, *args, **kwargs)。
+        '''
+        return self.submit(self.readers, 'read', f, args, kwargs)
+
+    def write(self, f, *args, **kwargs):
+        '''
+        在写线程中执行 f(db, *args, **kwargs)。
+        '''
+        return self.submit(self.writer, 'write', f, args, kwargs)
+
+    def submit(self, pool, kind, f, args, kwargs):
+        '''
+        提交到线程池，并统计从提交到完成的时间（包括排队的时间）。
+        '''
+        start = time.perf_counter()
+        op = f.__name__
+
+        def done(result):
+            DB_LATENCY.observe(time.perf_counter() - start, op, kind)
+            if isinstance(result, Failure):
+                DB_ERRORS.inc(op)
+            return result
+
+        d = deferToThreadPool(self.reactor, pool, f, self.db, *args, **kwargs)
+        d.addBoth(done)
+        return d
+
+
+_dbs = {}
+
+
+def get_db(path=USERDB):
+    '''
+    返回路径对应的共享 Database 对象，整个进程只打开一次。
+    '''
+    if path not in _dbs:
+        _dbs[path] = Database(path)
+    return _dbs[path]
+
+
+def create_tables(db):
+    '''
+    建立用户表，并加入两个初始用户。
+    '''
+    with db.transaction():
+        db.execute('''
+                CREATE TABLE IF NOT EXISTS user
+                (
+                name VARCHAR(20) PRIMARY KEY,
+                passwd VARCHAR(20) NOT NULL,
+                credit INT NOT NULL,
+                title VARCHAR(8)
+                )
+                ''')
+        sql = 'INSERT OR IGNORE INTO user(name, passwd, credit, title) VALUES(?, ?, ?, ?)'
+        db.execute(sql, ('xinxin', '2333', 2000, '男爵'))
+        db.execute(sql, ('memory', '2333', 2000, '男爵'))
+
+
+def get_account(db, name):
+    '''
+    查询一个用户的密码和积分信息，一次查询就够登录用了。
+    @return: (passwd, user)，用户不存在时返回 (None, None)
+    '''
+    row = db.query_one('SELECT passwd, credit, title FROM user WHERE name=?', (name, ))
+    if row is None:
+        return None, None
+    return row[0], {'name': name, 'credit': row[1], 'title': row[2]}
+
+
+def check_login(db, name, passwd):
+    '''
+    验证用户名和密码，在工作线程中执行。
+    @return: 验证通过时返回用户信息，否则抛出 LoginError
+    '''
+    real, user = get_account(db, name)
+    if user is None:
+        raise LoginError('用户名 %s 不存在。' % name)
+    if real != passwd:
+        raise LoginError('密码错误。')
+    return user
+
+
+def get_user(db, name):
+    '''
+    查询一个用户名的信息，用户不存在时返回 None。
+    '''
+    row = db.query_one('SELECT credit, title FROM user WHERE name=?', (name, ))
+    if row is None:
+        return None
+    return {'name': name, 'credit': row[0], 'title': row[1]}
+
+
+def add_user(db, name, passwd):
+    '''
+    注册一个新用户。
+    @return: 注册成功返回 True，用户名已存在返回 False
+    '''
+    sql = 'INSERT INTO user(name, passwd, credit, title) VALUES(?, ?, ?, ?)'
+    try:
+        with db.transaction():
+            db.connection().execute(sql, (name, passwd, 0, '平民'))
+    except sqlite3.IntegrityError:
+        return False
+    except sqlite3.Error as e:
+        raise DatabaseError('注册用户失败： %s' % e)
+    return True
+
+
+def update_users(db, users):
+    '''
+    在一个事务里批量更新多个用户的积分和称号。
+    '''
+    sql = 'UPDATE user SET credit=?, title=? WHERE name=?'
+    with db.transaction():
+        for user in users:
+            db.execute(sql, (user['credit'], user['title'], user['name']))
@@ -11,6 +11,8 @@ import time
 import pygame
 from random import choice
 from .base import BaseGame, Button, Chess
+from .ai import AIPlayer
+from .rules import Board, COLORS, sq
 from .utils import *
 from .configs import *
 
@@ -139,15 +141,14 @@ class BattleChess(BaseGame):
         self.start_time = -1                    # 上一步操作的时间
         self.wait_end = False                   # 是否结束游戏，进入等待退出的界面
         self.timeout = {'red': 0, 'blue': 0}    # 双方超时的次数
-        self.no_eat = 0                         # 多少步没有吃子或者翻开棋子
-        self.step = 0                           # 目前走的总步数
+        self.board = None                       # 规则引擎的棋盘，判断走法和输赢，见 rules.py
+        self.ai = None                          # 本地模式的电脑对手，见 ai.py
         # 棋盘相关的参数
         self.select = (-1, -1)                  # 选中的棋盘格子的位置，(-1, -1)表示无选中
         self.last_step = None                   # 记录上一步的操作，如果是翻开棋子，记录位置，如果是移动，记录前后的位置
         self.next_list = []                     # 选中的棋子下一步可走的地方
         self.cb_color = [[None for i in range(ROW)] for j in range(ROW)]    # 每个格子的颜色
-        self.chess_left = {'red': 18, 'blue': 18, None: 0}   # 红蓝双方剩下的棋子
-        self.chess = [[None for i in range(ROW)] for j in range(ROW)]   # 所有的棋子
+        self.chess = [[None for i in range(ROW)] for j in range(ROW)]   # 所有的棋子，只用来绘制
         # 资源相关的参数，具体见 load_scr() 函数的说明
         self.img_unopen = []
         self.img_red_chess = [[[None, None] for i in range(ROW)] for j in range(ROW)]
@@ -192,21 +193,27 @@ class BattleChess(BaseGame):
     def init_game(self, data):
         '''
         根据模式初始化游戏参数。
-        本地模式时，使用随机的棋盘和随机的先后手。
+        本地模式时，使用随机的棋盘和随机的先后手，设置了 LOCAL_AI 时和电脑对战，自己执哪一方也是随机的。
         网络模式时，使用服务器传来的游戏数据。
         '''
         if self.local:    # 本地对战时本地生成棋子，联网对战时服务器生成棋子
-            self.load_chess(random_chess())
+            chess = random_chess()
             if not self.my_user:
                 self.my_user = random_user()
             self.your_user = random_user()
             self.turn = choice(['red', 'blue'])
-            self.my_color = self.turn
+            if LOCAL_AI:
+                self.my_color = choice(['red', 'blue'])
+                self.ai = AIPlayer(self.enemy_color, *AI_LEVELS[LOCAL_AI])
+            else:
+                self.my_color = self.turn
         elif self.online:
-            self.load_chess(data['chess'])
+            chess = data['chess']
             self.your_user = data['you']
             self.turn = data['turn']
             self.my_color = data['color']
+        self.load_chess(chess)
+        self.board = Board.from_chess(chess, self.turn, MAX_NOEAT)
 
     def load_chess(self, chess):
         '''
@@ -282,24 +289,21 @@ class BattleChess(BaseGame):
         '''
         self.wait_end = True
         self.buttons['giveup'].set_click(False)
-        if self.local:
+        if self.ai:
+            self.ai.cancel()
+        if self.local and not self.ai:
             mapcolor = {'red': 0, 'blue': 1, None: 2}
             self.img_wait_end = self.img_wait[1][mapcolor[color]]
-        elif self.online:
+        else:
             if not color:
                 self.img_wait_end = self.img_wait[0][2]
-                data = {'type': 'endgame', 'user': None}
             elif color != self.my_color:
                 self.img_wait_end = self.img_wait[0][1]
-                self.my_user['credit'] -= WIN_CREDIT
-                self.my_user['title'] = get_title(self.my_user['credit'])
-                data = {'type': 'endgame', 'user': self.my_user}
             elif color == self.my_color:
                 self.img_wait_end = self.img_wait[0][0]
-                self.my_user['credit'] += WIN_CREDIT
-                self.my_user['title'] = get_title(self.my_user['credit'])
-                data = {'type': 'endgame', 'user': self.my_user}
-            self.sendata(data)
+            if self.online:
+                # 积分由服务端计算，结算以后服务端会发来新的积分
+                self.sendata({'type': 'endgame', 'user': None})
         self.start_wait(self.img_wait_end, self.buttons['ok'])
 
     def update(self):
@@ -313,38 +317,45 @@ class BattleChess(BaseGame):
             self.offline = True
             self.start_wait(self.img_wait[0][3], self.buttons['ok'])
             return
-        redleft, blueleft = self.chess_left['red'], self.chess_left['blue']
-        redtime, bluetime = self.timeout['red'], self.timeout['blue']
-        # 检测是否有一方棋子全被吃掉
-        if redleft == 0:
-            self.win_game('blue')
-        elif blueleft == 0:
-            self.win_game('red')
-        # 检测双方是否都只剩下一个棋子，若是，谁的比较大谁就获胜
-        elif redleft == 1 and blueleft == 1:
-            left = {}
-            for i, j in self.traverse():
-                chess = self.Chess[i][j]
-                if chess:
-                    left[chess.color] = chess
-            if left['red'].eat(left['blue']):
-                self.win_game('red')
-            else:
-                self.win_game('blue')
+        # 一方棋子全被吃掉、双方都只剩一个棋子、MAX_NOEAT 步内没有吃子或者翻开棋子，
+        # 这几种情况由规则引擎在每一步以后判定
+        if self.board.result is not None:
+            self.win_game(self.board.winner)
         # 谁超时了 MAX_TIMEOUT 次就算输
-        if redtime >= MAX_TIMEOUT:
+        elif self.timeout['red'] >= MAX_TIMEOUT:
             self.win_game('blue')
-        elif bluetime >= MAX_TIMEOUT:
+        elif self.timeout['blue'] >= MAX_TIMEOUT:
             self.win_game('red')
-        # MAX_NOEAT 步内没有吃子或者翻开棋子就自动和棋
-        if self.no_eat >= MAX_NOEAT:
-            self.win_game(None)
         # 至少 MIN_GIVEUP 步以后才能认输
-        if self.step >= MIN_GIVEUP:
+        elif self.board.step >= MIN_GIVEUP:
             self.buttons['giveup'].set_click(True)
 
+        if self.ai:
+            self.play_ai()
         self.parse_data()
 
+    def play_ai(self):
+        '''
+        轮到电脑时让它在后台开始想，想好了就走这一步，每一帧只检查一下，不等待。
+        '''
+        if self.wait_end or self.turn != self.ai.color:
+            return
+        if not self.ai.thinking:
+            if not self.board.actions():
+                # 电脑没有棋可走，直接认输
+                self.win_game(self.my_color)
+            else:
+                self.ai.think(self.board)
+            return
+        act = self.ai.poll()
+        if act is None:
+            return
+        x, y = divmod(act[0], ROW)
+        if len(act) == 1:
+            self.open_chess(x, y)
+        else:
+            self.move_chess(self.chess[x][y], *divmod(act[1], ROW))
+
     def parse_data(self):
         '''
         解析服务器传来的数据，根据数据进行操作。
@@ -410,7 +421,7 @@ class BattleChess(BaseGame):
         rect = time_img.get_rect()
         pos = time_left.get_rect(centerx=rect.centerx, bottom=rect.bottom-20)
         time_img.blit(time_left, pos)
-        if self.local:
+        if self.local and not self.ai:
             text = '你已超时 %d 次' % self.timeout[self.turn]
             time_pos = TIME_POS[0] if self.turn == 'red' else TIME_POS[1]
         elif self.my_color == self.turn:
@@ -482,15 +493,11 @@ class BattleChess(BaseGame):
 
     def turn_color(self):
         '''
-        转换目前活动的阵营。
+        转换目前活动的阵营，规则引擎在走完一步以后已经换过了。
         '''
-        if self.turn == 'red':
-            self.turn = 'blue'
-        else:
-            self.turn = 'red'
-        if self.local:
+        self.turn = COLORS[self.board.turn]
+        if self.local and not self.ai:
             self.my_color = self.turn
-        self.step += 1
         self.start_time = time.time()
 
     def click(self, x, y):
@@ -503,9 +510,9 @@ class BattleChess(BaseGame):
         x, y = self.find_position(x, y)
         if x == -1 and y == -1:
             return
-        elif self.local:
+        elif self.local and not self.ai:
             self.click_help(x, y)
-        elif self.online:
+        else:
             if self.my_color != self.turn:
                 return
             self.click_help(x, y)
@@ -514,7 +521,7 @@ class BattleChess(BaseGame):
         '''
         翻开棋子。
         '''
-        self.no_eat = 0
+        self.board.open(sq(x, y))
         self.chess[x][y].open = True
         self.last_step = (x, y)
         self.turn_color()
@@ -525,12 +532,8 @@ class BattleChess(BaseGame):
         sc 是要移动的棋子，(x, y) 是要移动去的位置。
         '''
         self.last_step = (x, y)
-        dead = sc.move(x, y)
-        if not dead:
-            self.no_eat += 1
-        else:
-            self.no_eat = 0
-            self.chess_left[dead] -= 1
+        self.board.move(sq(sc.x, sc.y), sq(x, y))
+        sc.move(x, y)
         self.turn_color()
         self.next_list = []
 
@@ -551,7 +554,7 @@ class BattleChess(BaseGame):
                 self.open_chess(x, y)
             elif chess.color == self.turn:
                 self.select = (x, y)
-                self.next_list = self.get_selcet_chess().next()
+                self.next_list = [divmod(t, ROW) for t in self.board.targets(sq(x, y))]
         else:
             sc = self.get_selcet_chess()
             self.select = (-1, -1)
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: leaderboard
+@author: Memory&Xinxin
+@date: 2019/12/21
+@document: 服务端的积分排行榜：前 N 名、自己的名次和前后的人、各个称号的人数
+'''
+
+from bisect import insort, bisect_left
+from twisted.internet import task
+from .utils import get_title
+from .configs import TITLE, LEADERBOARD_TOP
+
+'''
+所有用户的积分放在内存里，用一个树状数组（Fenwick 树）按积分统计人数：
+第 i 格是积分为 low + i 的人数，任意一段积分的人数、第 k 名的积分都是 O(log 积分范围)。
+同一个积分的用户名按字母顺序放在一个 SortedNames 里，名次相同时按用户名排。
+新用户都是 0 分，0 分的人可能有几十万，所以 SortedNames 把名字分成最多 2 * LOAD 个一段，
+另用一个树状数组记每段的人数，加入、删除、按位置取都只需要 O(log n) 次比较和移动一小段列表。
+启动时从数据库读一遍 user 表建立，之后每结算一局只改两个人，
+查询排行榜时不再读数据库。前 LEADERBOARD_TOP 名另外缓存一份，
+只有改动的积分进入了前几名的范围时才重新生成。
+'''
+
+MARGIN = 1024           # 积分范围两边预留的格数，超出时扩大范围重建
+LOAD = 512              # 同一个积分的用户名每段最多 2 * LOAD 个
+
+
+class Fenwick(object):
+    '''
+    树状数组，下标从 0 开始。
+    '''
+    __slots__ = ('size', 'tree')
+
+    def __init__(self, counts):
+        '''
+        O(n) 建立，counts[i] 是第 i 格的初始值。
+        '''
+        self.size = len(counts)
+        self.tree = [0] + list(counts)
+        for i in range(1, self.size + 1):
+            j = i + (i & -i)
+            if j <= self.size:
+                self.tree[j] += self.tree[i]
+
+    def add(self, i, delta):
+        i += 1
+        tree, size = self.tree, self.size
+        while i <= size:
+            tree[i] += delta
+            i += i & -i
+
+    def prefix(self, i):
+        '''
+        前 i 格（0 到 i - 1）的和。
+        '''
+        s = 0
+        tree = self.tree
+        while i > 0:
+            s += tree[i]
+            i -= i & -i
+        return s
+
+    def find(self, k):
+        '''
+        最小的 i，使得前 i + 1 格的和大于 k。
+        '''
+        pos = 0
+        step = 1 << self.size.bit_length()
+        tree = self.tree
+        while step:
+            nxt = pos + step
+            if nxt <= self.size and tree[nxt] <= k:
+                pos = nxt
+                k -= tree[nxt]
+            step >>= 1
+        return pos
+
+
+class SortedNames(object):
+    '''
+    按字母顺序排好的一组用户名，分段存放。支持 len()、按下标和切片取、index()。
+    '''
+    __slots__ = ('chunks', 'maxes', 'sizes', 'length')
+
+    def __init__(self, names=()):
+        '''
+        names 必须已经排好序。
+        '''
+        names = list(names)
+        self.chunks = [names[i:i + LOAD] for i in range(0, len(names), LOAD)]
+        self.maxes = [chunk[-1] for chunk in self.chunks]
+        self.length = len(names)
+        self.reindex()
+
+    def reindex(self):
+        '''
+        段的个数变了时重新建立每段人数的树状数组。
+        '''
+        self.sizes = Fenwick([len(chunk) for chunk in self.chunks])
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            for name in chunk:
+                yield name
+
+    def add(self, name):
+        chunks, maxes = self.chunks, self.maxes
+        self.length += 1
+        if not chunks:
+            chunks.append([name])
+            maxes.append(name)
+            self.reindex()
+            return
+        i = bisect_left(maxes, name)
+        if i == len(maxes):
+            i -= 1
+        chunk = chunks[i]
+        insort(chunk, name)
+        maxes[i] = chunk[-1]
+        if len(chunk) > 2 * LOAD:
+            chunks[i:i + 1] = [chunk[:LOAD], chunk[LOAD:]]
+            maxes[i:i + 1] = [chunk[LOAD - 1], chunk[-1]]
+            self.reindex()
+        else:
+            self.sizes.add(i, 1)
+
+    def remove(self, name):
+        '''
+        删除 name，name 必须在里面。
+        '''
+        chunks, maxes = self.chunks, self.maxes
+        i = bisect_left(maxes, name)
+        chunk = chunks[i]
+        del chunk[bisect_left(chunk, name)]
+        self.length -= 1
+        if chunk:
+            maxes[i] = chunk[-1]
+            self.sizes.add(i, -1)
+        else:
+            del chunks[i]
+            del maxes[i]
+            self.reindex()
+
+    def index(self, name):
+        '''
+        name 的下标，不在里面时是它应该插入的位置。
+        '''
+        i = bisect_left(self.maxes, name)
+        if i == len(self.maxes):
+            return self.length
+        return self.sizes.prefix(i) + bisect_left(self.chunks[i], name)
+
+    def locate(self, k):
+        '''
+        第 k 个名字在第几段的第几个。
+        '''
+        i = self.sizes.find(k)
+        return i, k - self.sizes.prefix(i)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            start, stop, step = k.indices(self.length)
+            out = []
+            if start >= stop:
+                return out
+            i, j = self.locate(start)
+            n = stop - start
+            while n > 0:
+                part = self.chunks[i][j:j + n]
+                out.extend(part)
+                n -= len(part)
+                i, j = i + 1, 0
+            return out
+        if k < 0:
+            k += self.length
+        if not 0 <= k < self.length:
+            raise IndexError(k)
+        i, j = self.locate(k)
+        return self.chunks[i][j]
+
+
+class Leaderboard(object):
+    '''
+    积分排行榜。排名按积分从高到低，积分相同时按用户名排，名次从 1 开始，积分相同的名次也相同。
+    '''
+    def __init__(self, top=LEADERBOARD_TOP):
+        self.credits = {}           # 用户名 -> 积分
+        self.buckets = {}           # 积分 -> 按用户名排好序的 SortedNames
+        self.low = 0                # 树状数组第 0 格对应的积分
+        self.tree = Fenwick([0])
+        self.top_size = top
+        self.top_cache = None       # 缓存的前 top_size 名
+        self.loop = None
+
+    def __len__(self):
+        return len(self.credits)
+
+    def __contains__(self, name):
+        return name in self.credits
+
+    def start(self, reactor, dbworker, log, refresh=0):
+        '''
+        从数据库建立排行榜。refresh 不为 0 时每隔 refresh 秒重新读一次，
+        多进程时其他进程结算的积分要这样才能看到。
+        '''
+        def load():
+            d = dbworker.read(all_credits)
+            d.addCallback(self.rebuild)
+            d.addErrback(lambda failure: log('读取排行榜失败： %s' % failure.getErrorMessage()))
+            return d
+
+        if refresh:
+            self.loop = task.LoopingCall(load)
+            self.loop.clock = reactor
+            self.loop.start(refresh)
+        else:
+            load()
+
+    def stop(self):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+
+    def rebuild(self, rows):
+        '''
+        用 [(用户名, 积分)] 重新建立。
+        '''
+        self.credits = dict(rows)
+        names = {}
+        for name, credit in sorted(rows):
+            names.setdefault(credit, []).append(name)
+        self.buckets = dict((credit, SortedNames(bucket)) for credit, bucket in names.items())
+        self.resize()
+
+    def resize(self, extra=()):
+        '''
+        按现在的积分范围（加上 extra 里的积分）重新建立树状数组，两边各留 MARGIN 格。
+        '''
+        credits = list(self.buckets) + list(extra) + [0]
+        self.low = min(credits) - MARGIN
+        counts = [0] * (max(credits) + MARGIN - self.low + 1)
+        for credit, names in self.buckets.items():
+            counts[credit - self.low] = len(names)
+        self.tree = Fenwick(counts)
+        self.top_cache = None
+
+    def update(self, name, credit):
+        '''
+        用户 name 的积分变成了 credit，新用户也用这个加入。
+        '''
+        old = self.credits.get(name)
+        if old == credit:
+            return
+        if not 0 <= credit - self.low < self.tree.size:
+            self.resize((credit, ))
+        if old is not None:
+            bucket = self.buckets[old]
+            bucket.remove(name)
+            if not bucket:
+                del self.buckets[old]
+            self.tree.add(old - self.low, -1)
+        bucket = self.buckets.get(credit)
+        if bucket is None:
+            self.buckets[credit] = SortedNames([name])
+        else:
+            bucket.add(name)
+        self.credits[name] = credit
+        self.tree.add(credit - self.low, 1)
+        cache = self.top_cache
+        # 原来的积分或者新的积分在缓存的范围里，缓存就过期了
+        if cache is not None and (len(cache) < self.top_size or credit >= cache[-1]['credit']
+                                  or old is not None and old >= cache[-1]['credit']):
+            self.top_cache = None
+
+    def above(self, credit):
+        '''
+        积分比 credit 高的人数。
+        '''
+        i = min(max(credit - self.low + 1, 0), self.tree.size)
+        return len(self.credits) - self.tree.prefix(i)
+
+    def below(self, credit):
+        '''
+        积分比 credit 低的人数。
+        '''
+        return self.tree.prefix(min(max(credit - self.low, 0), self.tree.size))
+
+    def at(self, p):
+        '''
+        第 p 个人（从 0 开始，积分从高到低）的用户名和积分。
+        '''
+        i = self.tree.find(len(self.credits) - 1 - p)
+        credit = i + self.low
+        return self.buckets[credit][p - self.above(credit)], credit
+
+    def entries(self, start, stop):
+        '''
+        第 start 到第 stop - 1 个人。同一个积分的人连着取，不用每个人都查一次树状数组。
+        '''
+        stop = min(stop, len(self.credits))
+        out = []
+        p = max(start, 0)
+        while p < stop:
+            name, credit = self.at(p)
+            above = self.above(credit)
+            bucket = self.buckets[credit]
+            for name in bucket[p - above:stop - above]:
+                out.append({'rank': above + 1, 'name': name, 'credit': credit, 'title': get_title(credit)})
+            p = above + len(bucket)
+        return out
+
+    def top(self, n):
+        if n > self.top_size:
+            return self.entries(0, n)
+        if self.top_cache is None:
+            self.top_cache = self.entries(0, self.top_size)
+        return self.top_cache[:n]
+
+    def rank(self, name):
+        '''
+        用户的名次，不在排行榜上时为 None。
+        '''
+        credit = self.credits.get(name)
+        if credit is None:
+            return None
+        return self.above(credit) + 1
+
+    def around(self, name, k):
+        '''
+        用户自己和前后各 k 个人。
+        '''
+        credit = self.credits.get(name)
+        if credit is None:
+            return []
+        p = self.above(credit) + self.buckets[credit].index(name)
+        return self.entries(p - k, p + k + 1)
+
+    def titles(self):
+        '''
+        每个称号的人数，称号的积分范围见 configs.TITLE，积分小于 0 的也算平民。
+        '''
+        last = max(high for low, high in TITLE.values())
+        counts = {}
+        for title, (low, high) in TITLE.items():
+            lo = self.below(low) if low > 0 else 0
+            hi = len(self.credits) if high == last else self.below(high)
+            counts[title] = hi - lo
+        return counts
+
+
+def all_credits(db):
+    '''
+    所有用户的积分，只在建立排行榜时读一次。
+    '''
+    return db.query('SELECT name, credit FROM user')
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: loadtest
+@author: Memory&Xinxin
+@date: 2019/12/12
+@document: 服务端的压力测试工具，python -m battlechess.loadtest -h 查看用法
+'''
+
+import sys
+import json
+import time
+import random
+import argparse
+from twisted.internet import reactor, task
+from twisted.internet.protocol import Protocol
+from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+from .codec import JSON, PacketDecoder, FrameError, encode_packet, hello
+from .rules import Board, COLORS, MIN_GIVEUP, sq
+
+'''
+用一个进程模拟大量的客户端（机器人），每个机器人的流程是：
+注册 -> 登录 -> 匹配 -> 轮流翻棋或走棋 -> 结束游戏 -> 再次匹配……
+同一局游戏的两个机器人都在这个进程里，所以一方发出数据包的时间，
+另一方收到时可以直接拿来算转发延迟，不需要两边对时。
+还可以同时启动一些观战的客户端，它们随机挑一局正在进行的游戏观战，
+这一局结束后再挑下一局，用来测试观战人数多的时候服务端的开销。
+机器人用 rules.Board 记录棋盘、列出能走的步，和服务端用的是同一套规则，
+所以服务端不会拒绝机器人的操作，出现 illegal 就说明两边的规则不一致。
+结果以json的格式输出。
+'''
+
+
+def percentiles(values):
+    '''
+    返回一组延迟（秒）的分位数，单位是毫秒。
+    '''
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+    n = len(values)
+
+    def p(q):
+        return round(values[min(n - 1, int(q * n))] * 1000, 3)
+
+    return {'count': n, 'p50': p(0.5), 'p90': p(0.9), 'p99': p(0.99),
+            'max': round(values[-1] * 1000, 3), 'mean': round(sum(values) / n * 1000, 3)}
+
+
+class Stats(object):
+    '''
+    收集压力测试的数据。
+    '''
+    def __init__(self):
+        self.start = time.time()
+        self.connects = 0           # 建立成功的连接数
+        self.connect_time = []      # 建立连接花的时间
+        self.signins = 0
+        self.games = 0              # 完整结束的游戏数（每局算两次，两个机器人各一次）
+        self.match_time = []        # 从请求匹配到收到棋盘的时间
+        self.relay_time = []        # 一方发出游戏数据包到另一方收到的时间
+        self.errors = {}            # 错误类型 -> 次数
+        self.bots = {}              # 用户名 -> 机器人，用来找到对手
+        self.finished = 0           # 已经跑完的机器人数
+        self.watch_joins = 0        # 观战的客户端加入游戏的次数
+        self.watch_packets = 0      # 观战的客户端收到的游戏数据包数
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def report(self):
+        elapsed = time.time() - self.start
+        return {'elapsed': round(elapsed, 3),
+                'connections': self.connects,
+                'connections_per_sec': round(self.connects / elapsed, 3) if elapsed else 0,
+                'connect_latency_ms': percentiles(self.connect_time),
+                'signins': self.signins,
+                'games': self.games // 2,
+                'messages_relayed': len(self.relay_time),
+                'messages_per_sec': round(len(self.relay_time) / elapsed, 3) if elapsed else 0,
+                'match_latency_ms': percentiles(self.match_time),
+                'relay_latency_ms': percentiles(self.relay_time),
+                'watch_joins': self.watch_joins,
+                'watch_packets': self.watch_packets,
+                'errors': self.errors}
+
+
+class Bot(Protocol):
+    '''
+    一个按脚本自动下棋的客户端。
+    '''
+    def __init__(self, stats, name, games, plies, codec, started):
+        self.stats = stats
+        self.name = name
+        self.games = games              # 要下的局数
+        self.plies = plies              # 每局最多下多少步，到了就由轮到的一方认输
+        self.use_codec = codec          # 想要使用的编码
+        self.codec = JSON
+        self.started = started          # 开始连接的时间
+        self.decoder = PacketDecoder(lambda msg: stats.error('bad_packet'))
+        self.board = None
+        self.sent_at = None             # 上一个游戏数据包发出的时间
+        self.done = False
+        stats.bots[name] = self
+
+    def connectionMade(self):
+        self.stats.connects += 1
+        self.stats.connect_time.append(time.time() - self.started)
+        if self.use_codec != JSON:
+            self.send(hello())
+        self.send({'type': 'signup', 'user': {'name': self.name, 'passwd': 'bot'}})
+
+    def connectionLost(self, reason):
+        if not self.done:
+            self.stats.error('connection_lost')
+            self.finish()
+
+    def send(self, data):
+        self.transport.write(encode_packet(data, self.codec))
+
+    def dataReceived(self, data):
+        try:
+            packets = self.decoder.feed(data)
+        except FrameError:
+            self.stats.error('bad_frame')
+            self.transport.loseConnection()
+            return
+        for packet in packets:
+            handler = getattr(self, 'on_' + packet['type'], None)
+            if handler:
+                handler(packet)
+
+    def on_hello(self, data):
+        self.codec = data.get('codec', JSON)
+
+    def on_ping(self, data):
+        self.send({'type': 'pong'})
+
+    def on_signup(self, data):
+        # 已经注册过的机器人会注册失败，直接登录就行
+        self.send({'type': 'signin', 'user': {'name': self.name, 'passwd': 'bot'}})
+
+    def on_signin(self, data):
+        if data['result'] != 'success':
+            self.stats.error('signin_failed')
+            self.finish()
+            return
+        self.stats.signins += 1
+        self.match()
+
+    def match(self):
+        self.match_at = time.time()
+        self.send({'type': 'match', 'name': self.name})
+
+    def on_init(self, data):
+        self.stats.match_time.append(time.time() - self.match_at)
+        self.board = Board.from_chess(data['chess'], data['turn'])
+        self.color = COLORS.index(data['color'])
+        self.peer = data['you']['name']
+        self.next_turn()
+
+    def on_open(self, data):
+        if self.received():
+            self.board.open(sq(*data['from']))
+            self.next_turn()
+
+    def on_move(self, data):
+        if self.received():
+            self.board.move(sq(*data['from']), sq(*data['to']))
+            self.next_turn()
+
+    def on_giveup(self, data):
+        if self.board is not None:
+            self.end_game()
+
+    def on_illegal(self, data):
+        self.stats.error('illegal')
+
+    def received(self):
+        '''
+        收到对手的数据包，计算转发延迟。
+        '''
+        if self.board is None:
+            self.stats.error('unexpected_packet')
+            return False
+        peer = self.stats.bots.get(self.peer)
+        if peer is not None and peer.sent_at is not None:
+            self.stats.relay_time.append(time.time() - peer.sent_at)
+            peer.sent_at = None
+        return True
+
+    def next_turn(self):
+        if self.board.result is not None:
+            self.end_game()
+        elif self.board.turn == self.color:
+            self.play()
+
+    def play(self):
+        acts = self.board.actions()
+        if not acts or self.board.step >= self.plies:
+            self.send({'type': 'giveup'})
+            self.end_game()
+            return
+        act = random.choice(acts)
+        self.sent_at = time.time()
+        self.send(self.board.packet(act))
+        self.board.apply(act)
+        self.next_turn()
+
+    def end_game(self):
+        self.board = None
+        self.stats.games += 1
+        self.send({'type': 'endgame', 'user': None})
+        self.games -= 1
+        if self.games > 0:
+            # 稍等一下再匹配，让对手也先结束这一局
+            reactor.callLater(0.01, self.match)
+        else:
+            self.finish()
+            self.transport.loseConnection()
+
+    def finish(self):
+        if not self.done:
+            self.done = True
+            self.stats.finished += 1
+
+
+class Spectator(Protocol):
+    '''
+    一个不停地找游戏观战的客户端。
+    '''
+    def __init__(self, stats, codec):
+        self.stats = stats
+        self.use_codec = codec
+        self.codec = JSON
+        self.decoder = PacketDecoder(lambda msg: stats.error('bad_packet'))
+
+    def connectionMade(self):
+        if self.use_codec != JSON:
+            self.send(hello())
+        self.send({'type': 'watch'})
+
+    def send(self, data):
+        self.transport.write(encode_packet(data, self.codec))
+
+    def dataReceived(self, data):
+        try:
+            packets = self.decoder.feed(data)
+        except FrameError:
+            self.stats.error('bad_frame')
+            self.transport.loseConnection()
+            return
+        for packet in packets:
+            typ = packet['type']
+            if typ == 'hello':
+                self.codec = packet.get('codec', JSON)
+            elif typ == 'ping':
+                self.send({'type': 'pong'})
+            elif typ == 'watch':
+                self.on_watch(packet)
+            elif typ in ('open', 'move', 'giveup'):
+                self.stats.watch_packets += 1
+
+    def on_watch(self, data):
+        result = data['result']
+        if result == 'list' and data['games']:
+            self.send({'type': 'watch', 'name': random.choice(data['games'])['red']})
+        elif result == 'success':
+            self.stats.watch_joins += 1
+        else:
+            # 没有游戏可看，或者这一局结束了，等一下再找
+            reactor.callLater(0.1, self.send, {'type': 'watch'})
+
+
+def raise_nofile():
+    '''
+    尽量调高能同时打开的文件数，否则开不了几千个连接。
+    '''
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def run(args, clock=reactor):
+    '''
+    按每秒 rate 个的速度启动 bots 个机器人，全部跑完或者超时后输出结果。
+    '''
+    raise_nofile()
+    stats = Stats()
+    endpoint = TCP4ClientEndpoint(clock, args.host, args.port, timeout=30)
+    names = ['%s%05d' % (args.prefix, i) for i in range(args.bots)]
+    codec = JSON if args.json else 'bin1'
+
+    def launch(name):
+        bot = Bot(stats, name, args.games, max(args.plies, MIN_GIVEUP), codec, time.time())
+        d = connectProtocol(endpoint, bot)
+
+        def failed(failure):
+            stats.error('connect_failed')
+            bot.finish()
+
+        d.addErrback(failed)
+
+    def spectate():
+        d = connectProtocol(endpoint, Spectator(stats, codec))
+        d.addErrback(lambda failure: stats.error('connect_failed'))
+
+    def spawn():
+        for i in range(max(1, int(args.rate * 0.1))):
+            if not names:
+                break
+            launch(names.pop(0))
+
+    def check():
+        if stats.finished >= args.bots or time.time() - stats.start > args.duration:
+            stop()
+
+    def stop():
+        for loop in (spawner, checker):
+            if loop.running:
+                loop.stop()
+        if clock.running:
+            clock.stop()
+
+    for i in range(args.spectators):
+        spectate()
+    spawner = task.LoopingCall(spawn)
+    spawner.start(0.1)
+    checker = task.LoopingCall(check)
+    checker.start(0.5, now=False)
+    clock.run()
+    return stats.report()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m battlechess.loadtest', description='皇家战棋服务端压力测试')
+    parser.add_argument('--host', default='127.0.0.1', help='服务端地址')
+    parser.add_argument('-p', '--port', type=int, default=1122, help='服务端端口')
+    parser.add_argument('-n', '--bots', type=int, default=100, help='机器人的数量')
+    parser.add_argument('-r', '--rate', type=float, default=200, help='每秒启动多少个机器人')
+    parser.add_argument('-g', '--games', type=int, default=3, help='每个机器人下几局')
+    parser.add_argument('--plies', type=int, default=40, help='每局最多下多少步，到了就认输，不少于 %d 步' % MIN_GIVEUP)
+    parser.add_argument('-d', '--duration', type=float, default=120, help='最长运行时间（秒）')
+    parser.add_argument('-s', '--spectators', type=int, default=0, help='观战的客户端数量')
+    parser.add_argument('--prefix', default='bot', help='机器人用户名的前缀')
+    parser.add_argument('--json', action='store_true', help='使用旧的json编码，不协商二进制编码')
+    parser.add_argument('-o', '--output', default=None, help='结果写入的文件，默认输出到屏幕')
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
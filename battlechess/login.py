@@ -15,8 +15,8 @@ import tkinter as tk
 from tkinter import Tk, Entry, Button
 from tkinter.ttk import Label
 from tkinter.messagebox import showinfo, askyesno
-from .configs import IMG_PATH
-from .utils import install_game, dict2bin
+from .configs import IMG_PATH, NAME_LIMIT
+from .utils import install_game
 from .game import BeginGame
 
 
@@ -70,8 +70,11 @@ class LoginUI(Tk):
         if not name or not passwd:
             showinfo('错误', '输入不完整。')
             return
+        if len(name.encode('utf-8')) > NAME_LIMIT:
+            showinfo('错误', '用户名太长了。')
+            return
         data = {'type': 'signup', 'user': {'name': name, 'passwd': passwd}}
-        self.factory.protocol.transport.write(dict2bin(data))
+        self.factory.protocol.send(data)
 
     def signin(self, event=None):
         if not self.factory.protocol or self.factory.failed:
@@ -85,7 +88,7 @@ class LoginUI(Tk):
             showinfo('错误', '输入不完整。')
             return
         data = {'type': 'signin', 'user': {'name': name, 'passwd': passwd}}
-        self.factory.protocol.transport.write(dict2bin(data))
+        self.factory.protocol.send(data)
 
     def center_window(self, width, height):   # 窗口居中
         screenwidth = self.winfo_screenwidth()
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: matchmaking
+@author: Memory&Xinxin
+@date: 2019/12/08
+@document: 按积分匹配对手的等待队列
+'''
+
+import time
+import heapq
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from itertools import count
+from .configs import MATCH_BUCKET, MATCH_WINDOW, MATCH_WIDEN
+
+
+class MatchQueue(object):
+    '''
+    按积分分桶的匹配队列。
+    积分 credit 的用户放在第 credit // bucket 个桶里，每个桶是一个按等待先后排列的
+    OrderedDict，加入和取消都是 O(1)；有人的桶的编号存在一个有序列表里，
+    用二分查找定位，所以找对手只需要看自己附近的几个桶。
+    能接受的积分差一开始是 window，每多等一秒放宽 widen，等得越久越容易匹配到。
+
+    每个桶还有一个按积分排好序的 (积分, 用户名) 列表。整个桶都在可接受范围内时
+    直接取等得最久的人；只有一部分在范围内时（最多是两头的两个桶）用二分查找取
+    积分最接近的人，所以找对手不会把整个桶扫一遍。
+
+    能接受的积分差只和开始等待的时间有关，所以不用每秒把所有人重新匹配一遍：
+    按积分排好序后，一个人最先能接受的一定是积分和自己相邻的两个人之一，
+    由相邻的人和自己的积分差可以直接算出什么时候能匹配上，放进一个按时间排列的堆。
+    有人加入或离开时，只有积分和这个人相邻的两个人的时间会变。
+    sweep 只处理时间到了的人，没人能匹配时几乎不做事。
+    '''
+    def __init__(self, bucket=MATCH_BUCKET, window=MATCH_WINDOW, widen=MATCH_WIDEN, clock=time.time):
+        self.bucket = bucket            # 每个桶的积分宽度
+        self.window = window            # 初始能接受的积分差
+        self.widen = widen              # 每等一秒放宽的积分差
+        self.clock = clock
+        self.buckets = {}               # 桶编号 -> OrderedDict(用户名 -> (积分, 开始等待的时间))
+        self.keys = []                  # 有人在等的桶编号，从小到大
+        self.ladders = {}               # 桶编号 -> [(积分, 用户名)]，按积分从小到大
+        self.due = {}                   # 用户名 -> 预计能匹配上的时间
+        self.heap = []                  # (预计能匹配上的时间, 序号, 用户名)，里面可能有过期的项
+        self.seq = count()
+        self.players = OrderedDict()    # 用户名 -> 桶编号，按开始等待的先后排列
+        self.metrics = {}               # 桶编号 -> [匹配成功的人数, 总等待时间, 最长等待时间]
+
+    def __len__(self):
+        return len(self.players)
+
+    def __contains__(self, name):
+        return name in self.players
+
+    def __iter__(self):
+        return iter(self.players)
+
+    def add(self, name, credit, now=None):
+        '''
+        加入等待队列，已经在队列里时返回 False。
+        '''
+        if name in self.players:
+            return False
+        now = self.clock() if now is None else now
+        key = int(credit) // self.bucket
+        if key not in self.buckets:
+            self.buckets[key] = OrderedDict()
+            self.ladders[key] = []
+            insort(self.keys, key)
+        self.buckets[key][name] = (credit, now)
+        insort(self.ladders[key], (credit, name))
+        self.players[name] = key
+        for n in (name,) + self._neighbours(name):
+            self._schedule(n)
+        return True
+
+    def cancel(self, name):
+        '''
+        离开等待队列，不在队列里时返回 False。
+        '''
+        if name not in self.players:
+            return False
+        self._remove(name)
+        return True
+
+    def _remove(self, name):
+        near = self._neighbours(name)
+        key = self.players.pop(name)
+        entries = self.buckets[key]
+        entry = entries.pop(name)
+        ladder = self.ladders[key]
+        del ladder[bisect_left(ladder, (entry[0], name))]
+        if not entries:
+            del self.buckets[key]
+            del self.ladders[key]
+            del self.keys[bisect_left(self.keys, key)]
+        self.due.pop(name, None)
+        for n in near:
+            self._schedule(n)
+        return key, entry
+
+    def _neighbours(self, name):
+        '''
+        按积分排序后和 name 相邻的（最多两个）用户。
+        '''
+        key = self.players[name]
+        credit, _ = self.buckets[key][name]
+        ladder = self.ladders[key]
+        i = bisect_left(ladder, (credit, name))
+        j = bisect_left(self.keys, key)
+        near = ()
+        if i > 0:
+            near += (ladder[i - 1][1],)
+        elif j > 0:
+            near += (self.ladders[self.keys[j - 1]][-1][1],)
+        if i + 1 < len(ladder):
+            near += (ladder[i + 1][1],)
+        elif j + 1 < len(self.keys):
+            near += (self.ladders[self.keys[j + 1]][0][1],)
+        return near
+
+    def _schedule(self, name, floor=None):
+        '''
+        按和相邻的人的积分差算出 name 什么时候能匹配上，放进堆里。
+        没有人能匹配上时不放进堆，等有人加入时再算。
+        '''
+        credit, since = self.buckets[self.players[name]][name]
+        gaps = [abs(self.buckets[self.players[n]][n][0] - credit) for n in self._neighbours(name)]
+        gap = min(gaps) if gaps else None
+        if gap is None:
+            due = None
+        elif gap <= self.window:
+            due = since
+        elif self.widen > 0:
+            due = since + float(gap - self.window) / self.widen
+        else:
+            due = None
+        if due is None:
+            self.due.pop(name, None)
+            return
+        if floor is not None:
+            due = max(due, floor)
+        if self.due.get(name) == due:
+            return
+        self.due[name] = due
+        heapq.heappush(self.heap, (due, next(self.seq), name))
+        if len(self.heap) > 2 * len(self.due) + 64:
+            # 过期的项太多时重建一次
+            self.heap = [(d, next(self.seq), n) for n, d in self.due.items()]
+            heapq.heapify(self.heap)
+
+    def accept(self, since, now):
+        '''
+        从 since 开始等待的用户，在 now 时能接受的积分差。
+        '''
+        return self.window + self.widen * max(0, now - since)
+
+    def find(self, name, now=None):
+        '''
+        为 name 找一个积分差在可接受范围内的对手，找不到返回 None。
+        从自己所在的桶开始往两边找，先找到的是积分最接近的桶里等得最久的人；
+        桶只有一部分在范围内时，取这个桶里积分最接近的人。
+        '''
+        now = self.clock() if now is None else now
+        key = self.players[name]
+        credit, since = self.buckets[key][name]
+        limit = self.accept(since, now)
+        lo = int(credit - limit) // self.bucket
+        hi = int(credit + limit) // self.bucket
+        right = bisect_left(self.keys, key)
+        left = right - 1
+        while True:
+            # 左右两边哪个桶离自己近就先看哪个
+            lkey = self.keys[left] if left >= 0 and self.keys[left] >= lo else None
+            rkey = self.keys[right] if right < len(self.keys) and self.keys[right] <= hi else None
+            if lkey is None and rkey is None:
+                return None
+            if rkey is None or (lkey is not None and key - lkey < rkey - key):
+                k, left = lkey, left - 1
+            else:
+                k, right = rkey, right + 1
+            ladder = self.ladders[k]
+            if ladder[0][0] >= credit - limit and ladder[-1][0] <= credit + limit:
+                for other in self.buckets[k]:
+                    if other != name:
+                        return other
+                continue
+            i = bisect_left(ladder, (credit,))
+            near = [e for e in ladder[max(0, i - 1):i + 2] if e[1] != name][:2]
+            if near:
+                c, other = min(near, key=lambda e: abs(e[0] - credit))
+                if abs(c - credit) <= limit:
+                    return other
+
+    def pair(self, name, now=None):
+        '''
+        为 name 匹配对手，成功时把两人移出队列并返回对手的名字。
+        '''
+        now = self.clock() if now is None else now
+        other = self.find(name, now)
+        if other is None:
+            return None
+        for n in (name, other):
+            key, (_, since) = self._remove(n)
+            self.record(key, now - since)
+        return other
+
+    def sweep(self, now=None):
+        '''
+        等待的时间变长以后，能接受的积分差也变大了，
+        定时调用这个函数，为到时间能匹配上的人重新匹配，先到时间的先匹配。
+        @return: 匹配成功的 (用户, 对手) 列表
+        '''
+        now = self.clock() if now is None else now
+        pairs = []
+        while self.heap and self.heap[0][0] <= now:
+            due, _, name = heapq.heappop(self.heap)
+            if self.due.get(name) != due:
+                continue
+            del self.due[name]
+            other = self.pair(name, now)
+            if other is not None:
+                pairs.append((name, other))
+            elif name in self.players:
+                # 浮点误差导致刚好差一点时，下次再试
+                self._schedule(name, now + 1e-3)
+        return pairs
+
+    def record(self, key, wait):
+        m = self.metrics.setdefault(key, [0, 0.0, 0.0])
+        m[0] += 1
+        m[1] += wait
+        m[2] = max(m[2], wait)
+
+    def stats(self):
+        '''
+        每个积分段的等待人数和等待时间的统计。
+        @return: {积分段的下限: {'waiting', 'matched', 'avg_wait', 'max_wait'}}
+        '''
+        result = {}
+        for key in sorted(set(self.keys) | set(self.metrics)):
+            matched, total, longest = self.metrics.get(key, (0, 0.0, 0.0))
+            result[key * self.bucket] = {'waiting': len(self.buckets.get(key, ())),
+                                         'matched': matched,
+                                         'avg_wait': total / matched if matched else 0.0,
+                                         'max_wait': longest}
+        return result
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: metrics
+@author: Memory&Xinxin
+@date: 2019/12/14
+@document: 服务端的运行指标，以 Prometheus 的文本格式通过 HTTP 提供
+'''
+
+import time
+from bisect import bisect_left
+
+'''
+指标都放在模块级的 registry 里，服务端各处直接调用来计数，
+然后用 listen() 在本机开一个 HTTP 端口，访问 /metrics 就能拿到所有指标，
+可以用 Prometheus 定时抓取，也可以直接 curl 看。
+标签的值都转成字符串存，输出时才能排序；标签的值不能直接来自客户端，否则指标会无限增长。
+'''
+
+# 延迟的桶，单位是秒
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# 字节数的桶
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for n, v in zip(names, values):
+        v = str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('%s="%s"' % (n, v))
+    return '{%s}' % ','.join(pairs)
+
+
+class Counter(object):
+    '''只增不减的计数器。'''
+    kind = 'counter'
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *labels, **kwargs):
+        value = kwargs.get('value', 1)
+        labels = tuple(map(str, labels))
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self):
+        for labels, value in sorted(self.values.items()):
+            yield '%s%s %s' % (self.name, format_labels(self.labels, labels), value)
+
+
+class Gauge(object):
+    '''当前值，读取时调用函数得到。'''
+    kind = 'gauge'
+
+    def __init__(self, name, doc, fn):
+        self.name = name
+        self.doc = doc
+        self.fn = fn
+
+    def render(self):
+        yield '%s %s' % (self.name, self.fn())
+
+
+class Histogram(object):
+    '''分布，按桶统计次数，还有总和与总次数。'''
+    kind = 'histogram'
+
+    def __init__(self, name, doc, buckets=LATENCY_BUCKETS, labels=()):
+        self.name = name
+        self.doc = doc
+        self.buckets = tuple(buckets)
+        self.labels = labels
+        self.values = {}            # 标签 -> [每个桶的次数..., 超出最大桶的次数, 总和]
+
+    def observe(self, value, *labels):
+        labels = tuple(map(str, labels))
+        v = self.values.get(labels)
+        if v is None:
+            v = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        v[bisect_left(self.buckets, value)] += 1
+        v[-1] += value
+
+    def time(self, *labels):
+        '''
+        with histogram.time(): 统计一段代码的运行时间。
+        '''
+        return Timer(self, labels)
+
+    def render(self):
+        for labels, v in sorted(self.values.items()):
+            total = 0
+            for le, count in zip(self.buckets + ('+Inf', ), v[:-1]):
+                total += count
+                names = self.labels + ('le', )
+                yield '%s_bucket%s %d' % (self.name, format_labels(names, labels + (le, )), total)
+            yield '%s_sum%s %s' % (self.name, format_labels(self.labels, labels), v[-1])
+            yield '%s_count%s %d' % (self.name, format_labels(self.labels, labels), total)
+
+
+class Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class Registry(object):
+    '''
+    所有指标的集合。
+    '''
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, doc, labels=()):
+        return self.metrics.get(name) or self.add(Counter(name, doc, labels))
+
+    def histogram(self, name, doc, buckets=LATENCY_BUCKETS, labels=()):
+        return self.metrics.get(name) or self.add(Histogram(name, doc, buckets, labels))
+
+    def gauge(self, name, doc, fn):
+        '''同名的 gauge 会被新的函数替换。'''
+        return self.add(Gauge(name, doc, fn))
+
+    def render(self):
+        '''
+        按 Prometheus 的文本格式输出所有指标。
+        '''
+        lines = []
+        for name in sorted(self.metrics):
+            m = self.metrics[name]
+            lines.append('# HELP %s %s' % (name, m.doc))
+            lines.append('# TYPE %s %s' % (name, m.kind))
+            lines.extend(m.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# 服务端用到的指标
+MESSAGES = registry.counter('bc_messages_total', '收到的数据包数，按类型和处理方式', ('type', 'path'))
+HANDLER_LATENCY = registry.histogram('bc_handler_seconds', '处理一个数据包所用的时间', labels=('type', ))
+DB_LATENCY = registry.histogram('bc_db_seconds', '数据库操作从提交到完成的时间', labels=('op', 'pool'))
+DB_ERRORS = registry.counter('bc_db_errors_total', '数据库操作失败的次数', ('op', ))
+BYTES_IN = registry.counter('bc_bytes_received_total', '从客户端收到的字节数')
+BYTES_OUT = registry.counter('bc_bytes_sent_total', '发给客户端的字节数')
+CONN_BYTES_IN = registry.histogram('bc_connection_bytes_received', '每个连接收到的字节数', BYTES_BUCKETS)
+CONN_BYTES_OUT = registry.histogram('bc_connection_bytes_sent', '每个连接发出的字节数', BYTES_BUCKETS)
+CONNECTIONS = registry.counter('bc_connections_total', '建立过的连接数')
+WRITES = registry.counter('bc_writes_total', '合并后实际写给 transport 的次数')
+SLOW_CLIENTS = registry.counter('bc_slow_clients_total', '因为接收太慢被断开的连接数')
+EVICTED = registry.counter('bc_evicted_total', '因为没有响应被断开的连接数', ('reason', ))
+ILLEGAL = registry.counter('bc_illegal_packets_total', '服务端校验不通过而没有转发的游戏数据包数', ('type', ))
+GAMES = registry.counter('bc_games_total', '结束的游戏数，按结束的原因', ('reason', ))
+
+
+def listen(reactor, port, interface='127.0.0.1'):
+    '''
+    在本机开一个 HTTP 端口提供指标，访问 http://127.0.0.1:port/metrics
+    '''
+    from twisted.web.resource import Resource
+    from twisted.web.server import Site
+
+    class MetricsResource(Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            request.setHeader(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+            return registry.render().encode('utf-8')
+
+    return reactor.listenTCP(port, Site(MetricsResource()), interface=interface)
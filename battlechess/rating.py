@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: rating
+@author: Memory&Xinxin
+@date: 2019/12/22
+@document: Elo 积分：每局结算时由服务端计算积分变化；也可以按保存的对局记录用 NumPy 批量重算所有人的积分
+'''
+
+import sys
+import json
+import time
+import argparse
+from .configs import WIN_CREDIT, USERDB, RECORD_PATH
+
+'''
+红方积分 Ra、蓝方积分 Rb 时，红方的期望得分是 E = 1 / (1 + 10 ^ ((Rb - Ra) / SCALE))，
+红方实际得分 S 是赢 1、和 0.5、输 0，红方的积分变化是 round(K * (S - E))，蓝方正好相反。
+K = 2 * WIN_CREDIT，所以积分相同的两个人对局，赢的加 WIN_CREDIT、输的减 WIN_CREDIT，和以前一样；
+赢了积分比自己高的人加得多，输给积分比自己低的人扣得多，和棋时积分低的一方也能加分。
+掉线输掉的一方仍然不扣分。称号还是按积分用 get_title 计算。
+
+批量重算时，一个人的积分只受他自己之前的对局影响，所以把所有对局分成若干轮：
+每局放在 max(红方上一局的轮次, 蓝方上一局的轮次) + 1 这一轮，
+同一轮里每个人最多出现一次，互不影响，可以用 NumPy 整轮一起算，
+结果和一局一局按顺序算完全一样，轮数只和最活跃的那条对局链一样长。
+numpy 只有批量重算时才需要，服务端结算不依赖它。
+
+数据库里的积分不全来自保存下来的对局（初始用户送的积分、保存记录以前下的对局），
+所以写回数据库时不直接用重算的积分，而是在原来的积分上加上新参数和服务端现在的参数重算结果的差，
+只改对局记录里出现过的人，其他人的积分不变。
+'''
+
+K = 2 * WIN_CREDIT          # 每局最多变化的积分
+SCALE = 400                 # 积分差 SCALE 分时，高分一方的期望得分是 10 / 11
+INITIAL = 0                 # 新用户的积分，和注册时一样
+
+
+def expected(a, b, scale=SCALE):
+    '''
+    积分为 a 的一方对积分为 b 的一方的期望得分。
+    '''
+    return 1.0 / (1.0 + 10.0 ** ((b - a) / scale))
+
+
+def deltas(red, blue, score, protect=False, k=K, scale=SCALE):
+    '''
+    红方积分 red、蓝方积分 blue，红方得分 score，返回双方的积分变化 (红方, 蓝方)。
+    protect 为 True 时输的一方不扣分。
+    '''
+    d = int(round(k * (score - expected(red, blue, scale))))
+    if protect:
+        return max(d, 0), max(-d, 0)
+    return d, -d
+
+
+def assign_rounds(red, blue, players):
+    '''
+    每局游戏放在哪一轮，见上面的说明。
+    '''
+    last = [0] * players
+    rounds = []
+    for a, b in zip(red, blue):
+        r = max(last[a], last[b])
+        rounds.append(r)
+        last[a] = last[b] = r + 1
+    return rounds
+
+
+def recompute(red, blue, score, protect=None, players=None, initial=INITIAL, k=K, scale=SCALE):
+    '''
+    按顺序重算一系列对局以后每个人的积分。
+    red、blue 是每局红方、蓝方的编号（0 到 players - 1），score 是红方得分，protect 是输的一方是否不扣分。
+    @return: 每个人最后的积分，numpy 数组
+    '''
+    import numpy as np
+
+    red = np.asarray(red, dtype=np.int64)
+    blue = np.asarray(blue, dtype=np.int64)
+    score = np.asarray(score, dtype=np.float64)
+    if players is None:
+        players = int(max(red.max(initial=-1), blue.max(initial=-1))) + 1
+    ratings = np.full(players, initial, dtype=np.float64)
+    if not len(red):
+        return ratings
+    rounds = np.asarray(assign_rounds(red.tolist(), blue.tolist(), players))
+    order = np.argsort(rounds, kind='stable')
+    bounds = np.flatnonzero(np.diff(rounds[order])) + 1
+    if protect is not None:
+        protect = np.asarray(protect, dtype=bool)
+    for idx in np.split(order, bounds):
+        a, b = red[idx], blue[idx]
+        e = 1.0 / (1.0 + 10.0 ** ((ratings[b] - ratings[a]) / scale))
+        d = np.rint(k * (score[idx] - e))
+        da, db = d, -d
+        if protect is not None:
+            p = protect[idx]
+            da = np.where(p, np.maximum(da, 0), da)
+            db = np.where(p, np.maximum(db, 0), db)
+        ratings[a] += da
+        ratings[b] += db
+    return ratings
+
+
+def rebase(stored, names, ratings, baseline):
+    '''
+    写回数据库的积分：stored 是数据库里的积分（用户名 -> 积分），ratings、baseline 是 names 这些人
+    用新参数、用服务端现在的参数重算的积分。数据库里没有的人不写。
+    @return: [{'name', 'credit', 'title'}]
+    '''
+    from .utils import get_title
+
+    users = []
+    for name, new, old in zip(names, ratings, baseline):
+        if name not in stored:
+            continue
+        credit = int(stored[name] + new - old)
+        users.append({'name': name, 'credit': credit, 'title': get_title(credit)})
+    return users
+
+
+def load_history(path=RECORD_PATH):
+    '''
+    从对局记录里读出所有结束了的对局，按结束的时间排序。
+    @return: (用户名列表, 红方编号, 蓝方编号, 红方得分, 是否掉线)
+    '''
+    from .records import scan_results
+
+    ids = {}
+    games = []
+    for gid, t, red, blue, winner, reason in scan_results(path):
+        if reason is None:
+            continue
+        a = ids.setdefault(red, len(ids))
+        b = ids.setdefault(blue, len(ids))
+        score = 1.0 if winner == 'red' else 0.0 if winner == 'blue' else 0.5
+        games.append((t, gid, a, b, score, reason == 'disconnect'))
+    games.sort()
+    names = sorted(ids, key=ids.get)
+    return (names, [g[2] for g in games], [g[3] for g in games], [g[4] for g in games], [g[5] for g in games])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m battlechess.rating',
+                                     description='按保存的对局记录，用新的参数重算所有人的积分')
+    parser.add_argument('-k', type=float, default=K, help='每局最多变化的积分')
+    parser.add_argument('--scale', type=float, default=SCALE, help='Elo 的积分尺度')
+    parser.add_argument('--initial', type=float, default=INITIAL, help='每个人开始时的积分')
+    parser.add_argument('--top', type=int, default=10, help='输出积分最高的几个人')
+    parser.add_argument('--path', default=RECORD_PATH, help='对局记录的目录')
+    parser.add_argument('--apply', action='store_true',
+                        help='按新旧参数重算结果的差修改数据库里的积分，需要先停止服务端')
+    args = parser.parse_args(argv)
+
+    start = time.time()
+    names, red, blue, score, protect = load_history(args.path)
+    loaded = time.time()
+    ratings = recompute(red, blue, score, protect, len(names), args.initial, args.k, args.scale)
+    done = time.time()
+    ranked = sorted(zip(names, ratings.tolist()), key=lambda x: -x[1])
+    sys.stdout.write(json.dumps({'games': len(red), 'players': len(names), 'load_seconds': round(loaded - start, 3),
+                                 'rating_seconds': round(done - loaded, 3),
+                                 'top': [[n, int(r)] for n, r in ranked[:args.top]]}, ensure_ascii=False) + '\n')
+    if args.apply:
+        from .database import get_db, update_users
+        db = get_db(USERDB)
+        stored = dict(db.query('SELECT name, credit FROM user'))
+        baseline = recompute(red, blue, score, protect, len(names))
+        users = rebase(stored, names, ratings.tolist(), baseline.tolist())
+        update_users(db, users)
+        sys.stdout.write('已经更新 %d 个用户的积分。\n' % len(users))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,480 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: records
+@author: Memory&Xinxin
+@date: 2019/12/20
+@document: 对局记录：每局游戏存成一条紧凑的二进制记录，可以按编号、玩家、日期查找和回放
+'''
+
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import argparse
+from datetime import datetime
+from twisted.internet import defer, task
+from .rules import Board, SIZE, ROW, COLORS, sq, pos
+from .configs import USERDB, RECORD_PATH, RECORD_SEGMENT_SIZE, RECORD_FLUSH_INTERVAL, RECORD_BATCH
+
+'''
+记录只追加写到段文件里，一个段文件超过 RECORD_SEGMENT_SIZE 字节以后，下一批记录写到新的段文件，
+文件名是 前缀-编号.seg，多进程时每个工作进程用自己的前缀。每条记录是：
+    长度(u32) crc32(u32) 内容
+内容的格式：
+    游戏编号(u64) 结束时间(u32) 先走的一方(u8) 结果(u8) 结束原因(u8)
+    红方用户名(u8 长度 + utf-8) 蓝方用户名(u8 长度 + utf-8)
+    发牌(36 字节，颜色 * 8 + 等级，没有棋子是 0xFF)
+    步数(u16) 每一步(u16)：走棋是 起点 * 36 + 终点，翻棋是 1296 + 位置，认输是 0xFFFF
+一局 100 步的游戏大约 260 字节。
+
+索引放在数据库的 game 表里：编号、红方、蓝方、日期，以及记录所在的段文件、偏移和长度，
+按编号读一局只需要查一次主键再读一次文件；按玩家、按日期查的是表上的索引。
+结束的游戏先放在内存里，每 RECORD_FLUSH_INTERVAL 秒或者攒够 RECORD_BATCH 局，
+在数据库的写线程里一次追加到段文件、一个事务写入索引，不占用 reactor 线程。
+scan() 按顺序读段文件，一次只解码一条，几百万局也不需要全部读进内存。
+'''
+
+FRAME = struct.Struct('<II')            # 记录的长度、内容的 crc32
+HEAD = struct.Struct('<QIBBB')          # 游戏编号、结束时间、先走的一方、结果、结束原因
+ID = struct.Struct('<Q')
+COUNT = struct.Struct('<H')
+OPEN_BASE = SIZE * SIZE                 # 翻棋的编码从这里开始
+GIVEUP = 0xFFFF
+NO_PIECE = 0xFF
+NO_RESULT = 0xFF
+REASONS = ('normal', 'giveup', 'timeout', 'disconnect', 'abandon')
+RESULTS = ('red', 'blue', None)
+
+
+class RecordError(Exception):
+    '''记录损坏或者不完整时抛出。'''
+    pass
+
+
+class GameRecord(object):
+    '''
+    一局游戏的记录。moves 的格式和 GameRoom.moves 一样：翻棋是 [x, y]，走棋是 [x, y, nx, ny]，认输是 []，
+    从文件读出来的记录里，每一步和每个棋子都是共用的元组。
+    '''
+    __slots__ = ('id', 'time', 'red', 'blue', 'turn', 'winner', 'reason', 'chess', 'moves')
+
+    def __init__(self, red, blue, chess, moves, turn='red', winner=None, reason=None, time=0, id=0):
+        self.id = id
+        self.time = time            # 结束的时间
+        self.red = red              # 红方的用户名
+        self.blue = blue            # 蓝方的用户名
+        self.turn = turn            # 先走的一方
+        self.winner = winner        # 获胜的一方，和棋时为 None
+        self.reason = reason        # 结束的原因，见 GameSession.reason
+        self.chess = chess          # 发牌，同 random_chess()
+        self.moves = moves
+
+    @classmethod
+    def from_room(cls, room, now):
+        session = room.session
+        return cls(room.red['name'], room.blue['name'], room.chess, list(room.moves), room.turn,
+                   session.winner, session.reason, int(now))
+
+    @property
+    def day(self):
+        return int(datetime.fromtimestamp(self.time).strftime('%Y%m%d'))
+
+    def replay(self):
+        '''
+        在 rules.Board 上重新走一遍，返回最后的棋盘。
+        '''
+        board = Board.from_chess(self.chess, self.turn)
+        for m in self.moves:
+            if len(m) == 2:
+                board.open(sq(m[0], m[1]))
+            elif len(m) == 4:
+                board.move(sq(m[0], m[1]), sq(m[2], m[3]))
+            else:
+                board.resign(board.turn)
+        return board
+
+    def to_dict(self):
+        return {'id': self.id, 'time': self.time, 'red': self.red, 'blue': self.blue, 'turn': self.turn,
+                'winner': self.winner, 'reason': self.reason, 'chess': self.chess, 'moves': self.moves}
+
+
+def encode_move(m):
+    if len(m) == 2:
+        return OPEN_BASE + sq(m[0], m[1])
+    if len(m) == 4:
+        return sq(m[0], m[1]) * SIZE + sq(m[2], m[3])
+    return GIVEUP
+
+
+def decode_move(v):
+    if v == GIVEUP:
+        return []
+    if v >= OPEN_BASE:
+        return list(pos(v - OPEN_BASE))
+    s, t = divmod(v, SIZE)
+    return list(pos(s) + pos(t))
+
+
+# 解码用的表，扫描几百万局时不用每一步都做除法
+MOVES = dict((v, tuple(decode_move(v))) for v in list(range(OPEN_BASE + SIZE)) + [GIVEUP])
+PIECES = dict((b, (COLORS[b >> 3], b & 7)) for b in range(16) if b & 7 < 6 and b >> 3 < 2)
+PIECES[NO_PIECE] = None
+
+
+def pack_name(name):
+    b = name.encode('utf-8')
+    if len(b) > 255:
+        raise ValueError('用户名 %r 太长，超过了 255 个字节' % name)
+    return bytes((len(b), )) + b
+
+
+def encode_record(rec):
+    '''
+    把一条记录编码成字节，不包括长度和 crc32。
+    '''
+    winner = NO_RESULT if rec.winner is None and rec.reason is None else RESULTS.index(rec.winner)
+    reason = REASONS.index(rec.reason) if rec.reason in REASONS else NO_RESULT
+    deal = bytearray(NO_PIECE for i in range(SIZE))
+    for x in range(ROW):
+        for y in range(ROW):
+            c = rec.chess[x][y]
+            if c:
+                deal[sq(x, y)] = COLORS.index(c[0]) * 8 + c[1]
+    moves = [encode_move(m) for m in rec.moves]
+    return b''.join((HEAD.pack(rec.id, rec.time, COLORS.index(rec.turn), winner, reason),
+                     pack_name(rec.red), pack_name(rec.blue), bytes(deal),
+                     COUNT.pack(len(moves)), struct.pack('<%dH' % len(moves), *moves)))
+
+
+def decode_record(payload):
+    '''
+    从 encode_record() 的结果还原一条记录。
+    '''
+    try:
+        gid, t, turn, winner, reason = HEAD.unpack_from(payload, 0)
+        i = HEAD.size
+        names = []
+        for k in range(2):
+            n = payload[i]
+            names.append(bytes(payload[i + 1:i + 1 + n]).decode('utf-8'))
+            i += 1 + n
+        deal = payload[i:i + SIZE]
+        i += SIZE
+        count = COUNT.unpack_from(payload, i)[0]
+        moves = struct.unpack_from('<%dH' % count, payload, i + COUNT.size)
+        chess = [[PIECES[b] for b in deal[x * ROW:x * ROW + ROW]] for x in range(ROW)]
+        moves = [MOVES[v] for v in moves]
+    except (struct.error, IndexError, KeyError, UnicodeDecodeError) as e:
+        raise RecordError('记录格式不对： %r' % e)
+    return GameRecord(names[0], names[1], chess, moves, COLORS[turn],
+                      None if winner == NO_RESULT else RESULTS[winner],
+                      None if reason == NO_RESULT else REASONS[reason], t, gid)
+
+
+def read_frame(f):
+    '''
+    从文件的当前位置读一条记录的内容，读到文件末尾或者写到一半的记录时返回 None。
+    '''
+    head = f.read(FRAME.size)
+    if len(head) < FRAME.size:
+        return None
+    length, crc = FRAME.unpack(head)
+    payload = f.read(length)
+    if len(payload) < length or zlib.crc32(payload) != crc:
+        return None
+    return payload
+
+
+def segments(path=RECORD_PATH, prefix=None):
+    '''
+    目录里的段文件名，按写入的顺序排列。
+    '''
+    if not os.path.isdir(path):
+        return []
+    names = [n for n in os.listdir(path) if n.endswith('.seg')]
+    if prefix:
+        names = [n for n in names if n.rsplit('-', 1)[0] == prefix]
+    return sorted(names)
+
+
+def scan(path=RECORD_PATH, prefix=None):
+    '''
+    按写入的顺序逐条读出所有的记录，一次只读一个缓冲区。
+    '''
+    for name in segments(path, prefix):
+        with open(os.path.join(path, name), 'rb', buffering=1 << 20) as f:
+            while True:
+                payload = read_frame(f)
+                if payload is None:
+                    break
+                yield decode_record(payload)
+
+
+def scan_results(path=RECORD_PATH, prefix=None):
+    '''
+    和 scan() 一样按顺序读，但是只解码开头的编号、时间、双方和结果，不解码发牌和每一步，
+    重算积分这类只关心结果的统计用它。
+    @return: 逐个返回 (编号, 结束时间, 红方, 蓝方, 获胜的一方, 结束原因)
+    '''
+    for name in segments(path, prefix):
+        with open(os.path.join(path, name), 'rb', buffering=1 << 20) as f:
+            while True:
+                payload = read_frame(f)
+                if payload is None:
+                    break
+                gid, t, turn, winner, reason = HEAD.unpack_from(payload, 0)
+                i = HEAD.size
+                n = payload[i]
+                red = payload[i + 1:i + 1 + n].decode('utf-8')
+                i += 1 + n
+                blue = payload[i + 1:i + 1 + payload[i]].decode('utf-8')
+                yield (gid, t, red, blue, None if winner == NO_RESULT else RESULTS[winner],
+                       None if reason == NO_RESULT else REASONS[reason])
+
+
+def create_game_table(db):
+    '''
+    建立对局记录的索引表。
+    '''
+    with db.transaction():
+        db.execute('''
+                CREATE TABLE IF NOT EXISTS game
+                (
+                id INTEGER PRIMARY KEY,
+                red VARCHAR(20) NOT NULL,
+                blue VARCHAR(20) NOT NULL,
+                day INT NOT NULL,
+                segment VARCHAR(32) NOT NULL,
+                offset INT NOT NULL,
+                length INT NOT NULL
+                )
+                ''')
+        db.execute('CREATE INDEX IF NOT EXISTS game_red ON game(red)')
+        db.execute('CREATE INDEX IF NOT EXISTS game_blue ON game(blue)')
+        db.execute('CREATE INDEX IF NOT EXISTS game_day ON game(day)')
+
+
+def append_records(db, store, records):
+    '''
+    在写线程中把一批记录追加到段文件，并在一个事务里写入索引。
+    出错时把段文件截回原来的长度，这一批要么全部写入，要么都没写。
+    编码不了的记录再写多少次也一样，打印日志以后丢掉，不影响同一批的其他记录。
+    '''
+    payloads = []
+    for rec in records:
+        try:
+            payloads.append((rec, bytearray(encode_record(rec))))
+        except (ValueError, TypeError, KeyError, IndexError, AttributeError, struct.error) as e:
+            store.log('对局记录 %s 和 %s 无法编码，已丢弃： %r' % (rec.red, rec.blue, e))
+    store.open_segment()
+    # 只在一批的开头换段文件，出错时只需要截断一个文件
+    if store.size >= store.segment_size:
+        store.roll()
+    segment, size = store.segment, store.size
+    try:
+        with db.transaction():
+            for rec, payload in payloads:
+                cur = db.execute('INSERT INTO game(red, blue, day, segment, offset, length) VALUES(?, ?, ?, ?, ?, ?)',
+                                 (rec.red, rec.blue, rec.day, store.segment, store.size, len(payload)))
+                rec.id = cur.lastrowid
+                ID.pack_into(payload, 0, rec.id)
+                store.write(FRAME.pack(len(payload), zlib.crc32(payload)) + payload)
+            # 先把记录写到文件里，再提交索引
+            store.file.flush()
+    except BaseException:
+        if store.segment == segment:
+            store.file.truncate(size)
+            store.size = size
+        raise
+    return [rec.id for rec, payload in payloads]
+
+
+def close_segment(db, store):
+    store.close()
+
+
+def load_record(path, segment, offset, length):
+    with open(os.path.join(path, segment), 'rb') as f:
+        f.seek(offset)
+        payload = read_frame(f)
+    if payload is None or len(payload) != length:
+        raise RecordError('记录 %s:%d 不完整。' % (segment, offset))
+    return decode_record(payload)
+
+
+def read_record(db, path, gid):
+    '''
+    按编号读一局游戏，没有这一局时返回 None。
+    '''
+    row = db.query_one('SELECT segment, offset, length FROM game WHERE id=?', (gid, ))
+    if row is None:
+        return None
+    return load_record(path, *row)
+
+
+def find_by_player(db, name, limit=20, before=None):
+    '''
+    玩家 name 最近的 limit 局游戏，before 不为 None 时只返回编号比它小的，用来翻页。
+    @return: [(编号, 红方, 蓝方, 日期)]，编号从大到小
+    '''
+    before = before or sys.maxsize
+    return db.query('SELECT id, red, blue, day FROM game WHERE red=? AND id<? '
+                    'UNION ALL SELECT id, red, blue, day FROM game WHERE blue=? AND id<? '
+                    'ORDER BY id DESC LIMIT ?', (name, before, name, before, limit))
+
+
+def find_by_day(db, day, limit=100, after=0):
+    '''
+    某一天（yyyymmdd）的游戏，after 不为 0 时只返回编号比它大的。
+    @return: [(编号, 红方, 蓝方, 日期)]，编号从小到大
+    '''
+    return db.query('SELECT id, red, blue, day FROM game WHERE day=? AND id>? ORDER BY id LIMIT ?',
+                    (day, after, limit))
+
+
+class RecordStore(object):
+    '''
+    服务端的对局记录。add() 在 reactor 线程里调用，只是把记录放进内存，
+    写文件和索引都在数据库的写线程里进行，file、segment、size 也只在写线程里使用。
+    '''
+    def __init__(self, dbworker, log, path=RECORD_PATH, prefix='games', segment_size=RECORD_SEGMENT_SIZE,
+                 interval=RECORD_FLUSH_INTERVAL, batch=RECORD_BATCH):
+        self.dbworker = dbworker
+        self.log = log                      # 打印日志的函数
+        self.path = path
+        self.prefix = prefix                # 段文件名的前缀，多进程时每个进程不同
+        self.segment_size = segment_size
+        self.interval = interval
+        self.batch = batch
+        self.pending = []                   # 还没写入的记录
+        self.loop = task.LoopingCall(self.flush)
+        self.file = None                    # 正在写的段文件
+        self.segment = None                 # 正在写的段文件名
+        self.size = 0                       # 正在写的段文件的长度
+
+    def start(self, reactor):
+        '''
+        建立索引表，开始定时写入，reactor 关闭前再写入一次。
+        '''
+        d = self.dbworker.write(create_game_table)
+        d.addErrback(lambda failure: self.log('无法建立对局记录的索引： %s' % failure.getErrorMessage()))
+        self.loop.start(self.interval, now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+        d = self.flush()
+        d.addBoth(lambda _: self.dbworker.write(close_segment, self))
+        return d
+
+    def add(self, record):
+        self.pending.append(record)
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        '''
+        把内存里的记录写入磁盘。读写文件或数据库失败时放回去下次再写，所以这里不会把错误抛给定时器；
+        编码不了的记录在 append_records() 里就丢掉了，不会放回去。
+        '''
+        if not self.pending:
+            return defer.succeed(None)
+        batch, self.pending = self.pending, []
+
+        def failed(failure):
+            self.log('写入对局记录失败： %s' % failure.getErrorMessage())
+            self.pending[:0] = batch
+
+        d = self.dbworker.write(append_records, self, batch)
+        d.addErrback(failed)
+        return d
+
+    def get(self, gid):
+        '''
+        按编号读一局游戏，结果是 GameRecord，没有时为 None。
+        '''
+        return self.dbworker.read(read_record, self.path, gid)
+
+    def by_player(self, name, limit=20, before=None):
+        return self.dbworker.read(find_by_player, name, limit, before)
+
+    def by_day(self, day, limit=100, after=0):
+        return self.dbworker.read(find_by_day, day, limit, after)
+
+    # 下面几个方法只在写线程里调用
+
+    def open_segment(self):
+        if self.file is not None:
+            return
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        names = segments(self.path, self.prefix)
+        if not names:
+            self.roll()
+            return
+        self.segment = names[-1]
+        self.file = open(os.path.join(self.path, self.segment), 'ab')
+        self.size = self.file.tell()
+
+    def roll(self):
+        '''
+        换一个新的段文件。
+        '''
+        n = 1
+        if self.segment is not None:
+            n = int(self.segment.rsplit('-', 1)[1].split('.')[0]) + 1
+            self.close()
+        self.segment = '%s-%06d.seg' % (self.prefix, n)
+        self.file = open(os.path.join(self.path, self.segment), 'ab')
+        self.size = self.file.tell()
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m battlechess.records', description='查看服务端保存的对局记录')
+    parser.add_argument('--id', type=int, help='输出这一局游戏的记录')
+    parser.add_argument('--player', help='列出这个玩家最近的游戏')
+    parser.add_argument('--day', type=int, help='列出这一天（yyyymmdd）的游戏')
+    parser.add_argument('--scan', action='store_true', help='读一遍所有的记录，统计局数、步数和结果')
+    parser.add_argument('-n', '--limit', type=int, default=20, help='最多列出几局')
+    parser.add_argument('--path', default=RECORD_PATH, help='对局记录的目录')
+    args = parser.parse_args(argv)
+
+    from .database import get_db
+    db = get_db(USERDB)
+    if args.id is not None:
+        rec = read_record(db, args.path, args.id)
+        sys.stdout.write((json.dumps(rec.to_dict(), ensure_ascii=False) if rec else '没有这一局。') + '\n')
+    elif args.player or args.day:
+        rows = find_by_player(db, args.player, args.limit) if args.player else find_by_day(db, args.day, args.limit)
+        for gid, red, blue, day in rows:
+            sys.stdout.write('%10d  %s  %s vs %s\n' % (gid, day, red, blue))
+    elif args.scan:
+        start = time.time()
+        games = plies = 0
+        results = {}
+        for rec in scan(args.path):
+            games += 1
+            plies += len(rec.moves)
+            results[rec.winner or 'draw'] = results.get(rec.winner or 'draw', 0) + 1
+        elapsed = time.time() - start
+        sys.stdout.write(json.dumps({'games': games, 'plies': plies, 'results': results, 'seconds': round(elapsed, 3),
+                                     'games_per_sec': round(games / elapsed) if elapsed else 0}) + '\n')
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
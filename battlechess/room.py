@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: room
+@author: Memory&Xinxin
+@date: 2019/12/15
+@document: 服务端的对局房间，记录一局游戏并把游戏数据包转发给对手和观战的人
+'''
+
+from .codec import encode_packet
+from .session import GameSession
+
+'''
+两个玩家匹配成功后，服务端为这局游戏建一个房间，记下开局的棋盘和之后的每一步。
+其他用户发送 {'type': 'watch', 'name': 某个玩家} 就可以观战这个玩家所在的游戏，
+服务端先回复一个快照：
+    {'type': 'watch', 'result': 'success', 'chess': 开局的棋盘, 'turn': 先走的一方,
+     'red': 红方用户信息, 'blue': 蓝方用户信息, 'moves': 已经走过的步}
+moves 里每一步是一个列表，翻棋是 [x, y]，走棋是 [x, y, nx, ny]，认输是 []。
+之后对局中的数据包会原样发给观战的人，游戏结束时发送 {'type': 'watch', 'result': 'end', 'winner': 获胜的一方}，
+和棋时 winner 为 None。
+不带 name 的 watch 请求返回正在进行的游戏列表。
+转发时同一个数据包对每种编码方式只编码一次，所有观战的人收到的是同一份字节，
+所以观战的人再多，每一步也只是多了几次 write。
+观战的人网络太慢、连接暂停发送时，跳过发给他的数据包，恢复以后重新发一次快照。
+'''
+
+
+class GameRoom(object):
+    '''
+    一局正在进行的游戏。
+    '''
+    def __init__(self, red, blue, chess, turn='red', now=0):
+        self.red = red                  # 红方的用户信息
+        self.blue = blue                # 蓝方的用户信息
+        self.chess = chess              # 开局的棋盘
+        self.turn = turn                # 先走的一方
+        self.moves = []                 # 已经走过的步，格式见上面的说明
+        self.watchers = set()           # 观战的连接
+        self.stale = set()              # 跳过了数据包、需要重新发快照的观战连接
+        self.session = GameSession(chess, turn, now)    # 服务端的棋盘，校验每一步并判定输赢
+
+    @property
+    def players(self):
+        return self.red['name'], self.blue['name']
+
+    def color(self, name):
+        return 'red' if name == self.red['name'] else 'blue'
+
+    def record(self, data):
+        '''
+        记下一个游戏数据包，只记翻棋、走棋和认输。
+        '''
+        typ = data.get('type')
+        if typ == 'open':
+            self.moves.append(list(data['from']))
+        elif typ == 'move':
+            self.moves.append(list(data['from']) + list(data['to']))
+        elif typ == 'giveup':
+            self.moves.append([])
+
+    def relay(self, data, to=None):
+        '''
+        记下一个游戏数据包，并发给对手 to（在其他进程上时为 None）和所有观战的人。
+        '''
+        self.record(data)
+        frames = {}         # 编码方式 -> 编码好的字节
+        if to is not None:
+            to.write(self.frame(data, to.codec, frames))
+        # 写的时候可能有连接断开并退出观战，所以先复制一份
+        for conn in tuple(self.watchers):
+            if conn.paused:
+                self.stale.add(conn)
+                continue
+            conn.write(self.frame(data, conn.codec, frames))
+
+    def frame(self, data, codec, frames):
+        f = frames.get(codec)
+        if f is None:
+            f = frames[codec] = encode_packet(data, codec)
+        return f
+
+    def snapshot(self):
+        '''
+        中途加入观战时收到的快照。
+        '''
+        return {'type': 'watch', 'result': 'success', 'chess': self.chess, 'turn': self.turn,
+                'red': self.red, 'blue': self.blue, 'moves': self.moves}
+
+    def summary(self):
+        return {'red': self.red['name'], 'blue': self.blue['name'],
+                'moves': len(self.moves), 'watchers': len(self.watchers)}
+
+    def add_watcher(self, conn):
+        self.watchers.add(conn)
+        conn.send(self.snapshot())
+
+    def remove_watcher(self, conn):
+        self.watchers.discard(conn)
+        self.stale.discard(conn)
+
+    def resync(self, conn):
+        '''
+        观战的连接恢复发送，如果跳过了数据包就重新发快照。
+        '''
+        if conn in self.stale:
+            self.stale.discard(conn)
+            conn.send(self.snapshot())
+
+    def close(self):
+        '''
+        游戏结束，通知所有观战的人。
+        '''
+        frames = {}
+        data = {'type': 'watch', 'result': 'end', 'winner': self.session.winner}
+        watchers, self.watchers = self.watchers, set()
+        self.stale = set()
+        for conn in watchers:
+            conn.watching = None
+            conn.write(self.frame(data, conn.codec, frames))
@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: rules
+@author: Memory&Xinxin
+@date: 2019/12/19
+@document: 不依赖 pygame 的皇家战棋规则，服务端校验、压力测试和模拟对局都用它
+'''
+
+import random
+
+'''
+棋盘压平成 36 个格子，位置 (x, y) 对应第 x * 6 + y 格，也就是一个整数的第 x * 6 + y 位。
+棋盘用位棋盘（bitboard）表示：每一方每个等级的棋子各是一个 36 位的整数，
+另外每一方所有棋子、所有翻开的棋子也各是一个整数，
+每个格子的相邻格子、每个等级能吃哪些等级都事先算好放在表里。
+再用一个 36 格的列表记下每个格子上是哪种棋子，走棋时不用逐个等级去找。
+生成走法时按等级整批计算能走到的格子，判断一步棋是否合法也只需要几次位运算，
+不需要创建任何对象。客户端的 game.BattleChess、服务端的校验和压力测试都用它。
+
+每个棋盘还有一个 64 位的 Zobrist 哈希：每种棋子在每个格子上、翻开和没翻开各有一个随机数，
+轮到蓝方再有一个，哈希是所有这些随机数的异或。翻棋、走棋、吃子时只异或改变了的几项，
+所以同一个局面不管怎么走到的哈希都一样，可以用来识别重复的局面和做置换表（见 transposition.py）。
+随机数用固定的种子生成，不同进程算出的哈希也一样。连续没有吃子的步数不算在哈希里。
+public_hash() 是双方都看得到的部分的哈希：没翻开的棋子只算在哪些格子、每种还有几个，
+不管具体哪个在哪里，ai.py 的搜索用它在置换表里找同一个局面。
+'''
+
+ROW = 6                     # 棋盘是 ROW * ROW 的，同 configs.ROW
+SIZE = ROW * ROW
+COLORS = ('red', 'blue')
+RED, BLUE, DRAW = 0, 1, 2   # Board.result 的取值，DRAW 表示和棋
+EMPTY = -1
+PIECES = 18                 # 每一方的棋子数
+# 发牌的顺序：红蓝交替，每种棋子双方各 1、1、2、2、4、8 个
+DEAL_LEVELS = tuple(level for level, n in enumerate((2, 2, 4, 4, 8, 16)) for i in range(n))
+# 同 configs.MAX_NOEAT 和 configs.MIN_GIVEUP，这里不导入 configs，因为它依赖 pygame
+MAX_NOEAT = 30
+MIN_GIVEUP = 20
+
+# 和 configs.DIRECTION 的顺序一样：上、左、右、下
+DIRECTION = ((0, -1), (-1, 0), (1, 0), (0, 1))
+
+
+def sq(x, y):
+    return x * ROW + y
+
+
+def pos(s):
+    return divmod(s, ROW)
+
+
+def can_eat(a, b):
+    '''
+    等级为 a 的棋子能否吃掉等级为 b 的棋子：
+    等级越小越厉害，可以吃等级不比自己小的棋子；但是刺客(5)可以吃国王(0)，国王不能吃刺客。
+    '''
+    if a == 0 and b == 5:
+        return False
+    if a == 5 and b == 0:
+        return True
+    return a <= b
+
+
+def deal(rng=random):
+    '''
+    随机发牌：双方各有 1 个国王、1 个将军、2 个骑士、2 个弓箭手、4 个禁卫军、8 个刺客，
+    随机放在 36 个格子上。utils.random_chess() 也用它。
+    @return: chess[x][y] = [颜色, 等级]
+    '''
+    order = list(range(SIZE))
+    rng.shuffle(order)
+    chess = [[0] * ROW for x in range(ROW)]
+    for i, s in enumerate(order):
+        x, y = pos(s)
+        chess[x][y] = [COLORS[i % 2], DEAL_LEVELS[i]]
+    return chess
+
+
+def _neighbors(s):
+    x, y = pos(s)
+    return tuple(sq(x + dx, y + dy) for dx, dy in DIRECTION if 0 <= x + dx < ROW and 0 <= y + dy < ROW)
+
+
+NEIGHBORS = tuple(_neighbors(s) for s in range(SIZE))      # 每个格子的相邻格子
+EAT = tuple(tuple(can_eat(a, b) for b in range(6)) for a in range(6))
+
+FULL = (1 << SIZE) - 1
+BIT = tuple(1 << s for s in range(SIZE))
+NEIGHBOR_MASK = tuple(sum(BIT[t] for t in NEIGHBORS[s]) for s in range(SIZE))
+# MOVES[s][mask] 是 s 上的棋子走到 mask 里每个格子的走法，mask 是相邻格子的任意子集
+MOVES = tuple(dict((sum(BIT[t] for t in ts), tuple((s, t) for t in ts))
+                   for ts in (tuple(t for i, t in enumerate(NEIGHBORS[s]) if k >> i & 1)
+                              for k in range(1 << len(NEIGHBORS[s]))))
+              for s in range(SIZE))
+# 每一行的 6 个格子正好是 6 位，按行查表把一个位棋盘拆成格子，比逐位检查快
+ROW_SQUARES = tuple(tuple(tuple(x * ROW + y for y in range(ROW) if m >> y & 1) for m in range(1 << ROW))
+                    for x in range(ROW))
+ROW_OPENS = tuple(tuple(tuple((s, ) for s in squares) for squares in row) for row in ROW_SQUARES)
+
+_zobrist = random.Random(20191223)
+ZOBRIST_HIDDEN = tuple(tuple(_zobrist.getrandbits(64) for s in range(SIZE)) for p in range(12))  # 没翻开的棋子
+ZOBRIST_OPEN = tuple(tuple(_zobrist.getrandbits(64) for s in range(SIZE)) for p in range(12))    # 翻开的棋子
+ZOBRIST_TURN = _zobrist.getrandbits(64)     # 轮到蓝方
+ZOBRIST_COVER = tuple(_zobrist.getrandbits(64) for s in range(SIZE))    # 格子上有没翻开的棋子，不管是什么
+ZOBRIST_COUNT = tuple(tuple(_zobrist.getrandbits(64) for k in range(SIZE + 1)) for p in range(12))  # 没翻开的这种棋子有几个
+del _zobrist
+
+
+def _cover_row(x, m):
+    h = 0
+    for s in ROW_SQUARES[x][m]:
+        h ^= ZOBRIST_COVER[s]
+    return h
+
+
+# 按行查表算一个位棋盘上所有格子的 ZOBRIST_COVER 的异或
+ZOBRIST_COVER_ROWS = tuple(tuple(_cover_row(x, m) for m in range(1 << ROW)) for x in range(ROW))
+
+
+def squares(mask):
+    '''
+    位棋盘 mask 里所有的格子，从小到大。
+    '''
+    out = []
+    x = 0
+    while mask:
+        m = mask & 63
+        if m:
+            out.extend(ROW_SQUARES[x][m])
+        mask >>= ROW
+        x += 1
+    return out
+
+
+class Board(object):
+    '''
+    一局游戏的棋盘和计数。
+    open() 和 move() 不检查是否合法，调用前先用 can_open() 和 can_move() 检查。
+    '''
+    __slots__ = ('pieces', 'side', 'at', 'opened', 'turn', 'left', 'no_eat', 'step', 'result', 'max_noeat', 'hash')
+
+    def __init__(self, pieces, turn=RED, max_noeat=MAX_NOEAT):
+        self.pieces = pieces                # 第 color * 6 + level 个是 color 一方等级为 level 的棋子的位棋盘
+        self.at = [EMPTY] * SIZE            # 每个格子上棋子的 color * 6 + level，EMPTY 表示没有棋子
+        for i, mask in enumerate(pieces):
+            for s in squares(mask):
+                self.at[s] = i
+        self.side = [pieces[0] | pieces[1] | pieces[2] | pieces[3] | pieces[4] | pieces[5],
+                     pieces[6] | pieces[7] | pieces[8] | pieces[9] | pieces[10] | pieces[11]]   # 双方所有的棋子
+        self.opened = 0                     # 翻开了的棋子
+        self.turn = turn                    # 轮到哪一方
+        self.left = [bin(self.side[RED]).count('1'), bin(self.side[BLUE]).count('1')]   # 双方剩下的棋子数
+        self.no_eat = 0                     # 连续多少步没有吃子或者翻开棋子
+        self.step = 0                       # 一共走了多少步
+        self.result = None                  # 游戏结束时为 RED、BLUE 或 DRAW
+        self.max_noeat = max_noeat
+        self.hash = self.zobrist()          # 局面的 Zobrist 哈希，每一步增量更新
+
+    @classmethod
+    def from_chess(cls, chess, turn='red', max_noeat=MAX_NOEAT):
+        '''
+        从 random_chess() 生成的棋盘（chess[x][y] = [颜色, 等级]）建立。
+        '''
+        pieces = [0] * 12
+        for x in range(ROW):
+            for y in range(ROW):
+                c = chess[x][y]
+                if c:
+                    pieces[COLORS.index(c[0]) * 6 + c[1]] |= BIT[x * ROW + y]
+        return cls(pieces, COLORS.index(turn), max_noeat)
+
+    def copy(self):
+        board = Board.__new__(Board)
+        board.pieces = self.pieces[:]
+        board.side = self.side[:]
+        board.at = self.at[:]
+        board.opened = self.opened
+        board.turn = self.turn
+        board.left = self.left[:]
+        board.no_eat = self.no_eat
+        board.step = self.step
+        board.result = self.result
+        board.max_noeat = self.max_noeat
+        board.hash = self.hash
+        return board
+
+    def shuffled(self, rng=random):
+        '''
+        复制一份，没翻开的棋子在没翻开的格子之间随机重新摆放。
+        双方都只知道还有哪些棋子没翻开，不知道在哪里，搜索时用它把看不见的部分随机确定下来。
+        '''
+        board = self.copy()
+        opened = self.opened
+        hidden = squares((self.side[RED] | self.side[BLUE]) & ~opened)
+        codes = [self.at[s] for s in hidden]
+        rng.shuffle(codes)
+        pieces = [m & opened for m in self.pieces]
+        at = board.at
+        for s, p in zip(hidden, codes):
+            at[s] = p
+            pieces[p] |= BIT[s]
+        board.pieces = pieces
+        board.side = [pieces[0] | pieces[1] | pieces[2] | pieces[3] | pieces[4] | pieces[5],
+                      pieces[6] | pieces[7] | pieces[8] | pieces[9] | pieces[10] | pieces[11]]
+        board.hash = board.zobrist()
+        return board
+
+    def zobrist(self):
+        '''
+        从头计算局面的 Zobrist 哈希，和增量更新的 self.hash 应该一样。
+        '''
+        h = ZOBRIST_TURN if self.turn == BLUE else 0
+        for s, p in enumerate(self.at):
+            if p != EMPTY:
+                h ^= ZOBRIST_OPEN[p][s] if self.opened & BIT[s] else ZOBRIST_HIDDEN[p][s]
+        return h
+
+    def public_hash(self):
+        '''
+        双方都看得到的局面的哈希：翻开的棋子、哪些格子有没翻开的棋子、没翻开的每种棋子有几个、轮到哪一方。
+        没翻开的棋子怎么摆放不影响它，shuffled() 以后不变。
+        '''
+        at = self.at
+        opened = self.opened
+        hidden = (self.side[RED] | self.side[BLUE]) & ~opened
+        h = self.hash
+        for s in squares(hidden):
+            h ^= ZOBRIST_HIDDEN[at[s]][s]
+        for x in range(ROW):
+            h ^= ZOBRIST_COVER_ROWS[x][hidden >> x * ROW & 63]
+        for p in range(12):
+            h ^= ZOBRIST_COUNT[p][bin(self.pieces[p] & hidden).count('1')]
+        return h
+
+    @property
+    def winner(self):
+        '''
+        获胜一方的颜色名，和棋或者没有结束时为 None。
+        '''
+        return COLORS[self.result] if self.result in (RED, BLUE) else None
+
+    def piece(self, s):
+        '''
+        格子 s 上的棋子 (颜色, 等级)，没有棋子时为 None。
+        '''
+        p = self.at[s]
+        return None if p == EMPTY else divmod(p, 6)
+
+    def is_open(self, s):
+        return bool(self.opened & BIT[s])
+
+    def can_open(self, s):
+        b = BIT[s]
+        return self.result is None and self.at[s] != EMPTY and not self.opened & b
+
+    def can_move(self, s, t):
+        '''
+        轮到的一方能否把 s 上的棋子走到 t：只能走自己翻开的棋子，走到相邻的空格，
+        或者吃掉相邻的、已经翻开的、等级不比自己小的对方棋子。
+        '''
+        bs, bt = BIT[s], BIT[t]
+        c = self.turn
+        side, opened = self.side, self.opened
+        if self.result is not None or not side[c] & opened & bs or not NEIGHBOR_MASK[s] & bt:
+            return False
+        q = self.at[t]
+        if q == EMPTY:
+            return True
+        if not side[c ^ 1] & opened & bt:
+            return False
+        return EAT[self.at[s] - c * 6][q - (c ^ 1) * 6]
+
+    def targets(self, s):
+        '''
+        s 上的棋子这一步能走到的格子。
+        '''
+        return [t for t in NEIGHBORS[s] if self.can_move(s, t)]
+
+    def open(self, s):
+        p = self.at[s]
+        self.opened |= BIT[s]
+        self.hash ^= ZOBRIST_HIDDEN[p][s] ^ ZOBRIST_OPEN[p][s]
+        self.no_eat = 0
+        self.next_turn()
+
+    def move(self, s, t):
+        '''
+        走棋，吃掉棋子时返回被吃的一方，否则返回 None。
+        '''
+        bs, bt = BIT[s], BIT[t]
+        pieces, side, at = self.pieces, self.side, self.at
+        p, q = at[s], at[t]
+        if q == EMPTY:
+            dead = None
+            self.no_eat += 1
+        else:
+            dead = q // 6
+            pieces[q] ^= bt
+            side[dead] ^= bt
+            self.left[dead] -= 1
+            self.no_eat = 0
+            self.hash ^= ZOBRIST_OPEN[q][t]
+        pieces[p] ^= bs | bt
+        side[p // 6] ^= bs | bt
+        at[t], at[s] = p, EMPTY
+        self.hash ^= ZOBRIST_OPEN[p][s] ^ ZOBRIST_OPEN[p][t]
+        # 走的棋子一定是翻开的，走到 t 以后 t 也是翻开的
+        self.opened = self.opened ^ bs | bt
+        self.next_turn()
+        return dead
+
+    def next_turn(self):
+        self.turn ^= 1
+        self.hash ^= ZOBRIST_TURN
+        self.step += 1
+        self.check()
+
+    def check(self):
+        '''
+        判断游戏是否结束：一方的棋子全被吃掉就输；双方都只剩一个棋子时比大小；
+        连续 max_noeat 步没有吃子或者翻开棋子就和棋。
+        '''
+        red, blue = self.left
+        if red == 0:
+            self.result = BLUE
+        elif blue == 0:
+            self.result = RED
+        elif red == 1 and blue == 1:
+            # 双方都只剩一个棋子时比大小
+            a = self.at[self.side[RED].bit_length() - 1]
+            b = self.at[self.side[BLUE].bit_length() - 1] - 6
+            self.result = RED if EAT[a][b] else BLUE
+        elif self.no_eat >= self.max_noeat:
+            self.result = DRAW
+
+    def resign(self, color):
+        '''
+        color 一方认输（或者超时、掉线）。
+        '''
+        if self.result is None:
+            self.result = color ^ 1
+
+    def actions(self):
+        '''
+        轮到的一方所有能走的步，翻棋是 (s, )，走棋是 (s, t)。
+        先是所有的翻棋，然后按等级列出走棋。
+        '''
+        if self.result is not None:
+            return []
+        pieces, side, opened, turn = self.pieces, self.side, self.opened, self.turn
+        occupied = side[RED] | side[BLUE]
+        acts = []
+        hidden = occupied & ~opened
+        x = 0
+        while hidden:
+            m = hidden & 63
+            if m:
+                acts.extend(ROW_OPENS[x][m])
+            hidden >>= ROW
+            x += 1
+        mine = side[turn] & opened
+        if not mine:
+            return acts
+        empty = FULL ^ occupied
+        base = turn * 6
+        enemy = [m & opened for m in pieces[6 - base:12 - base]]      # 对方每个等级翻开了的棋子
+        weaker = 0
+        for level in (5, 4, 3, 2, 1, 0):
+            # weaker 是等级不比 level 小的对方棋子，也就是按 can_eat 能吃的，再加上刺客和国王的例外
+            weaker |= enemy[level]
+            movable = pieces[base + level] & mine
+            if not movable:
+                continue
+            if level == 0:
+                prey = empty | (weaker ^ enemy[5])
+            elif level == 5:
+                prey = empty | weaker | enemy[0]
+            else:
+                prey = empty | weaker
+            while movable:
+                low = movable & -movable
+                movable ^= low
+                s = low.bit_length() - 1
+                to = NEIGHBOR_MASK[s] & prey
+                if to:
+                    acts.extend(MOVES[s][to])
+        return acts
+
+    def apply(self, act):
+        '''
+        走 actions() 返回的一步。
+        '''
+        if len(act) == 1:
+            self.open(act[0])
+        else:
+            self.move(act[0], act[1])
+
+    def packet(self, act):
+        '''
+        actions() 返回的一步对应的数据包。
+        '''
+        if len(act) == 1:
+            return {'type': 'open', 'from': list(pos(act[0]))}
+        return {'type': 'move', 'from': list(pos(act[0])), 'to': list(pos(act[1]))}
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: runserver
+@author: Memory&Xinxin
+@date: 2019/12/10
+@document: 服务端的启动入口，python -m battlechess.runserver -h 查看用法
+'''
+
+import argparse
+from .configs import LOCAL_PORT, METRICS_PORT
+
+BACKENDS = ['twisted', 'asyncio']
+
+
+def install_asyncio():
+    '''
+    安装 Twisted 的 asyncio reactor，必须在导入 twisted.internet.reactor 之前调用，
+    所以服务端的模块都在这之后才导入。
+    '''
+    import asyncio
+    from twisted.internet import asyncioreactor
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    asyncioreactor.install(loop)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m battlechess.runserver', description='皇家战棋服务端')
+    parser.add_argument('-p', '--port', type=int, default=LOCAL_PORT, help='监听的端口')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='工作进程数，大于1时启动多个进程共用同一个端口')
+    parser.add_argument('-m', '--metrics-port', type=int, default=METRICS_PORT,
+                        help='在本机这个端口上提供运行指标（/metrics），0 表示不开启；'
+                             '多进程时第 i 个工作进程使用这个端口加 1 加 i')
+    parser.add_argument('-b', '--backend', choices=BACKENDS, default='twisted',
+                        help='网络层的实现：twisted（默认）或者 asyncio streams，两者的处理逻辑相同')
+    # 下面几个参数是主进程启动工作进程时用的
+    parser.add_argument('--worker', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--broker', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--fd', type=int, default=3, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.backend == 'asyncio':
+        install_asyncio()
+
+    if args.worker is not None:
+        from .cluster import runworker
+        runworker(args.fd, args.broker, args.worker, args.metrics_port, args.backend)
+        return
+
+    from .server import createDatabase, runserver
+    createDatabase()
+    runserver(args.port, args.workers, args.metrics_port, args.backend)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,189 +7,487 @@
 @document: 皇家战棋游戏的服务端文件
 '''
 import os
+import time
 from twisted.internet.protocol import Protocol
 from twisted.internet.protocol import Factory
 from twisted.internet.endpoints import TCP4ServerEndpoint
-from twisted.internet import reactor
+from twisted.internet import reactor, defer, task
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
 from .utils import *
-from .configs import SERVER_LOG_PATH, USERDB, DATABASE_PATH
+from .codec import JSON, PROTOCOL_VERSION, choose_codec
+from .database import DBWorker, LoginError, get_db, create_tables, check_login, add_user
+from .cache import UserCache
+from .matchmaking import MatchQueue
+from .room import GameRoom
+from .records import RecordStore, GameRecord
+from .rules import COLORS
+from .leaderboard import Leaderboard
+from .timingwheel import TimingWheel
+from . import metrics
+from .metrics import registry, MESSAGES, HANDLER_LATENCY, BYTES_IN, BYTES_OUT, CONN_BYTES_IN, CONN_BYTES_OUT, \
+    CONNECTIONS, WRITES, SLOW_CLIENTS, EVICTED, ILLEGAL, GAMES
+from .configs import SERVER_LOG_PATH, USERDB, DATABASE_PATH, METRICS_PORT, OUTBOX_LIMIT, \
+    HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT, IDLE_TIMEOUT, LEADERBOARD_TOP, LEADERBOARD_REFRESH, NAME_LIMIT, \
+    TIMEOUT_SLACK
 
+GAME_PACKETS = ('open', 'move', 'giveup')      # 游戏中的操作，校验以后转发给对手
+CLOCK_EPSILON = 0.01                            # 到时间再判超时的时候多等一点，避免浮点数的误差
 
+
+@implementer(IPushProducer)
 class BCServerProtocol(Protocol):
-    """docstring for BCServerProtocol"""
+    """
+    服务端和一个客户端的连接。
+    发给客户端的数据先放进 outbox，同一轮事件循环里的所有数据合并成一次 write。
+    连接本身注册为 transport 的生产者，客户端收得太慢、transport 的缓冲区满了时，
+    Twisted 会调用 pauseProducing，这时数据只留在 outbox 里，
+    等 resumeProducing 时再发；outbox 超过 OUTBOX_LIMIT 字节就断开这个连接。
+    在线的连接可能有几十万个，所以每个连接只保存自己的状态：
+    数据包的分派表 parse 放在类上，日志用 factory 的。
+    Twisted 的 Protocol 没有 __slots__，这里加上也还是有 __dict__，
+    而 Python 3 里同一个类的实例共用属性名，__dict__ 本来就不大，所以不用 __slots__。
+    """
+
     def __init__(self, factory):
         # super(BCServerProtocol, self).__init__()
         self.factory = factory
-        self.log = Logging(SERVER_LOG_PATH)
-        self.parse = {'signin': self.signin,
-                      'signup': self.signup,
-                      'match': self.match,
-                      'unmatch': self.unmatch,
-                      'endgame': self.endgame}
+        self.decoder = PacketDecoder(factory.log_print)
+        self.codec = JSON       # 发给客户端的数据的编码方式，握手以后可能变成二进制
+        self.id = 0
+        self.user = None
+        self.bytes_in = 0       # 这个连接收到和发出的字节数
+        self.bytes_out = 0
+        self.watching = None    # 正在观战的房间
+        self.outbox = None      # 等待发送的数据，有数据时才建立列表
+        self.outbox_size = 0
+        self.queued = False     # 是否已经在等待 factory 统一发送
+        self.paused = False     # transport 的缓冲区满了，暂停发送
+        self.last_seen = 0      # 最后一次收到数据的时间
+        self.pingable = False   # 握手过的客户端才会回复 ping
+
+    @property
+    def log(self):
+        return self.factory.log
 
     def connectionMade(self):
         '''
         建立连接时的动作。
         '''
         self.factory.connection_num += 1
+        CONNECTIONS.inc()
         self.factory.id += 1
         self.id = self.factory.id
-        self.user = None
+        self.transport.registerProducer(self, True)
+        self.last_seen = self.factory.wheel.now
+        self.factory.wheel.schedule(self, IDLE_TIMEOUT, self.factory.check)
 
     def connectionLost(self, reason):
         '''
         失去连接时的操作。
         '''
+        self.connected = False
+        self.outbox = None
+        self.outbox_size = 0
         self.factory.connection_num -= 1
+        self.factory.wheel.cancel(self)
+        CONN_BYTES_IN.observe(self.bytes_in)
+        CONN_BYTES_OUT.observe(self.bytes_out)
+        if self.watching:
+            self.watching.remove_watcher(self)
         if not self.user:
             return
         self.log.print("用户 %s 失去了连接。" % self.user)
         qqmsg(self.user, '退出了游戏')
         # 如果有正在进行的游戏，则判定为输
         if self.user in self.factory.matched:
-            data = {'type': 'giveup'}
-            self.sendToMatched(dict2bin(data))
+            room = self.factory.games.get(self.user)
+            if room is not None:
+                room.session.end(room.color(self.user), 'disconnect')
+            self.sendToMatched({'type': 'giveup'})
+            if room is not None:
+                self.factory.update_game(room)
             v = self.cleangame()
             if v:
                 self.log.print("因为 %s 掉线，%s 和 %s 的游戏结束!" % (self.user, self.user, v))
-        elif self.user in self.factory.wait:
-            self.factory.wait.remove(self.user)
+        elif self.factory.wait.cancel(self.user):
             self.log.print("用户 %s 放弃了匹配。" % self.user)
 
         # 从客户池中删除
         self.factory.clients.pop(self.user)
+        d = self.factory.cache.unpin(self.user)
+        if self.factory.cluster:
+            # 积分写回数据库以后才释放，马上在其他进程登录时读到的才是新的积分
+            cluster, user = self.factory.cluster, self.user
+            d.addCallback(lambda _: cluster.release(user))
         write_online(len(self.factory.clients))
 
     def dataReceived(self, _data):
         '''
         收到数据时的处理操作。
         '''
-        # strdata = data.decode('utf-8')
-        # jsons = strdata.replace('}{', '}}{{').split('}{')
-
-        datas = spilt_data(_data)
+        self.last_seen = self.factory.wheel.now
+        self.bytes_in += len(_data)
+        BYTES_IN.inc(value=len(_data))
+        try:
+            datas = self.decoder.feed(_data)
+        except FrameError as e:
+            self.log.print('用户 %s 发送了非法数据： %s' % (self.user, e))
+            self.transport.loseConnection()
+            return
         for data in datas:
-            typ = data['type']
-            if typ in self.parse:
-                self.parse[typ](data)
+            typ = data.get('type') if isinstance(data, dict) else None
+            if not isinstance(typ, str):
+                # type 不是字符串的数据包不是客户端发的，直接断开
+                self.log.print('用户 %s 发送了没有类型的数据包，断开连接。' % self.user)
+                self.transport.loseConnection()
+                return
+            start = time.perf_counter()
+            handler = self.parse.get(typ)
+            if handler is not None:
+                MESSAGES.inc(typ, 'handler')
+                handler(self, data)
+            elif typ in GAME_PACKETS:
+                MESSAGES.inc(typ, 'relay')
+                self.log.debug("用户 %s 进行了游戏操作: %s" % (self.user, typ))
+                self.play(data)
             else:
-                self.log.print('用户 %s 进行了游戏操作: %s' % (self.user, typ))
-                self.sendToMatched(dict2bin(data))
+                # 未知的类型都记在 unknown 下，不为每个随便发来的类型新建一组指标
+                typ = 'unknown'
+                MESSAGES.inc(typ, 'dropped')
+                self.log.debug("用户 %s 发送了未知的数据包: %s" % (self.user, data['type']))
+            HANDLER_LATENCY.observe(time.perf_counter() - start, typ)
+
+    def send(self, data):
+        '''
+        用这个连接协商好的编码方式给客户端发送一个数据包。
+        '''
+        self.write(encode_packet(data, self.codec))
+
+    def write(self, packet):
+        '''
+        发送已经编码好的数据包，转发给多个人时同一份字节可以直接复用。
+        数据先放进 outbox，在这一轮事件循环结束时和其他数据一起发送。
+        '''
+        if not self.connected:
+            return
+        self.bytes_out += len(packet)
+        BYTES_OUT.inc(value=len(packet))
+        if self.outbox is None:
+            self.outbox = [packet]
+        else:
+            self.outbox.append(packet)
+        self.outbox_size += len(packet)
+        if self.outbox_size > OUTBOX_LIMIT:
+            self.log.print('用户 %s 接收数据太慢，待发送的数据超过了 %d 字节，断开连接。' % (self.user or self.id, OUTBOX_LIMIT))
+            SLOW_CLIENTS.inc()
+            self.outbox = None
+            self.outbox_size = 0
+            # connectionLost 要等到下一轮事件循环，在这之前不再发送任何数据
+            self.connected = False
+            self.transport.abortConnection()
+            return
+        if not self.queued and not self.paused:
+            self.queued = True
+            self.factory.schedule_flush(self)
+
+    def flush(self):
+        '''
+        把 outbox 里的数据一次写给 transport。
+        '''
+        self.queued = False
+        if self.paused or not self.outbox or not self.connected:
+            return
+        data = self.outbox[0] if len(self.outbox) == 1 else b''.join(self.outbox)
+        self.outbox = None
+        self.outbox_size = 0
+        WRITES.inc()
+        self.transport.write(data)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.flush()
+        if self.watching:
+            # 暂停期间跳过了一些观战的数据包，重新发一次快照
+            self.watching.resync(self)
+
+    def stopProducing(self):
+        self.paused = True
+        self.outbox = None
+        self.outbox_size = 0
+
+    def hello(self, data):
+        '''
+        客户端的握手请求，选择双方都支持的编码方式。
+        回复仍然用json发送，客户端收到以后才切换编码。
+        '''
+        codec = choose_codec(data)
+        self.send({'type': 'hello', 'version': PROTOCOL_VERSION, 'codec': codec})
+        self.codec = codec
+        # 握手过的客户端会回复 ping，改用心跳检测
+        self.pingable = True
+        self.factory.wheel.schedule(self, HEARTBEAT_INTERVAL, self.factory.check)
+
+    def ping(self, data):
+        self.send({'type': 'pong'})
+
+    def pong(self, data):
+        '''
+        心跳的回复，收到数据时已经更新了 last_seen，不需要再做什么。
+        '''
+        pass
 
     def signin(self, data):
         '''
         处理用户的登录请求。
+        密码验证在数据库的线程池中进行，结果通过 Deferred 回调返回。
         '''
         user = data['user']
-        self.log.print('用户 %s 发起了登录请求。' % user['name'])
-        if user['name'] in self.factory.clients:
-            reply = {'type': 'signin', 'result': 'failed', 'reason': '该账号在其他地方已登录。'}
-            self.transport.write(dict2bin(reply))
-            self.log.print('用户 %s 登录失败。 因为： %s' % (user['name'], reply['reason']))
+        name = user['name']
+        self.log.print('用户 %s 发起了登录请求。' % name)
+        if name in self.factory.clients:
+            self.reply_failed('signin', name, '该账号在其他地方已登录。')
             return
-        # 查询是否存在该用户
-        sql = 'SELECT passwd FROM user WHERE name=?'
-        value = (user['name'], )
-        result = excuteSQL(sql, value)
-        if result is None:      # 查询失败
-            reply = {'type': 'signin', 'result': 'failed', 'reason': '系统出了一点问题。'}
-        elif result == []:      # 查不到用户
-            reply = {'type': 'signin', 'result': 'failed', 'reason': '用户名 %s 不存在。' % (user['name'])}
-        elif result[0][0] != user['passwd']:    # 密码不匹配
-            reply = {'type': 'signin', 'result': 'failed', 'reason': '密码错误。'}
-        else:                   # 登录成功
-            reply = {'type': 'signin', 'user': get_user(user['name']), 'result': 'success'}
-            qqmsg(user['name'], '登录了游戏')
-            # 添加到用户池
-            self.factory.clients[user['name']] = self
-            write_online(len(self.factory.clients))
-            self.user = user['name']
-        # 打印日志
-        if reply['result'] == 'failed':
-            self.log.print('用户 %s 登录失败。 因为： %s' % (user['name'], reply['reason']))
-        else:
-            self.log.print('用户 %s 登录成功。' % user['name'])
-        # 将结果发送给用户
-        self.transport.write(dict2bin(reply))
+
+        def success(info):
+            if not self.connected:
+                return
+            # 查询数据库的这段时间里，可能已经在其他地方登录了
+            if name in self.factory.clients:
+                self.reply_failed('signin', name, '该账号在其他地方已登录。')
+                return
+            if not self.factory.cluster:
+                self.login(name, info)
+                return
+            # 多进程模式下，还要向主进程登记，看是否在其他进程登录了
+            return self.factory.cluster.claim(name).addCallback(claimed, info)
+
+        def claimed(ok, info):
+            if not ok:
+                self.reply_failed('signin', name, '该账号在其他地方已登录。')
+            elif not self.connected or name in self.factory.clients:
+                if name not in self.factory.clients:
+                    self.factory.cluster.release(name)
+                if self.connected:
+                    self.reply_failed('signin', name, '该账号在其他地方已登录。')
+            else:
+                self.login(name, info)
+
+        def failed(failure):
+            if failure.check(LoginError):       # 用户不存在或密码错误
+                reason = failure.value.args[0]
+            else:                               # 查询失败
+                self.log.print(failure.getErrorMessage())
+                reason = '系统出了一点问题。'
+            if self.connected:
+                self.reply_failed('signin', name, reason)
+
+        d = self.factory.dbworker.read(check_login, name, user['passwd'])
+        d.addCallbacks(success, failed)
+        return d
+
+    def login(self, name, info):
+        '''
+        登录成功，把用户加入用户池。
+        '''
+        qqmsg(name, '登录了游戏')
+        # 缓存里的积分可能比数据库新，以缓存为准，并在在线期间一直留在缓存里
+        info = self.factory.cache.put(info)
+        self.factory.cache.pin(name)
+        # 添加到用户池
+        self.factory.clients[name] = self
+        write_online(len(self.factory.clients))
+        self.user = name
+        self.log.print('用户 %s 登录成功。' % name)
+        self.send({'type': 'signin', 'user': info, 'result': 'success'})
 
     def signup(self, data):
         '''
-        处理用户的注册请求。
+        处理用户的注册请求。新用户由数据库的写线程插入。
         '''
         user = data['user']
-        self.log.print('用户 %s 请求注册。' % user['name'])
-        # 查询是否存在同名的用户
-        sql = 'SELECT * FROM user WHERE name=?'
-        value = (user['name'], )
-        result = excuteSQL(sql, value)
-        if result is None:      # 查询失败
-            reply = {'type': 'signup', 'result': 'failed', 'reason': '服务器出了一点问题。'}
-        elif result == []:      # 查询成功，无同名用户
-            # 将新用户添加到数据库
-            sql = 'INSERT INTO user(name, passwd, credit, title) VALUES(?, ?, ?, ?)'
-            value = (user['name'], user['passwd'], 0, '平民')
-            if excuteSQL(sql, value) is not None:       # 插入成功，即注册成功
-                reply = {'type': 'signup', 'name': user['name'], 'result': 'success'}
-                qqmsg(user['name'], '注册成为了新用户')
-            else:
-                reply = {'type': 'signup', 'result': 'failed', 'reason': '服务器出了一点问题。'}
-        else:
-            reply = {'type': 'signup', 'result': 'failed', 'reason': '用户名 %s 已被注册。' % (user['name'])}
-        # 打印日志
-        if reply['result'] == 'failed':
-            self.log.print('用户 %s 注册失败。 因为： %s' % (user['name'], reply['reason']))
-        else:
-            self.log.print('用户 %s 注册成功。' % user['name'])
-        # 将结果发送给用户
-        self.transport.write(dict2bin(reply))
+        name = user['name']
+        self.log.print('用户 %s 请求注册。' % name)
+        if not isinstance(name, str) or not name or len(name.encode('utf-8')) > NAME_LIMIT:
+            self.reply_failed('signup', name, '用户名不能为空，也不能超过 %d 个字节。' % NAME_LIMIT)
+            return
 
-    def match(self, user):
+        def done(added):
+            if not self.connected:
+                return
+            if not added:       # 用户名是主键，插入失败说明已经有同名的用户
+                self.reply_failed('signup', name, '用户名 %s 已被注册。' % name)
+                return
+            qqmsg(name, '注册成为了新用户')
+            self.factory.leaderboard.update(name, 0)
+            self.log.print('用户 %s 注册成功。' % name)
+            self.send({'type': 'signup', 'name': name, 'result': 'success'})
+
+        def failed(failure):
+            self.log.print(failure.getErrorMessage())
+            if self.connected:
+                self.reply_failed('signup', name, '服务器出了一点问题。')
+
+        d = self.factory.dbworker.write(add_user, name, user['passwd'])
+        d.addCallbacks(done, failed)
+        return d
+
+    def reply_failed(self, typ, name, reason):
         '''
-        用户请求匹配对手时，查看是否有等待的用户，如果有，就配对，如果没有，就等待。
+        回复登录或注册失败，并打印日志。
         '''
-        self.log.print('用户 %s 请求匹配游戏对手。' % user['name'])
-        qqmsg(user['name'], '请求匹配游戏对手')
-        if user['name'] not in self.factory.wait:
-            self.factory.wait.append(user['name'])
+        action = '登录' if typ == 'signin' else '注册'
+        self.log.print('用户 %s %s失败。 因为： %s' % (name, action, reason))
+        self.send({'type': typ, 'result': 'failed', 'reason': reason})
 
-        if len(self.factory.wait) < 2:
-            # self.factory.wait = user['name']
-            self.log.print('用户 %s 正在等待匹配。' % user['name'])
-        else:
-            you = self.factory.wait[0]
-            me = self.factory.wait[1]
-            self.factory.matched[me] = you
-            self.factory.matched[you] = me
-            self.factory.wait.remove(me)
-            self.factory.wait.remove(you)
-            self.log.print('用户 %s 和 用户 %s 匹配成功。' % (me, you))
-            qqmsg('%s 和 %s' % (me, you), '匹配成功')
-
-            chess = random_chess()
-            my_user = get_user(me)
-            your_user = get_user(you)
-            data1 = {'type': 'init', 'chess': chess, 'turn': 'red', 'color': 'red', 'me': my_user, 'you': your_user}
-            data2 = {'type': 'init', 'chess': chess, 'turn': 'red', 'color': 'blue', 'me': your_user, 'you': my_user}
-            self.transport.write(dict2bin(data1))
-            self.sendToMatched(dict2bin(data2))
+    def match(self, user):
+        '''
+        用户请求匹配对手时，在积分相近的等待用户里找一个对手，如果有，就配对，如果没有，就等待。
+        '''
+        name = user['name']
+        self.log.print('用户 %s 请求匹配游戏对手。' % name)
+        if name != self.user or name in self.factory.matched:
+            self.log.print('用户 %s 未登录或正在游戏中，不能匹配。' % name)
+            return
+        qqmsg(name, '请求匹配游戏对手')
+        info = self.factory.cache.get(name) or {'name': name, 'credit': 0, 'title': '平民'}
+        if self.factory.cluster:
+            # 多进程模式下，由主进程统一匹配
+            self.factory.cluster.enqueue(info)
+            self.log.print('用户 %s 正在等待匹配。' % name)
+            return
+        self.factory.wait.add(name, info['credit'])
+        you = self.factory.wait.pair(name)
+        if you is None:
+            self.log.print('用户 %s 正在等待匹配。' % name)
+            return
+        return self.factory.start_game(name, you)
 
     def unmatch(self, user):
         '''
         用户取消请求匹配对手时的操作。
         '''
-        if user['name'] in self.factory.wait:
-            self.factory.wait.remove(user['name'])
+        if self.factory.cluster and user['name'] == self.user:
+            self.factory.cluster.cancel(user['name'])
+            self.log.print("用户 %s 放弃了匹配。" % user['name'])
+            qqmsg(user['name'], '放弃了匹配')
+        elif self.factory.wait.cancel(user['name']):
             self.log.print("用户 %s 放弃了匹配。" % user['name'])
             qqmsg(user['name'], '放弃了匹配')
 
+    def play(self, data):
+        '''
+        游戏中的操作。先在服务端的棋盘上校验，合法才转发给对手和观战的人，
+        不合法的回复 {'type': 'illegal', 'reason': 原因, 'packet': 原来的数据包}。
+        '''
+        room = self.factory.games.get(self.user)
+        if room is None:
+            self.log.debug('用户 %s 不在游戏中，忽略数据包 %s。' % (self.user, data['type']))
+            return
+        error = room.session.play(room.color(self.user), data, reactor.seconds())
+        if error:
+            ILLEGAL.inc(data['type'])
+            self.log.print('用户 %s 的操作不合法： %s %s' % (self.user, error, data))
+            self.send({'type': 'illegal', 'reason': error, 'packet': data})
+        else:
+            self.sendToMatched(data)
+        self.factory.update_game(room)
+
     def sendToMatched(self, data):
         '''
-        在游戏过程中，将游戏的数据包发送给对手
+        在游戏过程中，将游戏的数据包发送给对手和观战的人
         '''
         if self.user in self.factory.matched:
             toid = self.factory.matched[self.user]
-            to = self.factory.clients[toid]
-            to.transport.write(data)
+            to = self.factory.clients.get(toid)
+            room = self.factory.games.get(self.user)
+            if room is not None:
+                room.relay(data, to)
+            elif to is not None:
+                to.send(data)
+            if to is None and self.factory.cluster:
+                # 对手连接在其他进程上，经主进程转发
+                self.factory.cluster.route(toid, data)
+
+    def watch(self, data):
+        '''
+        观战用户 name 所在的游戏，没有 name 时返回正在进行的游戏列表。
+        '''
+        name = data.get('name')
+        if not name:
+            rooms = self.factory.rooms()
+            self.send({'type': 'watch', 'result': 'list', 'games': [r.summary() for r in rooms[:WATCH_LIST]]})
+            return
+        room = self.factory.games.get(name)
+        if room is None:
+            self.send({'type': 'watch', 'result': 'failed', 'reason': '%s 不在游戏中。' % name})
+            return
+        if self.user in room.players:
+            self.send({'type': 'watch', 'result': 'failed', 'reason': '不能观战自己的游戏。'})
+            return
+        self.unwatch(data)
+        self.watching = room
+        room.add_watcher(self)
+        self.log.debug('%s 开始观战 %s 和 %s 的游戏。' % (self.user or self.id, room.red['name'], room.blue['name']))
+
+    def unwatch(self, data):
+        '''
+        退出观战。
+        '''
+        if self.watching:
+            self.watching.remove_watcher(self)
+            self.watching = None
+
+    def replay(self, data):
+        '''
+        查看对局记录。带 id 时返回这一局的记录，格式见 GameRecord.to_dict()；
+        带 name 时返回这个玩家最近的游戏列表，before 用来翻页。
+        '''
+        def found(rec):
+            if rec is None:
+                self.send({'type': 'replay', 'result': 'failed', 'reason': '没有这一局。'})
+            else:
+                self.send(dict(rec.to_dict(), type='replay', result='success'))
+
+        def listed(rows):
+            games = [{'id': gid, 'red': red, 'blue': blue, 'day': day} for gid, red, blue, day in rows]
+            self.send({'type': 'replay', 'result': 'list', 'games': games})
+
+        def failed(failure):
+            self.log.print(failure.getErrorMessage())
+            self.send({'type': 'replay', 'result': 'failed', 'reason': '系统出了一点问题。'})
+
+        if data.get('id'):
+            d = self.factory.records.get(data['id']).addCallback(found)
+        else:
+            d = self.factory.records.by_player(data.get('name') or self.user, WATCH_LIST, data.get('before'))
+            d.addCallback(listed)
+        d.addErrback(failed)
+        return d
+
+    def rank(self, data):
+        '''
+        查看排行榜：前 top 名（最多 LEADERBOARD_TOP 名）、用户 name（默认是自己）的名次
+        和前后各 around 个人、各个称号的人数。数据都在内存里，不查数据库。
+        top 和 around 小于 0 时按 0 算，不是整数时回复失败。
+        '''
+        board = self.factory.leaderboard
+        name = data.get('name') or self.user
+        try:
+            n = max(0, min(int(data.get('top', 10)), LEADERBOARD_TOP))
+            k = max(0, min(int(data.get('around', 5)), LEADERBOARD_TOP))
+        except (TypeError, ValueError):
+            self.send({'type': 'rank', 'result': 'failed', 'reason': '参数不对。'})
+            return
+        if not isinstance(name, str):
+            self.send({'type': 'rank', 'result': 'failed', 'reason': '参数不对。'})
+            return
+        self.send({'type': 'rank', 'result': 'success', 'total': len(board), 'top': board.top(n),
+                   'name': name, 'rank': board.rank(name), 'around': board.around(name, k),
+                   'titles': board.titles()})
 
     def cleangame(self):
         if self.user in self.factory.matched:
@@ -197,23 +495,62 @@ class BCServerProtocol(Protocol):
             self.factory.matched.pop(self.user)
             if v in self.factory.matched:
                 self.factory.matched.pop(v)
+            self.factory.close_room(self.user, v)
             return v
 
     def endgame(self, data):
         '''
-        一局游戏结束时，玩家发送'endgame'数据包，服务端更新用户积分
+        一局游戏结束时，玩家发送'endgame'数据包。
+        输赢和积分已经由服务端的棋盘判定，旧的客户端发来的积分不再使用。
+        '''
+        room = self.factory.games.get(self.user)
+        if room is not None and room.session.result is None:
+            session = room.session
+            now = reactor.seconds()
+            session.check_clock(now, 0)
+            if session.result is None and COLORS[session.board.turn] != room.color(self.user):
+                # 轮到对方时，这一方的客户端发出自己这一步就开始给对方计时，比服务端转发的时候早，
+                # 可能提前一个网络延迟判出对方超时。差得不多时等到服务端的时间到了再判定，
+                # 这段时间里对方走了棋就说明没有超时
+                wait = session.deadline(now, 0)
+                if wait <= TIMEOUT_SLACK:
+                    reactor.callLater(wait + CLOCK_EPSILON, self.finish_game, room)
+                    return
+        self.finish_game(room)
+
+    def finish_game(self, room):
+        '''
+        结束 endgame 的这一局：服务端的时钟（不多给时间）判定超时的按超时算，否则算作这一方中途退出。
         '''
+        if room is not None:
+            if not self.connected or self.factory.games.get(self.user) is not room:
+                # 等待的时候掉线了，或者这一局已经按别的原因结束了
+                return
+            session = room.session
+            session.check_clock(reactor.seconds(), 0)
+            if session.result is None:
+                # 游戏没有结束就退出，算作认输
+                session.end(room.color(self.user), 'abandon')
+                self.sendToMatched({'type': 'giveup'})
+            self.factory.update_game(room)
         v = self.cleangame()
         if v:
             self.log.print('%s 和 %s 的游戏正常结束。' % (self.user, v))
             qqmsg('%s 和 %s' % (self.user, v), '的游戏结束')
-        user = data['user']
-        if not user:
-            return
-        self.log.print('更新用户数据：', user)
-        sql = 'UPDATE user SET credit=?, title=? WHERE name=?'
-        value = (user['credit'], user['title'], user['name'])
-        excuteSQL(sql, value)
+
+    # 数据包类型 -> 处理函数，所有连接共用，不在这里的类型只有 GAME_PACKETS 会校验后转发
+    parse = {'hello': hello,
+             'signin': signin,
+             'signup': signup,
+             'match': match,
+             'unmatch': unmatch,
+             'endgame': endgame,
+             'watch': watch,
+             'unwatch': unwatch,
+             'replay': replay,
+             'rank': rank,
+             'ping': ping,
+             'pong': pong}
 
 
 class BCServerFactory(Factory):
@@ -223,17 +560,253 @@ class BCServerFactory(Factory):
         self.id = 0
         self.clients = {}
         self.matched = {}
-        self.wait = []
-        self.log = Logging(SERVER_LOG_PATH)
+        self.games = {}             # 玩家的用户名 -> 所在的对局房间，两个玩家指向同一个房间
+        self.outgoing = []          # 有数据等待发送的连接
+        self.flusher = None
+        self.wait = MatchQueue()
+        self.sweeper = task.LoopingCall(self.sweep)
+        self.cluster = None         # 多进程模式下和主进程的连接，见 cluster.py
+        self.db = get_db(USERDB)
+        self.dbworker = DBWorker(self.db, reactor)
+        self.log = get_logger(SERVER_LOG_PATH)
+        self.cache = UserCache(self.dbworker, self.log.print)
+        self.records = RecordStore(self.dbworker, self.log.print)
+        self.leaderboard = Leaderboard()
+        self.log_print = self.log.print                 # 所有连接共用的日志函数
+        self.wheel = TimingWheel(log=self.log_print)    # 所有连接的心跳和超时
+        self.check = self.heartbeat                     # 时间轮里所有连接共用这一个回调
+        self.referee = self.check_clock                 # 时间轮里所有对局共用这一个回调
+        registry.gauge('bc_connections', '当前的连接数', lambda: self.connection_num)
+        registry.gauge('bc_online_users', '当前登录的用户数', lambda: len(self.clients))
+        registry.gauge('bc_match_waiting', '正在等待匹配的用户数', lambda: len(self.wait))
+        registry.gauge('bc_players_in_game', '正在游戏中的用户数', lambda: len(self.matched))
+        registry.gauge('bc_active_games', '正在进行的游戏数', lambda: len(self.matched) // 2)
+        registry.gauge('bc_spectators', '正在观战的连接数', lambda: sum(len(r.watchers) for r in self.rooms()))
+        registry.gauge('bc_timer_entries', '时间轮中的定时任务数', lambda: len(self.wheel))
+        registry.gauge('bc_user_cache_size', '缓存中的用户数', lambda: len(self.cache))
+        registry.gauge('bc_leaderboard_users', '排行榜上的用户数', lambda: len(self.leaderboard))
         self.log.print('启动服务器。')
 
+    def startFactory(self):
+        self.dbworker.start()
+        self.cache.start(reactor)
+        self.records.start(reactor)
+        # 多进程时其他进程结算的积分只写进数据库，所以要定时重新读
+        self.leaderboard.start(reactor, self.dbworker, self.log_print, LEADERBOARD_REFRESH if self.cluster else 0)
+        journal.start(reactor)
+        self.sweeper.start(MATCH_SWEEP, now=False)
+        self.wheel.start(reactor)
+
+    def stopFactory(self):
+        if self.sweeper.running:
+            self.sweeper.stop()
+        self.wheel.stop()
+        self.leaderboard.stop()
+
     def buildProtocol(self, addr):
         return BCServerProtocol(self)
 
+    def schedule_flush(self, conn):
+        '''
+        conn 有数据要发送。所有连接共用一个 callLater(0)，在这一轮事件循环结束时统一发送。
+        '''
+        self.outgoing.append(conn)
+        if self.flusher is None:
+            self.flusher = reactor.callLater(0, self.flush)
+
+    def flush(self):
+        self.flusher = None
+        outgoing, self.outgoing = self.outgoing, []
+        for conn in outgoing:
+            conn.flush()
+
+    def heartbeat(self, conn):
+        '''
+        检查一个连接是否还活着，由时间轮调用。
+        握手过的客户端 HEARTBEAT_INTERVAL 秒没有发数据就给它发 ping，
+        HEARTBEAT_TIMEOUT 秒还没有任何数据就断开；
+        旧的客户端不会回复 ping，只在 IDLE_TIMEOUT 秒没有数据时断开。
+        断开用 abortConnection，之后照常走 connectionLost 的清理流程。
+        '''
+        if not conn.connected:
+            return
+        idle = self.wheel.now - conn.last_seen
+        if not conn.pingable:
+            if idle >= IDLE_TIMEOUT:
+                self.evict(conn, 'idle', idle)
+            else:
+                self.wheel.schedule(conn, IDLE_TIMEOUT - idle, self.check)
+        elif idle >= HEARTBEAT_TIMEOUT:
+            self.evict(conn, 'heartbeat', idle)
+        elif idle >= HEARTBEAT_INTERVAL:
+            conn.send({'type': 'ping'})
+            self.wheel.schedule(conn, min(HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT - idle), self.check)
+        else:
+            self.wheel.schedule(conn, HEARTBEAT_INTERVAL - idle, self.check)
+
+    def evict(self, conn, reason, idle):
+        self.log.print('用户 %s 已经 %d 秒没有响应，断开连接。' % (conn.user or conn.id, idle))
+        EVICTED.inc(reason)
+        conn.connected = False
+        conn.transport.abortConnection()
+
+    def check_clock(self, room):
+        '''
+        轮到的一方太久没有操作，由时间轮调用。
+        '''
+        room.session.check_clock(reactor.seconds())
+        self.update_game(room)
+
+    def update_game(self, room):
+        '''
+        一局游戏有了新的进展：结束了就结算积分，否则重新设置超时的定时器。
+        '''
+        session = room.session
+        if session.result is None:
+            self.wheel.schedule(room, session.deadline(reactor.seconds()), self.referee)
+        elif not session.settled:
+            self.settle(room)
+
+    def settle(self, room):
+        '''
+        按服务端判定的结果结算积分，并把新的积分发给玩家。
+        积分变化按开局时双方的积分计算，所以双方在不同进程上时两边算出的结果一样，
+        每个进程只结算本进程上的玩家。
+        '''
+        session = room.session
+        session.settled = True
+        self.wheel.cancel(room)
+        GAMES.inc(session.reason)
+        red, blue = room.players
+        result = '%s 获胜' % (red if session.winner == 'red' else blue) if session.winner else '和棋'
+        self.log.print('%s 和 %s 的游戏结束，%s（%s）。' % (red, blue, result, session.reason))
+        changes = session.credits(room.red.get('credit', 0), room.blue.get('credit', 0))
+        for name, delta in zip(room.players, changes):
+            info = self.cache.get(name)
+            if name not in self.clients or info is None:
+                continue
+            if delta:
+                credit = info['credit'] + delta
+                # 只更新缓存，由缓存定时批量写回数据库
+                self.cache.update({'name': name, 'credit': credit, 'title': get_title(credit)})
+                self.leaderboard.update(name, credit)
+            self.clients[name].send({'type': 'credit', 'user': dict(info), 'delta': delta})
+        # 双方在不同进程上时两边都会结算，只由红方所在的进程保存记录
+        if red in self.clients:
+            self.records.add(GameRecord.from_room(room, time.time()))
+
+    def sweep(self):
+        '''
+        定时给还在等待的用户重新匹配，等得越久能接受的积分差越大。
+        '''
+        for me, you in self.wait.sweep():
+            self.start_game(me, you)
+
+    def deliver(self, name, data):
+        '''
+        主进程转发来的数据包，发给本进程上的用户 name。
+        '''
+        to = self.clients.get(name)
+        room = self.games.get(name)
+        if room is None:
+            if to is not None:
+                to.send(data)
+            return
+        if data.get('type') in GAME_PACKETS:
+            # 对手所在的进程已经校验过，这里只是同步棋盘
+            you = room.players[1] if room.players[0] == name else room.players[0]
+            error = room.session.play(room.color(you), data, reactor.seconds(), trusted=True)
+            if error:
+                self.log.print('其他进程转发来的操作和本进程的棋盘不一致： %s %s' % (error, data))
+        room.relay(data, to)
+        self.update_game(room)
+
+    def join_game(self, name, you, init):
+        '''
+        主进程把本进程上的用户 name 和用户 you 匹配到了一起。
+        '''
+        if name not in self.clients:
+            # 匹配的时候已经掉线了，直接告诉对手
+            self.cluster.route(you, {'type': 'giveup'})
+            return
+        self.matched[name] = you
+        self.log.print('用户 %s 和 用户 %s 匹配成功。' % (name, you))
+        # 两个玩家都在本进程时，第二个人加入的是同一个房间
+        room = self.games.get(you)
+        if room is None or name not in room.players:
+            red, blue = (init['me'], init['you']) if init['color'] == 'red' else (init['you'], init['me'])
+            room = GameRoom(red, blue, init['chess'], init['turn'], reactor.seconds())
+        self.games[name] = room
+        self.update_game(room)
+        self.clients[name].send(init)
+
+    def rooms(self):
+        '''
+        所有正在进行的游戏的房间，每个房间只出现一次。
+        '''
+        return [room for name, room in self.games.items() if name == room.red['name'] or room.red['name'] not in self.games]
+
+    def close_room(self, *names):
+        '''
+        游戏结束，关闭玩家所在的房间。
+        '''
+        for name in names:
+            room = self.games.pop(name, None)
+            if room is not None and not any(n in self.games for n in room.players):
+                self.wheel.cancel(room)
+                room.close()
+
+    def start_game(self, me, you):
+        '''
+        两个用户匹配成功，开始一局游戏。me 执红先走。
+        '''
+        self.matched[me] = you
+        self.matched[you] = me
+        self.log.print('用户 %s 和 用户 %s 匹配成功。' % (me, you))
+        qqmsg('%s 和 %s' % (me, you), '匹配成功')
+
+        def start(users):
+            # 查询用户信息的时候，可能有一方已经掉线了
+            if self.matched.get(me) != you:
+                return
+            my_user, your_user = users
+            chess = random_chess()
+            data1 = {'type': 'init', 'chess': chess, 'turn': 'red', 'color': 'red', 'me': my_user, 'you': your_user}
+            data2 = {'type': 'init', 'chess': chess, 'turn': 'red', 'color': 'blue', 'me': your_user, 'you': my_user}
+            room = self.games[me] = self.games[you] = GameRoom(my_user, your_user, chess, 'red', reactor.seconds())
+            self.update_game(room)
+            self.clients[me].send(data1)
+            self.clients[you].send(data2)
+
+        def failed(failure):
+            self.log.print(failure.getErrorMessage())
+            return [{'name': n, 'credit': 0, 'title': '平民'} for n in (me, you)]
+
+        # 在线的用户都在缓存里，这里一般不会查询数据库
+        d = defer.gatherResults([self.cache.load(me), self.cache.load(you)], consumeErrors=True)
+        d.addErrback(failed)
+        d.addCallback(start)
+        return d
+
 
-def runserver(port):
-    endpoint = TCP4ServerEndpoint(reactor, port)
-    endpoint.listen(BCServerFactory())
+def runserver(port, workers=1, metrics_port=METRICS_PORT, backend='twisted'):
+    '''
+    启动服务器。workers 大于 1 时启动多个进程共用同一个端口，见 cluster.py。
+    metrics_port 不为 0 时，在本机的这个端口上提供运行指标，见 metrics.py。
+    backend 为 'asyncio' 时用 asyncio streams 接受连接，见 aioserver.py。
+    '''
+    if workers > 1:
+        from .cluster import runmaster
+        runmaster(port, workers, metrics_port, backend)
+        return
+    if backend == 'asyncio':
+        from . import aioserver
+        reactor.callWhenRunning(aioserver.listen, BCServerFactory(), port)
+    else:
+        endpoint = TCP4ServerEndpoint(reactor, port)
+        endpoint.listen(BCServerFactory())
+    if metrics_port:
+        metrics.listen(reactor, metrics_port)
     reactor.run()
 
 
@@ -241,20 +814,7 @@ def createDatabase():
     if not os.path.exists(USERDB):
         if not os.path.exists(DATABASE_PATH):
             os.makedirs(DATABASE_PATH)
-        sql = '''
-                CREATE TABLE USER
-                (
-                NAME VARCHAR(20) PRIMARY KEY,
-                PASSWD VARCHAR(20) NOT NULL,
-                CREDIT INT NOT NULL,
-                TITLE VARCHAR(8)
-                );
-                '''
-        excuteSQL(sql)
-        sql = "INSERT INTO USER(NAME, PASSWD, CREDIT, TITLE) VALUES(?, ?, ?, ?)"
-        excuteSQL(sql, ('xinxin', '2333', 2000, '男爵'))
-        sql = "INSERT INTO USER(NAME, PASSWD, CREDIT, TITLE) VALUES(?, ?, ?, ?)"
-        excuteSQL(sql, ('memory', '2333', 2000, '男爵'))
+        create_tables(get_db(USERDB))
 
 
 if __name__ == '__main__':
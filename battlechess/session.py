@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: session
+@author: Memory&Xinxin
+@date: 2019/12/19
+@document: 服务端的一局游戏：校验双方的操作，计时，并由服务端判定输赢和积分
+'''
+
+from . import rating
+from .rules import Board, COLORS, ROW, RED, BLUE, sq
+from .configs import MAX_TIME, MAX_TIMEOUT, MAX_NOEAT, MIN_GIVEUP, TIMEOUT_SLACK
+
+'''
+服务端保存发牌时的棋盘，每收到一个翻棋、走棋或认输的数据包，
+先检查是不是轮到这一方、这一步是否符合规则，合法才转发并更新棋盘。
+输赢按客户端同样的规则在服务端判定，积分也由服务端按 Elo 计算（见 rating.py），
+客户端在 endgame 里发来的积分不再使用。
+
+超时和客户端一样计算：轮到的一方每 MAX_TIME 秒没有操作计一次超时，累计 MAX_TIMEOUT 次判输。
+服务端的计时从转发上一步开始，比客户端收到这一步要早，所以判超时的时候多给 TIMEOUT_SLACK 秒。
+等着对方走的一方比服务端更早开始给对方计时，它发来 endgame 说对方超时的时候服务端可能还差一点，
+这时等到服务端自己的时间到了（不多给时间）再判定，见 server.endgame。
+'''
+
+
+class GameSession(object):
+    '''
+    一局游戏的状态。play() 返回错误原因，合法时返回 None。
+    '''
+    def __init__(self, chess, turn='red', now=0):
+        self.board = Board.from_chess(chess, turn, MAX_NOEAT)
+        self.timeouts = [0, 0]      # 双方累计的超时次数
+        self.since = now            # 轮到当前一方的时间
+        self.reason = None          # 结束的原因：normal、giveup、timeout、disconnect、abandon
+        self.settled = False        # 是否已经结算了积分
+
+    @property
+    def result(self):
+        return self.board.result
+
+    @property
+    def winner(self):
+        return self.board.winner
+
+    def play(self, color, data, now, trusted=False):
+        '''
+        color 一方发来一个游戏数据包。
+        trusted 为 True 时是其他进程已经校验过的数据包，认输不受步数限制。
+        '''
+        board = self.board
+        typ = data.get('type')
+        self.check_clock(now)
+        if board.result is not None:
+            return '游戏已经结束。'
+        me = COLORS.index(color)
+        if typ == 'giveup':
+            if not trusted and board.step < MIN_GIVEUP:
+                return '%d 步以后才可以认输。' % MIN_GIVEUP
+            self.end(color, 'giveup')
+            return None
+        if me != board.turn:
+            return '还没有轮到你。'
+        try:
+            s = square(data['from'])
+            t = square(data['to']) if typ == 'move' else None
+        except (KeyError, TypeError, ValueError):
+            return '数据包的格式不对。'
+        if typ == 'open':
+            if not board.can_open(s):
+                return '这个位置不能翻棋。'
+            board.open(s)
+        elif typ == 'move':
+            if not board.can_move(s, t):
+                return '这一步不能这样走。'
+            board.move(s, t)
+        else:
+            return '未知的操作。'
+        # 这一步之前超时的次数累计下来，和客户端一样
+        self.timeouts[me] += self.late(now)
+        self.since = now
+        if board.result is not None:
+            self.reason = 'normal'
+        return None
+
+    def check_clock(self, now, slack=TIMEOUT_SLACK):
+        '''
+        计算轮到的一方到 now 为止超时了几次，够 MAX_TIMEOUT 次就判输。
+        '''
+        if self.board.result is not None:
+            return
+        turn = self.board.turn
+        if self.timeouts[turn] + self.late(now, slack) >= MAX_TIMEOUT:
+            self.timeouts[turn] = MAX_TIMEOUT
+            self.end(COLORS[turn], 'timeout')
+
+    def late(self, now, slack=TIMEOUT_SLACK):
+        '''
+        轮到的一方到 now 为止这一步超时了几次。
+        '''
+        return int(max(0, now - self.since - slack) // MAX_TIME)
+
+    def deadline(self, now, slack=TIMEOUT_SLACK):
+        '''
+        从 now 开始，轮到的一方还有多少秒会因为超时判输。
+        '''
+        return self.since + (MAX_TIMEOUT - self.timeouts[self.board.turn]) * MAX_TIME + slack - now
+
+    def end(self, loser, reason):
+        '''
+        loser 一方认输、超时或者掉线，已经结束的游戏不再改变结果。
+        '''
+        if self.board.result is None:
+            self.board.resign(COLORS.index(loser))
+            self.reason = reason
+
+    def credits(self, red, blue):
+        '''
+        开局时红方积分 red、蓝方积分 blue，返回双方这局游戏的积分变化 (红方, 蓝方)。
+        掉线输掉的目前不扣分。
+        '''
+        result = self.board.result
+        if result is None:
+            return 0, 0
+        score = 1 if result == RED else 0 if result == BLUE else 0.5
+        return rating.deltas(red, blue, score, self.reason == 'disconnect')
+
+
+def square(p):
+    '''
+    数据包里的位置 [x, y] 转成格子的编号。
+    '''
+    x, y = p
+    if not (isinstance(x, int) and isinstance(y, int) and 0 <= x < ROW and 0 <= y < ROW):
+        raise ValueError(p)
+    return sq(x, y)
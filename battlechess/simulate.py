@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: simulate
+@author: Memory&Xinxin
+@date: 2019/12/25
+@document: 多进程自我对弈：不用 pygame 下大量的对局，统计先手胜率、和棋率和对局长度
+'''
+
+import sys
+import json
+import time
+import random
+import argparse
+from multiprocessing import Pool, cpu_count
+from .rules import Board, COLORS, DRAW, EMPTY, MAX_NOEAT, deal
+from .ai import VALUE, search
+
+'''
+发牌用 rules.deal()（和 utils.random_chess() 一样），规则用 rules.Board（和客户端、服务端一样），
+包括吃子、国王和刺客的例外、MAX_NOEAT 步和棋、双方只剩一个棋子时比大小。
+没有棋可走的一方只能等着超时，这里直接算这一方输，和 ai.py 一样。
+
+对局分成每 CHUNK 局一块，由进程池里的进程一块一块地下，第 k 块的随机数种子是 seed * 1000003 + k，
+同样的种子和参数下的结果完全一样。每块下完把每局的结果送回主进程，
+主进程一边汇总统计，一边把每局的结果按行写成 json 追加到文件里，不需要把所有结果都放在内存里。
+
+走法的策略：random 随机走；greedy 能吃子就吃分值最高的，否则随机走；
+ai 用 ai.search() 每一步模拟 --iterations 局，很慢，只适合少量的对局。
+'''
+
+CHUNK = 200                 # 每块多少局
+BUCKET = 20                 # 对局长度的分布按多少步一组
+ENDS = ('capture', 'duel', 'noeat', 'stuck')    # 吃光了、只剩一个棋子比大小、和棋、没有棋可走
+
+
+def random_policy(board, acts, rng, options):
+    return rng.choice(acts)
+
+
+def greedy_policy(board, acts, rng, options):
+    '''
+    能吃子时吃分值最高的，否则随机走。
+    '''
+    at = board.at
+    best, value = None, 0
+    for act in acts:
+        if len(act) == 2:
+            p = at[act[1]]
+            if p != EMPTY and VALUE[p % 6] > value:
+                best, value = act, VALUE[p % 6]
+    return best or rng.choice(acts)
+
+
+def ai_policy(board, acts, rng, options):
+    return search(board, float('inf'), options['iterations'], rng.random())[0]
+
+
+POLICIES = {'random': random_policy, 'greedy': greedy_policy, 'ai': ai_policy}
+
+
+def play(rng, policies, options):
+    '''
+    下一局，先手随机。
+    @return: (先手的颜色, 结果, 步数, 结束的原因)，结果是 'first'、'second' 或者和棋时的 None
+    '''
+    first = rng.randrange(2)
+    board = Board.from_chess(deal(rng), COLORS[first], options['max_noeat'])
+    end = None
+    while board.result is None:
+        acts = board.actions()
+        if not acts:
+            board.resign(board.turn)
+            end = 'stuck'
+            break
+        policy = policies[board.turn != first]
+        board.apply(policy(board, acts, rng, options))
+    if end is None:
+        if board.result == DRAW:
+            end = 'noeat'
+        elif min(board.left) == 0:
+            end = 'capture'
+        else:
+            end = 'duel'
+    winner = None if board.result == DRAW else 'first' if board.result == first else 'second'
+    return COLORS[first], winner, board.step, end
+
+
+def run_chunk(task):
+    '''
+    在进程池里下第 k 块的对局。
+    '''
+    k, n, seed, options = task
+    rng = random.Random(seed * 1000003 + k)
+    policies = (POLICIES[options['first']], POLICIES[options['second']])
+    return k, [play(rng, policies, options) for i in range(n)]
+
+
+class Stats(object):
+    '''
+    汇总所有对局的结果。
+    '''
+    def __init__(self):
+        self.games = 0
+        self.plies = 0
+        self.wins = {'first': 0, 'second': 0, None: 0}
+        self.ends = dict.fromkeys(ENDS, 0)
+        self.lengths = {}           # 步数 -> 局数
+
+    def add(self, first, winner, plies, end):
+        self.games += 1
+        self.plies += plies
+        self.wins[winner] += 1
+        self.ends[end] += 1
+        self.lengths[plies] = self.lengths.get(plies, 0) + 1
+
+    def percentile(self, q):
+        k = q * (self.games - 1)
+        for plies in sorted(self.lengths):
+            k -= self.lengths[plies]
+            if k < 0:
+                return plies
+        return max(self.lengths) if self.lengths else 0
+
+    def report(self, seconds):
+        games = self.games or 1
+        buckets = {}
+        for plies, n in self.lengths.items():
+            low = plies // BUCKET * BUCKET
+            buckets[low] = buckets.get(low, 0) + n
+        return {
+            'games': self.games,
+            'seconds': round(seconds, 2),
+            'games_per_sec': round(self.games / seconds, 1) if seconds else 0,
+            'plies_per_sec': round(self.plies / seconds) if seconds else 0,
+            'first_win_rate': round(self.wins['first'] / games, 4),
+            'second_win_rate': round(self.wins['second'] / games, 4),
+            'draw_rate': round(self.wins[None] / games, 4),
+            'ends': self.ends,
+            'length': {
+                'mean': round(self.plies / games, 1),
+                'min': min(self.lengths) if self.lengths else 0,
+                'p10': self.percentile(0.1),
+                'p50': self.percentile(0.5),
+                'p90': self.percentile(0.9),
+                'p99': self.percentile(0.99),
+                'max': max(self.lengths) if self.lengths else 0,
+                'histogram': dict(('%d-%d' % (low, low + BUCKET - 1), buckets[low]) for low in sorted(buckets)),
+            },
+        }
+
+
+def simulate(games, jobs, seed, options, output=None):
+    '''
+    下 games 局，结果逐行写入 output（文件对象），返回统计结果。
+    '''
+    tasks = [(k, min(CHUNK, games - k * CHUNK), seed, options) for k in range((games + CHUNK - 1) // CHUNK)]
+    stats = Stats()
+    start = time.time()
+    pool = Pool(jobs) if jobs > 1 else None
+    try:
+        results = pool.imap_unordered(run_chunk, tasks) if pool else map(run_chunk, tasks)
+        for k, chunk in results:
+            lines = []
+            for i, result in enumerate(chunk):
+                stats.add(*result)
+                if output is not None:
+                    first, winner, plies, end = result
+                    lines.append(json.dumps({'id': k * CHUNK + i, 'first': first, 'winner': winner,
+                                             'plies': plies, 'end': end}))
+            if lines:
+                output.write('\n'.join(lines) + '\n')
+    finally:
+        if pool is not None:
+            pool.terminate()
+    report = stats.report(time.time() - start)
+    report.update({'jobs': jobs, 'seed': seed, 'first': options['first'], 'second': options['second']})
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m battlechess.simulate', description='多进程自我对弈，统计先手胜率、和棋率和对局长度')
+    parser.add_argument('-n', '--games', type=int, default=10000, help='一共下几局')
+    parser.add_argument('-j', '--jobs', type=int, default=cpu_count(), help='用几个进程，默认是 CPU 的核数')
+    parser.add_argument('--first', choices=sorted(POLICIES), default='random', help='先手的策略')
+    parser.add_argument('--second', choices=sorted(POLICIES), default=None, help='后手的策略，默认和先手一样')
+    parser.add_argument('--iterations', type=int, default=200, help='ai 策略每一步模拟几局')
+    parser.add_argument('--max-noeat', type=int, default=MAX_NOEAT, help='几步不吃子或者翻棋判和棋')
+    parser.add_argument('--seed', type=int, default=None, help='随机数种子，默认随机选一个，会输出在结果里')
+    parser.add_argument('-o', '--output', default=None, help='每局的结果按行写成 json 的文件')
+    args = parser.parse_args(argv)
+
+    seed = args.seed if args.seed is not None else random.randrange(1 << 31)
+    options = {'first': args.first, 'second': args.second or args.first,
+               'iterations': args.iterations, 'max_noeat': args.max_noeat}
+    if args.output:
+        with open(args.output, 'w') as f:
+            report = simulate(args.games, args.jobs, seed, options, f)
+    else:
+        report = simulate(args.games, args.jobs, seed, options)
+    sys.stdout.write(json.dumps(report, indent=2) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: timingwheel
+@author: Memory&Xinxin
+@date: 2019/12/16
+@document: 哈希时间轮，用一个定时器管理大量连接的超时
+'''
+
+import math
+from twisted.internet import task
+
+'''
+每个连接一个 callLater 的话，十万个连接就是十万个 DelayedCall，
+每次重新设置超时都要在 reactor 的堆里删除和插入。
+时间轮把时间分成一格一格（tick），一圈有 slots 格，每格是一个 dict。
+到期时间在 n 个 tick 以后的任务放在 (当前格 + n) % slots 这一格，
+超过一圈的记下还要转几圈。只有一个 LoopingCall 每个 tick 转动一格，
+处理这一格里到期的任务，加入和取消都是 O(1)。
+reactor 被卡住时 LoopingCall 错过的几次不会补上，所以每次转动时按 reactor
+的时间算出从开始到现在应该转了多少格，把落下的格一起转完，任务不会被推迟。
+'''
+
+
+class TimingWheel(object):
+    '''
+    哈希时间轮。同一个 key 同时只有一个任务，重复 schedule 会替换之前的任务。
+    '''
+    def __init__(self, tick=1, slots=64, clock=None, log=None):
+        self.tick = tick                        # 每一格的时间（秒）
+        self.wheel = [{} for i in range(slots)] # 每一格：key -> [还要转几圈, 回调]
+        self.where = {}                         # key -> 所在的格
+        self.cursor = 0                         # 当前指向的格
+        self.clock = clock
+        self.now = 0                            # 最近一次转动的时间，给连接记录活跃时间用
+        self.origin = 0                         # 开始转动的时间
+        self.turned = 0                         # 开始以后一共转了多少格
+        self.loop = None
+        self.log = log
+
+    def __len__(self):
+        return len(self.where)
+
+    def __contains__(self, key):
+        return key in self.where
+
+    def start(self, reactor):
+        '''
+        开始转动，reactor 关闭时自动停止。
+        '''
+        if self.loop is not None:
+            return
+        self.clock = self.clock or reactor
+        self.now = self.origin = self.clock.seconds()
+        self.turned = 0
+        self.loop = task.LoopingCall(self.advance)
+        self.loop.clock = self.clock
+        self.loop.start(self.tick, now=False)
+
+    def stop(self):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        self.loop = None
+
+    def schedule(self, key, delay, callback):
+        '''
+        delay 秒以后调用 callback(key)，精度是一个 tick。
+        '''
+        self.cancel(key)
+        ticks = max(1, int(math.ceil(delay / self.tick)))
+        slot = (self.cursor + ticks) % len(self.wheel)
+        self.wheel[slot][key] = [(ticks - 1) // len(self.wheel), callback]
+        self.where[key] = slot
+
+    def cancel(self, key):
+        slot = self.where.pop(key, None)
+        if slot is not None:
+            del self.wheel[slot][key]
+
+    def advance(self):
+        '''
+        转动到当前时间，调用经过的格里到期的回调。
+        没有时钟时只转动一格。
+        '''
+        steps = 1
+        if self.clock is not None:
+            self.now = self.clock.seconds()
+            # 加一点余量，防止浮点误差让刚好到点的一格算成还没到
+            steps = max(1, int((self.now - self.origin) / self.tick + 1e-6) - self.turned)
+        self.turned += steps
+        due = []
+        for i in range(steps):
+            self.cursor = (self.cursor + 1) % len(self.wheel)
+            bucket = self.wheel[self.cursor]
+            ready = []
+            for key, entry in bucket.items():
+                if entry[0]:
+                    entry[0] -= 1
+                else:
+                    ready.append((key, entry[1]))
+            for key, callback in ready:
+                del bucket[key]
+                del self.where[key]
+            due += ready
+        # 先全部移出再回调，回调里可以重新 schedule 同一个 key
+        for key, callback in due:
+            try:
+                callback(key)
+            except Exception as e:
+                # 一个回调出错不能影响其他的任务，也不能让 LoopingCall 停下来
+                if self.log:
+                    self.log('时间轮的回调出错： %r' % e)
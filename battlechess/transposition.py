@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: transposition
+@author: Memory&Xinxin
+@date: 2019/12/23
+@document: 置换表：按局面的 Zobrist 哈希缓存搜索和分析的结果，大小固定，满了按深度和搜索的代数替换
+'''
+
+'''
+表有 2 ** bits 个槽，哈希为 h 的局面放在第 h & (2 ** bits - 1) 个槽里，槽里同时存完整的哈希，
+取的时候哈希对不上就当作没有，所以两个局面共用一个槽时不会取错。
+每个槽只存一项，新的一项和槽里另一个局面冲突时：槽里的是以前的搜索留下的，
+或者新的一项深度不比它小，就替换掉它，否则丢掉新的。同一个局面总是用新的一项覆盖。
+深度由调用的人决定，比如搜索的深度或者模拟的次数，越大表示这一项越值得留着。
+每次开始新的一次搜索时调用 new_search()，上一次搜索留下的项会先被替换，不需要清空整个表；
+这一次搜索里取到过的项也算这一次的。
+槽用几个并列的列表存，不为每一项创建对象。同一个进程里的搜索和分析可以共用一个表。
+'''
+
+
+class TranspositionTable(object):
+    '''
+    大小固定的置换表。get() 和 put() 的 key 是 rules.Board.hash。
+    '''
+    def __init__(self, bits=18):
+        self.size = 1 << bits
+        self.mask = self.size - 1
+        self.keys = [None] * self.size      # 每个槽里局面的哈希，None 表示空
+        self.values = [None] * self.size    # 每个槽里存的结果
+        self.depths = [0] * self.size       # 每个槽里的深度
+        self.ages = [0] * self.size         # 每个槽是第几次搜索存的
+        self.age = 0                        # 现在是第几次搜索
+        self.used = 0                       # 用了多少个槽
+        self.reset_stats()
+
+    def __len__(self):
+        return self.used
+
+    def __contains__(self, key):
+        return self.keys[key & self.mask] == key
+
+    def reset_stats(self):
+        self.probes = 0         # 查询的次数
+        self.hits = 0           # 查到的次数
+        self.stores = 0         # 存进去的次数
+        self.replaced = 0       # 替换掉另一个局面的次数
+        self.rejected = 0       # 因为槽里的项更深而没有存的次数
+
+    def get(self, key, default=None):
+        '''
+        取出局面 key 的结果，没有时返回 default。
+        '''
+        self.probes += 1
+        i = key & self.mask
+        if self.keys[i] != key:
+            return default
+        self.hits += 1
+        self.ages[i] = self.age
+        return self.values[i]
+
+    def put(self, key, value, depth=0):
+        '''
+        存入局面 key 的结果，返回是否存进去了。
+        '''
+        i = key & self.mask
+        old = self.keys[i]
+        if old is None:
+            self.used += 1
+        elif old != key:
+            if self.ages[i] == self.age and depth < self.depths[i]:
+                self.rejected += 1
+                return False
+            self.replaced += 1
+        self.keys[i] = key
+        self.values[i] = value
+        self.depths[i] = depth
+        self.ages[i] = self.age
+        self.stores += 1
+        return True
+
+    def new_search(self):
+        '''
+        开始新的一次搜索，以前存的项都可以被替换。
+        '''
+        self.age += 1
+
+    def clear(self):
+        self.keys = [None] * self.size
+        self.values = [None] * self.size
+        self.depths = [0] * self.size
+        self.ages = [0] * self.size
+        self.age = 0
+        self.used = 0
+        self.reset_stats()
+
+    @property
+    def hit_rate(self):
+        return self.hits / self.probes if self.probes else 0.0
+
+    def stats(self):
+        '''
+        命中率等统计，可以直接转成 json。
+        '''
+        return {'size': self.size, 'used': self.used, 'fill': round(self.used / self.size, 4),
+                'probes': self.probes, 'hits': self.hits, 'hit_rate': round(self.hit_rate, 4),
+                'stores': self.stores, 'replaced': self.replaced, 'rejected': self.rejected}
@@ -9,12 +9,17 @@
 
 import os
 import json
+import time
+import atexit
 import pygame
-import sqlite3
+import threading
+from collections import deque
 from random import choice, randint
 from datetime import datetime
 from twisted.internet import task
 from .configs import *
+from .codec import dict2bin, encode_packet, PacketDecoder, FrameError
+from .rules import deal
 
 
 _game = None
@@ -39,124 +44,224 @@ def uninstall_game():
     _game = None
 
 
+class EventJournal(object):
+    '''
+    给 nonebot 的消息和在线人数的日志。
+    登录、匹配、掉线都很频繁，如果每次都打开文件写一行，人多的时候开销很大，
+    所以先存在内存里，由 reactor 的定时器每隔一段时间批量写入。
+    log_qq.txt 仍然是每行一个json，online.txt 仍然只有一个数字，
+    nonebot 那边读取的方式不用改。
+    '''
+    def __init__(self, login_log=LOGIN_LOG, online_path=ONLINE_PATH, interval=JOURNAL_INTERVAL):
+        self.login_log = login_log
+        self.online_path = online_path
+        self.interval = interval        # 写入文件的间隔，单位是秒
+        self.events = []                # 还没写入的消息
+        self.online = None              # 最新的在线人数，None 表示没有变化
+        # online_path 为 None 时不写在线人数，多进程模式下由主进程统计
+        self.loop = None
+        atexit.register(self.flush)
+
+    def start(self, reactor):
+        '''
+        开始定时写入，reactor 关闭前再写入一次。
+        '''
+        if self.loop is not None:
+            return
+        self.loop = task.LoopingCall(self.flush)
+        self.loop.clock = reactor
+        self.loop.start(self.interval, now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        self.loop = None
+        self.flush()
+
+    def add(self, name, op):
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        msg = {'name': name, 'op': op, 'time': now}
+        self.events.append(json.dumps(msg) + '\n')
+
+    def set_online(self, num):
+        self.online = num
+
+    def flush(self):
+        '''
+        把积攒的消息一次写入，在线人数只写最新的一个。
+        '''
+        if self.events:
+            events, self.events = self.events, []
+            try:
+                with open(self.login_log, 'a+') as f:
+                    f.write(''.join(events))
+            except OSError:
+                pass
+        if self.online is not None and self.online_path:
+            num, self.online = self.online, None
+            try:
+                with open(self.online_path, 'w', encoding='utf-8') as f:
+                    f.write(str(num))
+            except OSError:
+                pass
+
+
+journal = EventJournal()
+
+
 def qqmsg(name, op):
     '''
     为了和另nonebot交互，可以把服务器的一些日志发送到QQ上，
     就在服务端调用这个函数，把一些消息写到文件中，再由nonebot
-    读取并发送到QQ。
+    读取并发送到QQ。消息会先放进 journal，稍后批量写入。
     '''
-    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    msg = {'name': name, 'op': op, 'time': now}
-    msg = json.dumps(msg) + '\n'
-    with open(LOGIN_LOG, 'a+') as f:
-        f.write(msg)
+    journal.add(name, op)
 
 
 def write_online(num):
-    try:
-        with open(ONLINE_PATH, 'w', encoding='utf-8') as f:
-            f.write(str(num))
-    except:
-        pass
+    '''
+    更新在线人数，稍后由 journal 写入文件。
+    '''
+    journal.set_online(num)
+
+
+# 日志的级别
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
 
 
 class Logging(object):
-    '''用来打印日志的类'''
-    def __init__(self, path=None):
+    '''
+    用来打印日志的类。
+    print() 只把格式化好的一行放进内存里的环形缓冲区，
+    由后台线程定时把缓冲区里的日志一次性打印并写入文件，
+    日志文件一直打开着，日期变了就换一个新文件，
+    所以游戏过程中打日志不会有任何文件IO。
+    缓冲区满了时丢掉最旧的日志。
+    同一个路径的日志最好用 get_logger() 获取，整个进程共用一个。
+    '''
+    def __init__(self, path=None, level=LOG_LEVEL, interval=LOG_FLUSH_INTERVAL, size=LOG_BUFFER_SIZE):
         self.path = path
-        self.output = True
-        if not os.path.exists(path):
+        self.output = True                  # 是否写入文件
+        self.level = level                  # 低于这个级别的日志不记录
+        self.interval = interval            # 写入文件的间隔，单位是秒
+        self.buffer = deque(maxlen=size)    # 还没写入的日志
+        self.dropped = 0                    # 因为缓冲区满了丢掉的日志数
+        self.file = None                    # 当前打开的日志文件
+        self.file_day = None                # 当前日志文件的日期
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.closed = False
+        self._sec = None                    # 缓存时间戳，同一秒内不用重复格式化
+        self._now = ''
+        if path and not os.path.exists(path):
             os.makedirs(path)
+        atexit.register(self.close)
 
-    def print(self, *args):
+    def print(self, *args, **kwargs):
         '''
-        打印日志，并写入到文件中。
+        打印日志。可以用 level=DEBUG 等指定级别，默认是 INFO。
         '''
-        # 构造日志格式
-        datenow = datetime.now()
-        now = datenow.strftime('%Y-%m-%d %H:%M:%S : ')
-        log = [str(s) for s in args]
-        logstr = now + ' '.join(log)
-        # 打印
-        print(logstr)
-        if not self.path or not self.output:
+        if kwargs.get('level', INFO) < self.level:
             return
-        # 写入到文件中
-        log_file = datenow.strftime('log_%Y_%m_%d.txt')
-        log_file = os.path.join(self.path, log_file)
-        with open(log_file, 'a+') as f:
-            f.write(logstr+'\n')
-
-
-def excuteSQL(sql, value=None, db=USERDB):
-    '''
-    执行一条SQL语句，如果是select，就返回查询结果，如果出错返回None。
-    '''
-    sql = sql.upper()
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-    result = []
-    try:
-        if value:
-            cursor.execute(sql, value)
-        else:
-            cursor.execute(sql)
-        if sql.startswith('SELECT'):
-            result = cursor.fetchall()
-    except:
-        Logging(SERVER_LOG_PATH).print('数据库操作失败： %s' % sql)
-        return None
-    finally:
-        cursor.close()
-        conn.commit()
-        conn.close()
-        return result
-
-
-def spilt_data(data):
-    '''
-    用来将服务器传来的数据包分开。
-    默认客户端和服务器端每次传送的数据都是
-    一个标准的json字符串加上换行符，因此只要
-    根据换行符进行数据分离就可以了。
-    '''
-    jsons = []
-    try:
-        lines = data.decode('utf-8').split('\n')
-    except:
-        Logging(SERVER_LOG_PATH).print('非法内容： ', data)
-    for line in lines:
-        line = line.strip()
-        if line == '':
-            continue
-        try:
-            # 防止传来的不是json数据导致解析出错
-            j = json.loads(line)
-            jsons.append(j)
-        except:
-            Logging(SERVER_LOG_PATH).print('json数据解析失败，内容为： %s' % line)
+        # 构造日志格式
+        sec = int(time.time())
+        if sec != self._sec:
+            self._sec = sec
+            self._now = datetime.fromtimestamp(sec).strftime('%Y-%m-%d %H:%M:%S : ')
+        logstr = self._now + ' '.join([str(s) for s in args])
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append(logstr)
+        if self.thread is None and not self.closed:
+            self.thread = threading.Thread(target=self.run, name='logging')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def debug(self, *args):
+        self.print(*args, level=DEBUG)
+
+    def warning(self, *args):
+        self.print(*args, level=WARNING)
+
+    def run(self):
+        '''
+        后台线程，定时写入日志。
+        '''
+        while not self.closed:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
 
-    return jsons
+    def flush(self):
+        '''
+        把缓冲区里的日志打印出来并写入到文件中。
+        '''
+        with self.lock:
+            logs = []
+            while self.buffer:
+                logs.append(self.buffer.popleft())
+            if self.dropped:
+                logs.append('%s日志太多，丢掉了 %d 条。' % (self._now, self.dropped))
+                self.dropped = 0
+            if not logs:
+                return
+            # 打印
+            print('\n'.join(logs))
+            if not self.path or not self.output:
+                return
+            # 按日期写入到对应的文件中，日志的前10个字符就是日期
+            start = 0
+            for i in range(1, len(logs) + 1):
+                if i < len(logs) and logs[i][:10] == logs[start][:10]:
+                    continue
+                f = self.open_file(logs[start][:10])
+                f.write('\n'.join(logs[start:i]) + '\n')
+                start = i
+            self.file.flush()
+
+    def open_file(self, day):
+        '''
+        返回日期 day 的日志文件，日期变了就关掉旧文件，打开新文件。
+        '''
+        if day != self.file_day:
+            if self.file:
+                self.file.close()
+            log_file = 'log_%s.txt' % day.replace('-', '_')
+            self.file = open(os.path.join(self.path, log_file), 'a+')
+            self.file_day = day
+        return self.file
+
+    def close(self):
+        '''
+        停止后台线程，写入剩下的日志并关闭文件。
+        '''
+        if self.closed:
+            return
+        self.closed = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(1)
+        self.flush()
+        if self.file:
+            self.file.close()
+            self.file = None
 
 
-def dict2bin(data):
-    '''
-    将字典数据转换成字符串，然后加上一个换行符，
-    再转换成二进制数据。
-    '''
-    strdata = json.dumps(data)
-    strdata = strdata + '\n'
-    return strdata.encode('utf-8')
+_loggers = {}
 
 
-def get_user(name):
+def get_logger(path=None):
     '''
-    查询一个用户名的信息。
+    返回路径对应的共享日志对象。
     '''
-    sql = 'SELECT credit, title FROM user WHERE name=?'
-    value = (name, )
-    result = excuteSQL(sql, value)[0]
-    return {'name': name, 'credit': result[0], 'title': result[1]}
+    if path not in _loggers:
+        _loggers[path] = Logging(path)
+    return _loggers[path]
 
 
 all_surface = {}
@@ -220,24 +325,9 @@ def surface_clip(src, row, col, mode='row'):
 
 def random_chess():
     '''
-    随机生成一盘棋局。
-    '''
-    CHESS_NUM = [2, 2, 4, 4, 8, 16]
-    all_pos = [(i, j) for i in range(6) for j in range(6)]
-    chess = [[0 for i in range(6)] for j in range(6)]
-    level = 0
-    for i in range(36):
-        x, y = choice(all_pos)
-        all_pos.remove((x, y))
-        if i % 2 == 0:
-            chess[x][y] = ['red', level]
-        else:
-            chess[x][y] = ['blue', level]
-
-        CHESS_NUM[level] -= 1
-        if CHESS_NUM[level] <= 0:
-            level += 1
-    return chess
+    随机生成一盘棋局，发牌的规则见 rules.deal()。
+    '''
+    return deal()
 
 
 def random_user():
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: test_batch
+@author: Memory&Xinxin
+@date: 2019/12/26
+@document: 批量棋盘的测试：每一步能走的步、走完的局面和结果都和 rules.Board 一样
+'''
+
+import random
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from battlechess.batch import BoardBatch, ACTIONS, ONGOING
+from battlechess.rules import DIRECTION, ROW, SIZE, RED, BLUE, DRAW
+
+
+def encode_action(act):
+    '''
+    rules.Board.actions() 里的一步对应的走法编号。
+    '''
+    if len(act) == 1:
+        return act[0]
+    s, t = act
+    d = DIRECTION.index((t // ROW - s // ROW, t % ROW - s % ROW))
+    return SIZE + d * SIZE + s
+
+
+def same(board, other):
+    assert board.at == other.at
+    assert board.opened == other.opened
+    assert (board.turn, board.no_eat, board.step, board.result) == (other.turn, other.no_eat, other.step, other.result)
+    assert board.left == other.left
+    assert board.hash == other.hash
+
+
+def test_matches_rules_board():
+    rng = random.Random(5)
+    n = 40
+    batch = BoardBatch.deal(n, np.random.default_rng(5), np.arange(n) % 2, max_noeat=12)
+    boards = [batch.board(i) for i in range(n)]
+    for i, board in enumerate(boards):
+        assert board.turn == i % 2 and board.max_noeat == 12
+    plies = 0
+    while True:
+        rows = batch.ongoing()
+        assert list(rows) == [i for i, b in enumerate(boards) if b.result is None]
+        if not len(rows):
+            break
+        legal = batch.legal(rows)
+        actions = []
+        for k, i in enumerate(rows):
+            acts = boards[i].actions()
+            assert sorted(encode_action(a) for a in acts) == list(np.flatnonzero(legal[k]))
+            if not acts:
+                boards[i].resign(boards[i].turn)
+                batch.resign(rows[k:k + 1])
+                actions.append(None)
+                continue
+            act = rng.choice(acts)
+            boards[i].apply(act)
+            actions.append(encode_action(act))
+        keep = np.array([a is not None for a in actions], dtype=bool)
+        batch.apply(np.array([a for a in actions if a is not None], dtype=np.int64), rows[keep])
+        for i in rows:
+            same(batch.board(i), boards[i])
+        plies += len(rows)
+    assert plies > 1000
+    results = set(batch.result)
+    assert ONGOING not in results and results <= {RED, BLUE, DRAW}
+
+
+def test_finished_games_have_no_actions():
+    batch = BoardBatch.deal(3, 1)
+    batch.resign(np.array([1]))
+    legal = batch.legal()
+    assert legal.shape == (3, ACTIONS)
+    assert legal[0].sum() == SIZE and legal[2].sum() == SIZE and not legal[1].any()
+
+
+def test_from_boards_round_trip():
+    rng = random.Random(2)
+    boards = []
+    for i in range(10):
+        board = BoardBatch.deal(1, i).board(0)
+        for k in range(rng.randrange(60)):
+            acts = board.actions()
+            if not acts:
+                break
+            board.apply(rng.choice(acts))
+        boards.append(board)
+    batch = BoardBatch.from_boards(boards)
+    for i, board in enumerate(boards):
+        same(batch.board(i), board)
+    color, level, opened = batch.color, batch.level, batch.opened
+    for i, board in enumerate(boards):
+        for s in range(SIZE):
+            piece = board.piece(s)
+            x, y = divmod(s, ROW)
+            assert (color[i, x, y], level[i, x, y]) == (piece if piece else (-1, 0))
+            assert opened[i, x, y] == board.is_open(s)
+
+
+def test_features():
+    batch = BoardBatch.deal(50, 3)
+    batch.random_rollout(3, max_plies=20)
+    planes = batch.features()
+    assert planes.shape == (50, 14, ROW, ROW)
+    # 每个格子正好属于一个平面
+    assert (planes.sum(1) == 1).all()
+    mine = planes[:, 0:6].sum((1, 2, 3))
+    yours = planes[:, 6:12].sum((1, 2, 3))
+    opened = batch.opened.sum((1, 2))
+    assert (mine + yours == opened).all()
+
+
+def test_random_rollout_finishes():
+    batch = BoardBatch.deal(200, 7)
+    plies = batch.random_rollout(7)
+    assert not len(batch.ongoing())
+    assert plies == batch.step.sum()
+    for i in range(0, 200, 20):
+        board = batch.board(i)
+        assert board.result in (RED, BLUE, DRAW)
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: test_bench
+@author: Memory&Xinxin
+@date: 2019/12/21
+@document: 每个连接的内存开销的测试：空闲和登录以后的连接不超过预算，处理函数不放在每个连接上
+'''
+
+import inspect
+from battlechess.bench import IdleTransport, idle_connections
+from battlechess.codec import dict2bin, hello
+from battlechess.server import BCServerFactory, BCServerProtocol
+
+# 改动以前空闲连接大约 1700 字节，登录以后大约 2000 字节，现在大约 550 和 900 字节
+IDLE_BUDGET = 800
+LOGIN_BUDGET = 1300
+
+
+def test_idle_connection_size():
+    size, _ = idle_connections(2000)
+    assert size < IDLE_BUDGET
+
+
+def test_login_connection_size():
+    size, _ = idle_connections(2000, login=True)
+    assert size < LOGIN_BUDGET
+
+
+def test_no_per_connection_handlers():
+    factory = BCServerFactory()
+    p = factory.buildProtocol(None)
+    p.makeConnection(IdleTransport())
+    p.dataReceived(dict2bin(hello()))
+    assert isinstance(BCServerProtocol.parse, dict)
+    assert not [k for k, v in vars(p).items() if inspect.ismethod(v) or isinstance(v, dict)]
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: test_cache
+@author: Memory&Xinxin
+@date: 2019/12/06
+@document: 用户缓存的测试：延迟写回、淘汰、下线时立即写回
+'''
+
+from twisted.internet import defer
+from battlechess.cache import UserCache
+
+
+class FakeWorker(object):
+    '''
+    代替 DBWorker，写操作要测试自己调用 finish() 才完成。
+    '''
+    def __init__(self):
+        self.writes = []        # [(写入的行, Deferred)]
+
+    def write(self, fn, rows):
+        d = defer.Deferred()
+        self.writes.append((rows, d))
+        return d
+
+    def finish(self, i=0, error=None):
+        rows, d = self.writes.pop(i)
+        if error is None:
+            d.callback(None)
+        else:
+            d.errback(error)
+        return rows
+
+
+def user(name, credit=0):
+    return {'name': name, 'credit': credit, 'title': '平民'}
+
+
+def make(size=3):
+    worker = FakeWorker()
+    logs = []
+    return UserCache(worker, logs.append, size=size), worker, logs
+
+
+def test_updates_are_batched_until_flush():
+    cache, worker, logs = make()
+    cache.put(user('a'))
+    cache.update(user('a', 10))
+    cache.update(user('a', 20))
+    assert worker.writes == []
+    cache.flush()
+    assert worker.finish() == [user('a', 20)]
+    assert not cache.dirty and not cache.flushing
+
+
+def test_failed_flush_is_retried():
+    cache, worker, logs = make()
+    cache.update(user('a', 10))
+    cache.flush()
+    worker.finish(error=RuntimeError('disk full'))
+    assert cache.dirty == {'a'} and logs
+    cache.flush()
+    assert worker.finish() == [user('a', 10)]
+
+
+def test_put_keeps_unwritten_credit():
+    cache, worker, logs = make()
+    cache.update(user('a', 10))
+    assert cache.put(user('a', 0))['credit'] == 10
+    cache.flush()
+    # 写回的过程中数据库里还是旧的
+    assert cache.put(user('a', 0))['credit'] == 10
+    worker.finish()
+    # 写完以后以数据库为准，其他进程可能改过
+    assert cache.put(user('a', 30))['credit'] == 30
+
+
+def test_eviction_skips_pinned_and_dirty():
+    cache, worker, logs = make(size=2)
+    cache.put(user('a'))
+    cache.pin('a')
+    cache.update(user('b', 5))
+    # 钉住的和还没写回的不淘汰，新放进来的没人用过，先被淘汰
+    cache.put(user('c'))
+    assert 'a' in cache and 'b' in cache and 'c' not in cache
+    cache.flush()
+    worker.finish()
+    cache.get('b')
+    cache.put(user('d'))
+    assert 'a' in cache and 'b' not in cache and 'd' in cache
+
+
+def test_unpin_writes_user_before_firing():
+    cache, worker, logs = make()
+    cache.put(user('a'))
+    cache.pin('a')
+    cache.update(user('a', 40))
+    fired = []
+    cache.unpin('a').addCallback(fired.append)
+    assert fired == [] and 'a' not in cache.dirty
+    assert worker.finish() == [user('a', 40)]
+    assert fired == [None]
+
+
+def test_unpin_waits_for_batch_in_progress():
+    cache, worker, logs = make()
+    cache.update(user('a', 40))
+    cache.flush()
+    fired = []
+    cache.unpin('a').addCallback(fired.append)
+    assert fired == [] and len(worker.writes) == 1
+    worker.finish()
+    assert fired == [None]
+
+
+def test_unpin_after_change_during_batch_writes_again():
+    cache, worker, logs = make()
+    cache.update(user('a', 40))
+    cache.flush()
+    cache.update(user('a', 60))
+    fired = []
+    cache.unpin('a').addCallback(fired.append)
+    assert len(worker.writes) == 2
+    worker.finish()
+    assert fired == [] and 'a' in cache.flushing
+    assert worker.finish() == [user('a', 60)]
+    assert fired == [None] and not cache.flushing
+
+
+def test_unpin_clean_user_fires_at_once():
+    cache, worker, logs = make()
+    cache.put(user('a'))
+    fired = []
+    cache.unpin('a').addCallback(fired.append)
+    assert fired == [None] and worker.writes == []
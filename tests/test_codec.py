@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: test_codec
+@author: Memory&Xinxin
+@date: 2019/12/21
+@document: 数据包编码的测试：两种编码来回转换、拆包粘包、不合法的帧
+'''
+
+import pytest
+from battlechess.codec import (BINARY, JSON, BIN_HEADER, BIN_MARK, MAX_FRAME, FrameError,
+                               PacketDecoder, encode_packet, choose_codec, hello)
+
+
+def init_packet():
+    chess = [[None] * 6 for i in range(6)]
+    chess[0][0] = ['red', 6]
+    chess[5][5] = ['blue', 1]
+    chess[2][3] = ['blue', 4]
+    return {'type': 'init', 'chess': chess, 'turn': 'red', 'color': 'blue',
+            'me': {'name': 'memory', 'credit': 20}, 'you': {'name': 'xinxin', 'credit': 0}}
+
+
+PACKETS = [{'type': 'move', 'from': [0, 0], 'to': [5, 5]},
+           {'type': 'open', 'from': [3, 4]},
+           {'type': 'giveup'},
+           init_packet(),
+           {'type': 'match', 'name': 'memory'}]
+
+
+@pytest.mark.parametrize('codec', [JSON, BINARY])
+def test_round_trip(codec):
+    data = b''.join(encode_packet(p, codec) for p in PACKETS)
+    assert PacketDecoder().feed(data) == PACKETS
+    if codec == BINARY:
+        assert data[0] == BIN_MARK and len(encode_packet(PACKETS[0], codec)) == BIN_HEADER.size + 2
+
+
+def test_split_frames():
+    data = b''.join(encode_packet(p, c) for p in PACKETS for c in (JSON, BINARY))
+    decoder = PacketDecoder()
+    packets = []
+    for i in range(len(data)):
+        packets += decoder.feed(data[i:i + 1])
+    assert packets == [p for p in PACKETS for c in (JSON, BINARY)]
+    assert decoder.pending() == 0
+
+
+def test_unpackable_falls_back_to_json():
+    bad = {'type': 'move', 'from': [6, 0], 'to': [0, 0]}
+    data = encode_packet(bad, BINARY)
+    assert data.endswith(b'\n')
+    assert PacketDecoder().feed(data) == [bad]
+
+
+@pytest.mark.parametrize('typ, payload', [(1, bytes((36, 0))), (1, bytes((0, 255))), (2, bytes((36, )))])
+def test_square_out_of_range(typ, payload):
+    decoder = PacketDecoder()
+    frame = BIN_HEADER.pack(BIN_MARK, typ, len(payload)) + payload
+    with pytest.raises(FrameError):
+        decoder.feed(frame + encode_packet(PACKETS[2], BINARY))
+    assert decoder.pending() == 0
+
+
+def test_malformed_frames_are_dropped():
+    logs = []
+    decoder = PacketDecoder(log=logs.append)
+    data = b'not json\n' + b'[1, 2]\n' + b'\n'
+    data += BIN_HEADER.pack(BIN_MARK, 99, 0)                      # 未知的类型
+    data += BIN_HEADER.pack(BIN_MARK, 1, 1) + bytes((3, ))        # 走棋少了一个字节
+    data += encode_packet(PACKETS[0], BINARY)
+    assert decoder.feed(data) == [PACKETS[0]]
+    assert len(logs) == 4
+
+
+def test_frame_too_long():
+    decoder = PacketDecoder()
+    with pytest.raises(FrameError):
+        decoder.feed(b'x' * (MAX_FRAME + 1))
+    assert decoder.pending() == 0
+    assert decoder.feed(encode_packet(PACKETS[2])) == [PACKETS[2]]
+
+
+def test_choose_codec():
+    assert choose_codec(hello()) == BINARY
+    assert choose_codec({'type': 'hello', 'codecs': [JSON]}) == JSON
+    assert choose_codec({'type': 'hello'}) == JSON
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: test_leaderboard
+@author: Memory&Xinxin
+@date: 2019/12/21
+@document: 排行榜的测试：和逐个排序的结果比较名次、前 N 名、前后的人
+'''
+
+import random
+from battlechess import leaderboard
+from battlechess.leaderboard import Leaderboard, SortedNames
+
+
+def expected(credits):
+    '''
+    直接排序得到的排行榜。
+    '''
+    order = sorted(credits.items(), key=lambda item: (-item[1], item[0]))
+    rank = {}
+    for p, (name, credit) in enumerate(order):
+        rank[name] = 1 + sum(1 for c in credits.values() if c > credit)
+    return order, rank
+
+
+def check(board, credits):
+    order, rank = expected(credits)
+    assert len(board) == len(credits)
+    assert [(e['name'], e['credit']) for e in board.top(len(credits) + 5)] == order
+    for name in credits:
+        assert board.rank(name) == rank[name]
+        p = [n for n, c in order].index(name)
+        around = [(e['name'], e['credit']) for e in board.around(name, 2)]
+        assert around == order[max(p - 2, 0):p + 3]
+
+
+def test_random_updates(monkeypatch):
+    # 段很小，才能测到分段和合并
+    monkeypatch.setattr(leaderboard, 'LOAD', 2)
+    rng = random.Random(1)
+    board = Leaderboard(top=5)
+    credits = {}
+    rows = [('u%02d' % i, rng.choice((0, 0, 0, 10, 20))) for i in range(30)]
+    board.rebuild(rows)
+    credits.update(rows)
+    check(board, credits)
+    for k in range(300):
+        name = 'u%02d' % rng.randrange(40)
+        credit = rng.choice((0, 0, -20, 10, 20, 3000))
+        board.update(name, credit)
+        credits[name] = credit
+        board.top(3)
+        if k % 10 == 0:
+            check(board, credits)
+    check(board, credits)
+
+
+def test_top_cache_drops_player_leaving_from_zero():
+    board = Leaderboard(top=3)
+    board.rebuild([('a', 10), ('b', 0), ('c', 0), ('d', -5)])
+    assert [e['name'] for e in board.top(3)] == ['a', 'b', 'c']
+    board.update('b', -20)
+    assert [(e['name'], e['credit']) for e in board.top(3)] == [('a', 10), ('c', 0), ('d', -5)]
+
+
+def test_titles_count_everyone():
+    board = Leaderboard()
+    board.rebuild([('a', -100), ('b', 0), ('c', 5000), ('d', 100000)])
+    assert sum(board.titles().values()) == 4
+
+
+def test_sorted_names(monkeypatch):
+    monkeypatch.setattr(leaderboard, 'LOAD', 3)
+    rng = random.Random(2)
+    names = SortedNames()
+    plain = []
+    for k in range(500):
+        name = 'n%03d' % rng.randrange(200)
+        if name in plain:
+            names.remove(name)
+            plain.remove(name)
+        else:
+            names.add(name)
+            plain.append(name)
+            plain.sort()
+        assert len(names) == len(plain)
+        if plain:
+            i = rng.randrange(len(plain))
+            assert names[i] == plain[i]
+            assert names.index(plain[i]) == i
+            assert names[i:i + 7] == plain[i:i + 7]
+    assert list(names) == plain
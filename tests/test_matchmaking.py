@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: test_matchmaking
+@author: Memory&Xinxin
+@date: 2019/12/21
+@document: 匹配队列的测试：积分接近的先匹配、同一个桶里先来先匹配、等待变长后放宽、定时重新匹配
+'''
+
+import random
+from battlechess.matchmaking import MatchQueue
+
+
+def test_pairs_closest_bucket_first():
+    q = MatchQueue(bucket=100, window=300, widen=0)
+    q.add('far', 1250, now=0)
+    q.add('near', 1080, now=0)
+    q.add('me', 1000, now=1)
+    assert q.pair('me', now=1) == 'near'
+    assert 'me' not in q and 'near' not in q
+    assert list(q) == ['far']
+
+
+def test_fifo_within_bucket():
+    q = MatchQueue(bucket=100, window=100, widen=0)
+    q.add('a', 1010, now=0)
+    q.add('b', 1050, now=1)
+    q.add('me', 1040, now=2)
+    assert q.pair('me', now=2) == 'a'
+
+
+def test_partial_bucket_takes_closest():
+    q = MatchQueue(bucket=100, window=30, widen=0)
+    q.add('low', 1101, now=0)
+    q.add('high', 1190, now=1)
+    q.add('me', 1090, now=2)
+    # 1100 号桶只有一部分在范围内，不能取等得最久的人
+    assert q.pair('me', now=2) == 'low'
+    q.add('me', 1160, now=3)
+    assert q.find('me', now=3) == 'high'
+
+
+def test_window_widens_with_wait():
+    q = MatchQueue(bucket=100, window=100, widen=50)
+    q.add('a', 1000, now=0)
+    q.add('b', 1400, now=0)
+    assert q.pair('b', now=0) is None
+    assert q.sweep(now=5) == []
+    assert q.sweep(now=6) in ([('a', 'b')], [('b', 'a')])
+    assert len(q) == 0
+    stats = q.stats()
+    assert stats[1000]['matched'] == 1 and stats[1400]['max_wait'] == 6
+
+
+def test_cancel():
+    q = MatchQueue(bucket=100, window=100, widen=50)
+    q.add('a', 1000, now=0)
+    assert not q.add('a', 1000, now=0)
+    q.add('b', 1500, now=0)
+    assert q.cancel('a')
+    assert not q.cancel('a')
+    assert q.sweep(now=100) == []
+    assert list(q) == ['b']
+    assert 1000 not in q.stats()
+
+
+def unmatched(q, credits, since, now):
+    '''
+    还能匹配上的两个人，直接两两比较。
+    '''
+    names = list(q)
+    for a in names:
+        for b in names:
+            if a != b and abs(credits[a] - credits[b]) <= q.accept(since[a], now):
+                return a, b
+    return None
+
+
+def test_sweep_leaves_nobody_matchable():
+    rng = random.Random(3)
+    q = MatchQueue(bucket=50, window=40, widen=7)
+    credits, since = {}, {}
+    now = 0.0
+    for step in range(3000):
+        now += rng.random() * 0.5
+        op = rng.random()
+        if op < 0.6:
+            name = 'p%d' % step
+            credits[name] = rng.randint(0, 3000)
+            since[name] = now
+            q.add(name, credits[name], now=now)
+            you = q.pair(name, now=now)
+            if you is not None:
+                assert abs(credits[name] - credits[you]) <= q.accept(now, now)
+        elif op < 0.8 and len(q):
+            q.cancel(rng.choice(list(q)))
+        else:
+            for me, you in q.sweep(now=now):
+                assert abs(credits[me] - credits[you]) <= q.accept(since[me], now)
+            assert unmatched(q, credits, since, now) is None
+        assert sum(len(b) for b in q.buckets.values()) == len(q)
+        assert sum(len(l) for l in q.ladders.values()) == len(q)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: test_rating
+@author: Memory&Xinxin
+@date: 2019/12/22
+@document: Elo 积分的测试：单局的积分变化、批量重算和逐局计算一致、写回数据库时保留原有的积分
+'''
+
+import random
+import pytest
+from battlechess.configs import WIN_CREDIT
+from battlechess.rating import K, deltas, expected, recompute, rebase
+
+np = pytest.importorskip('numpy')
+
+
+def test_equal_credits_move_by_win_credit():
+    assert deltas(100, 100, 1.0) == (WIN_CREDIT, -WIN_CREDIT)
+    assert deltas(100, 100, 0.0) == (-WIN_CREDIT, WIN_CREDIT)
+    assert deltas(100, 100, 0.5) == (0, 0)
+
+
+def test_upsets_move_more():
+    favourite, underdog = deltas(800, 200, 1.0)[0], deltas(200, 800, 1.0)[0]
+    assert 0 < favourite < WIN_CREDIT < underdog <= K
+    # 和棋时积分低的一方加分
+    assert deltas(200, 800, 0.5)[0] > 0
+
+
+def test_deltas_are_zero_sum_and_protected():
+    for red, blue, score in [(0, 0, 1.0), (300, -50, 0.0), (1234, 77, 0.5)]:
+        a, b = deltas(red, blue, score)
+        assert a == -b
+        pa, pb = deltas(red, blue, score, protect=True)
+        assert (pa, pb) == (max(a, 0), max(b, 0))
+    assert abs(expected(0, 400) - 1.0 / 11) < 1e-12
+
+
+def test_recompute_matches_sequential():
+    rng = random.Random(5)
+    players = 30
+    red, blue, score, protect = [], [], [], []
+    for i in range(3000):
+        a, b = rng.sample(range(players), 2)
+        red.append(a)
+        blue.append(b)
+        score.append(rng.choice((0.0, 0.5, 1.0)))
+        protect.append(rng.random() < 0.1)
+    ratings = [0] * players
+    for a, b, s, p in zip(red, blue, score, protect):
+        da, db = deltas(ratings[a], ratings[b], s, p)
+        ratings[a] += da
+        ratings[b] += db
+    assert recompute(red, blue, score, protect, players).tolist() == ratings
+
+
+def test_rebase_keeps_credit_not_from_records():
+    red, blue, score = [0, 1, 0], [1, 2, 2], [1.0, 0.0, 0.5]
+    names = ['a', 'b', 'c']
+    baseline = recompute(red, blue, score, None, 3)
+    stored = {'a': 2000 + baseline[0], 'b': 35 + baseline[1], 'seed': 2000}
+    # 参数不变时什么都不变；没有在数据库里的 c、没有对局记录的 seed 都不写
+    same = rebase(stored, names, baseline.tolist(), baseline.tolist())
+    assert [(u['name'], u['credit']) for u in same] == [('a', stored['a']), ('b', stored['b'])]
+    ratings = recompute(red, blue, score, None, 3, k=10)
+    users = rebase(stored, names, ratings.tolist(), baseline.tolist())
+    assert [u['credit'] for u in users] == [2000 + ratings[0], 35 + ratings[1]]
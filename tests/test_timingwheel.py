@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+'''
+@name: test_timingwheel
+@author: Memory&Xinxin
+@date: 2019/12/21
+@document: 时间轮的测试：按时触发、取消和替换、超过一圈、reactor 卡住以后补上落下的格
+'''
+
+from twisted.internet import task
+from battlechess.timingwheel import TimingWheel
+
+
+def started(tick=1, slots=8):
+    clock = task.Clock()
+    wheel = TimingWheel(tick=tick, slots=slots, clock=clock)
+    wheel.start(clock)
+    return clock, wheel
+
+
+def test_fires_on_time():
+    clock, wheel = started()
+    fired = []
+    wheel.schedule('a', 3, lambda key: fired.append((key, clock.seconds())))
+    wheel.schedule('b', 0.2, lambda key: fired.append((key, clock.seconds())))
+    for i in range(5):
+        clock.advance(1)
+    assert fired == [('b', 1), ('a', 3)]
+    assert len(wheel) == 0
+
+
+def test_cancel_and_replace():
+    clock, wheel = started()
+    fired = []
+    wheel.schedule('a', 2, fired.append)
+    wheel.schedule('b', 2, fired.append)
+    wheel.cancel('a')
+    wheel.schedule('b', 4, fired.append)
+    clock.advance(3)
+    clock.advance(1)
+    clock.advance(1)
+    assert fired == ['b']
+    assert 'a' not in wheel and 'b' not in wheel
+
+
+def test_more_than_one_round():
+    clock, wheel = started(slots=8)
+    fired = []
+    wheel.schedule('a', 20, fired.append)
+    for i in range(19):
+        clock.advance(1)
+    assert fired == []
+    clock.advance(1)
+    assert fired == ['a']
+
+
+def test_catches_up_after_stall():
+    clock, wheel = started(slots=8)
+    fired = []
+    for key, delay in (('a', 2), ('b', 5), ('c', 11), ('d', 30)):
+        wheel.schedule(key, delay, fired.append)
+    # reactor 卡住了 12 秒，LoopingCall 只会调用一次
+    clock.advance(12)
+    assert fired == ['a', 'b', 'c']
+    assert wheel.now == 12 and wheel.turned == 12
+    # 之后的任务仍然按原来的时间触发
+    wheel.schedule('e', 3, fired.append)
+    clock.advance(3)
+    assert fired[-1] == 'e'
+    clock.advance(14)
+    assert fired == ['a', 'b', 'c', 'e']
+    clock.advance(1)
+    assert fired[-1] == 'd'
+
+
+def test_callback_errors_and_reschedule():
+    logs = []
+    clock = task.Clock()
+    wheel = TimingWheel(clock=clock, log=logs.append)
+    wheel.start(clock)
+    fired = []
+
+    def again(key):
+        fired.append(key)
+        wheel.schedule(key, 1, again)
+
+    wheel.schedule('bad', 1, lambda key: 1 / 0)
+    wheel.schedule('good', 1, again)
+    clock.advance(1)
+    clock.advance(1)
+    assert fired == ['good', 'good']
+    assert len(logs) == 1 and 'good' in wheel
+    wheel.stop()
+    assert not clock.getDelayedCalls()